@@ -0,0 +1,188 @@
+"""Dump import benchmark
+
+Times the schema and the data import of a mysqldump xml file (:func:`.mysqldump_parser_schema` and
+:func:`.mysqldump_parser_data`) and prints the results as JSON. The dump is generated with
+:mod:`benchmarks.gen_mysqldump` unless ``--dump`` is given. Run it from the repository root::
+
+    python -m benchmarks.dump_import --mode parse --tables 10 --size-mb 100
+
+In ``parse`` mode mongo is replaced by an in-memory stand-in that drops the rows, measuring the parsing and
+the type conversion alone; in ``write`` mode the rows are written to ``--mongo-uri`` or to mongomock, with a
+single writer thread. Every mode runs in its own process, so its peak RSS is not affected by the others.
+
+"""
+import argparse
+import configparser
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from queue import Empty
+
+from benchmarks.gen_mysqldump import DumpGenerator, add_arguments
+from mymongolib import utils
+from mymongolib.mongodb import MyMongoDB
+
+
+class ParseOnlyMongoDB(MyMongoDB):
+    """:class:`.MyMongoDB` keeping the table structures in memory and dropping the rows
+
+    """
+    def __init__(self, conf):
+        MyMongoDB.__init__(self, conf, client=object())
+        self.structures = dict()
+        self.rows = 0
+
+    def insert_primary_key(self, doc):
+        self.structures[doc['_id']] = doc
+
+    def get_primary_key(self, table, db):
+        return self.structures.get(db + '.' + table)
+
+    def insert_many(self, docs, schema, collection, ordered=True):
+        self.rows += len(docs)
+
+    def create_index(self, keys, schema, collection, name=None, unique=False):
+        pass
+
+    def drop_db(self, db_name):
+        pass
+
+    def write_log_pos(self, log_file, log_pos, seqnum=None):
+        pass
+
+    def make_db_as_parsed(self, db, parse_type):
+        pass
+
+
+def peak_rss():
+    """Peak resident memory of the process in bytes
+
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def import_dump(args, mode, results):
+    """Import the dump in schema and data phases, in a child process
+
+    Args:
+        args (object): parsed command line arguments
+        mode (str): ``parse`` or ``write``
+        results (object): multiprocessing queue where the results are put
+
+    """
+    writers = args.writers
+    config = configparser.ConfigParser()
+    config.read_dict({'mongodb': {'host': '', 'port': '', 'user': '', 'password': '', 'utildb': args.utildb,
+                                  'id_mode': args.id_mode}})
+    if mode == 'parse':
+        mongodb = ParseOnlyMongoDB(config['mongodb'])
+    elif args.mongo_uri is not None:
+        import pymongo
+        mongodb = MyMongoDB(config['mongodb'], pymongo.MongoClient(args.mongo_uri))
+    else:
+        import mongomock
+        mongodb = MyMongoDB(config['mongodb'], mongomock.MongoClient())
+        # mongomock is not thread safe
+        writers = 1
+
+    baseline = peak_rss()
+    start = time.time()
+    utils.mysqldump_parser_schema(args.dump, mongodb)
+    schema = time.time()
+    utils.mysqldump_parser_data(args.dump, mongodb, batch_size=args.batch_size, writers=writers,
+                                queue_size=args.queue_size)
+    data = time.time()
+
+    results.put({
+        'schema_seconds': schema - start,
+        'data_seconds': data - schema,
+        'writers': writers,
+        'rows_per_second': args.total_rows / (data - schema) if args.total_rows else None,
+        'mb_per_second': os.path.getsize(args.dump) / 1024 / 1024 / (data - schema),
+        'baseline_rss_bytes': baseline,
+        'peak_rss_bytes': peak_rss(),
+    })
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Dump import benchmark')
+    parser.add_argument('--dump', help='existing mysqldump xml file, default to a generated one')
+    parser.add_argument('--mode', default='both', choices=['parse', 'write', 'both'],
+                        help='parse only, parse and write to mongo or both')
+    parser.add_argument('--mongo-uri', help='mongod to write to, default to mongomock')
+    parser.add_argument('--utildb', default='mymongo_bench_utils')
+    parser.add_argument('--id-mode', default='objectid', choices=['objectid', 'primary_key'])
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows per insert')
+    parser.add_argument('--writers', type=int, default=2, help='writer threads')
+    parser.add_argument('--queue-size', type=int, default=8, help='max batches waiting to be written')
+    parser.add_argument('--output', help='file where the JSON results are written, default to stdout')
+    add_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def run(args):
+    """Run the benchmark
+
+    Args:
+        args (object): parsed command line arguments
+
+    Returns:
+        dict: results
+
+    """
+    generated = None
+    args.total_rows = None
+    if args.dump is None:
+        generated = tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False)
+        start = time.time()
+        with generated:
+            args.total_rows = DumpGenerator(args).write(generated)
+        args.dump = generated.name
+        generate_seconds = time.time() - start
+    else:
+        generate_seconds = None
+
+    try:
+        results = {'params': vars(args).copy(), 'dump_bytes': os.path.getsize(args.dump),
+                   'rows': args.total_rows, 'generate_seconds': generate_seconds}
+        modes = ['parse', 'write'] if args.mode == 'both' else [args.mode]
+        for mode in modes:
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=import_dump, args=(args, mode, queue))
+            proc.start()
+            while True:
+                try:
+                    results[mode] = queue.get(timeout=1)
+                    break
+                except Empty:
+                    if not proc.is_alive():
+                        results[mode] = {'error': 'import exited with code ' + str(proc.exitcode)}
+                        break
+            proc.join()
+    finally:
+        if generated is not None:
+            os.remove(generated.name)
+
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = json.dumps(run(args), indent=2, sort_keys=True)
+    if args.output is None:
+        sys.stdout.write(results + '\n')
+    else:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+
+
+if __name__ == '__main__':
+    main()
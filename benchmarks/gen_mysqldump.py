@@ -0,0 +1,148 @@
+"""Synthetic mysqldump xml generator
+
+Writes a dump in the format of ``mysqldump --xml --master-data=2 --hex-blob``, with table structures and rows,
+to benchmark the dump import without a mysql server. Run it from the repository root::
+
+    python -m benchmarks.gen_mysqldump --output /tmp/dump.xml --tables 10 --size-mb 100 --null-density 0.2
+
+"""
+import argparse
+import random
+import string
+import sys
+
+from xml.sax.saxutils import quoteattr, escape
+
+# mysql type and value generator of the columns, cycled after the primary key
+COLUMN_TYPES = [
+    ('varchar(255)', lambda rnd, size: ''.join(rnd.choice(string.ascii_letters) for i in range(size))),
+    ('int(11)', lambda rnd, size: str(rnd.randint(-2 ** 31, 2 ** 31 - 1))),
+    ('decimal(12,2)', lambda rnd, size: '{0:.2f}'.format(rnd.uniform(-10 ** 9, 10 ** 9))),
+    ('datetime', lambda rnd, size: '20{0:02d}-{1:02d}-{2:02d} {3:02d}:{4:02d}:{5:02d}'.format(
+        rnd.randint(0, 30), rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59),
+        rnd.randint(0, 59))),
+    ('double', lambda rnd, size: repr(rnd.random() * 10 ** 6)),
+    ('date', lambda rnd, size: '20{0:02d}-{1:02d}-{2:02d}'.format(rnd.randint(0, 30), rnd.randint(1, 12),
+                                                                    rnd.randint(1, 28))),
+    ('blob', lambda rnd, size: '0x' + ''.join(rnd.choice('0123456789ABCDEF') for i in range(size * 2))),
+]
+
+
+class DumpGenerator:
+    """Writes a synthetic mysqldump xml output
+
+    Every table has an auto increment ``id`` primary key, ``columns - 1`` columns of the types in
+    ``COLUMN_TYPES`` and a secondary index on its first column. The values are drawn from a pool per column, so
+    generating the dump is much faster than importing it.
+
+    Args:
+        args (object): parsed command line arguments
+
+    """
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.columns = [('id', 'int(11)', None)]
+        for i in range(1, args.columns):
+            mysql_type, gen = COLUMN_TYPES[(i - 1) % len(COLUMN_TYPES)]
+            pool = [escape(gen(self.random, args.value_size)) for j in range(256)]
+            self.columns.append(('c' + str(i), mysql_type, pool))
+
+    def structure(self, table):
+        lines = ['\t<table_structure name=' + quoteattr(table) + '>']
+        for name, mysql_type, pool in self.columns:
+            key = 'PRI' if name == 'id' else ''
+            null = 'NO' if name == 'id' else 'YES'
+            lines.append('\t\t<field Field="{0}" Type="{1}" Null="{2}" Key="{3}" Extra="" Comment="" />'.format(
+                name, mysql_type, null, key))
+        lines.append('\t\t<key Table={0} Non_unique="0" Key_name="PRIMARY" Seq_in_index="1" '
+                     'Column_name="id" />'.format(quoteattr(table)))
+        if len(self.columns) > 1:
+            lines.append('\t\t<key Table={0} Non_unique="1" Key_name="ix_{1}" Seq_in_index="1" '
+                         'Column_name="{1}" />'.format(quoteattr(table), self.columns[1][0]))
+        lines.append('\t</table_structure>')
+
+        return '\n'.join(lines) + '\n'
+
+    def row(self, row_id):
+        lines = ['\t<row>', '\t\t<field name="id">' + str(row_id) + '</field>']
+        for name, mysql_type, pool in self.columns[1:]:
+            if self.random.random() < self.args.null_density:
+                lines.append('\t\t<field name="' + name + '" xsi:nil="true" />')
+            else:
+                lines.append('\t\t<field name="' + name + '">' + self.random.choice(pool) + '</field>')
+        lines.append('\t</row>')
+
+        return '\n'.join(lines) + '\n'
+
+    def rows_per_table(self):
+        """Rows of each table, from ``rows`` or estimated from the target ``size_mb``
+
+        """
+        if self.args.size_mb is None:
+            return self.args.rows
+
+        sample = sum(len(self.row(i)) for i in range(100)) / 100
+        tables = self.args.databases * self.args.tables
+
+        return max(1, int(self.args.size_mb * 1024 * 1024 / (sample * tables)))
+
+    def write(self, out):
+        """Write the dump
+
+        Args:
+            out (object): text file
+
+        Returns:
+            int: rows written
+
+        """
+        rows = self.rows_per_table()
+        total = 0
+        out.write('<?xml version="1.0"?>\n')
+        out.write('<mysqldump xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+        out.write('<!--\nCHANGE MASTER TO MASTER_LOG_FILE=\'mysql-bin.000001\', MASTER_LOG_POS=4;\n-->\n')
+        for d in range(self.args.databases):
+            db = self.args.prefix + str(d + 1)
+            out.write('<database name=' + quoteattr(db) + '>\n')
+            for t in range(self.args.tables):
+                table = 't' + str(t + 1)
+                out.write(self.structure(table))
+                out.write('\t<table_data name=' + quoteattr(table) + '>\n')
+                for row_id in range(1, rows + 1):
+                    out.write(self.row(row_id))
+                out.write('\t</table_data>\n')
+                total += rows
+            out.write('</database>\n')
+        out.write('</mysqldump>\n')
+
+        return total
+
+
+def add_arguments(parser):
+    parser.add_argument('--databases', type=int, default=1, help='databases in the dump')
+    parser.add_argument('--prefix', default='mymongo_bench', help='prefix of the database names')
+    parser.add_argument('--tables', type=int, default=4, help='tables in each database')
+    parser.add_argument('--rows', type=int, default=10000, help='rows in each table')
+    parser.add_argument('--size-mb', type=float, help='approximate dump size, overrides --rows')
+    parser.add_argument('--columns', type=int, default=8, help='columns of each table, primary key included')
+    parser.add_argument('--value-size', type=int, default=16, help='characters of the string and blob values')
+    parser.add_argument('--null-density', type=float, default=0.1, help='fraction of NULL values')
+    parser.add_argument('--seed', type=int, default=42)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Synthetic mysqldump xml generator')
+    parser.add_argument('--output', help='dump file, default to stdout')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.output is None:
+        DumpGenerator(args).write(sys.stdout)
+    else:
+        with open(args.output, 'w') as f:
+            DumpGenerator(args).write(f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+"""Replication throughput benchmark
+
+Replays synthetic binlog row events through the replicator capture (:class:`.BinlogCapture`) and the data
+munging workers (:meth:`.DataMunging.run`) and prints the results as JSON. Run it from the repository root::
+
+    python -m benchmarks.replication --events 100000 --mix 60:30:10 --columns 50 --hot-keys 100
+
+Without ``--mongo-uri`` mongo is replaced by mongomock, which measures the replicator code alone. The workers
+run as threads of the benchmark process, so adding workers only helps when they wait on a real mongod.
+
+"""
+import argparse
+import configparser
+import json
+import queue
+import random
+import string
+import sys
+import threading
+import time
+
+from collections import Counter
+
+from pymysqlreplication.row_event import DeleteRowsEvent, UpdateRowsEvent, WriteRowsEvent
+
+from mymongolib.datamunging import DataMunging
+from mymongolib.mongodb import MyMongoDB
+from mymongolib.mysql import BinlogCapture, STMT_END_F
+
+
+def synthetic_event(base):
+    """Build a binlog rows event class filled from python values instead of a binlog packet
+
+    Args:
+        base (class): pymysqlreplication rows event class
+
+    Returns:
+        class: subclass of ``base``
+
+    """
+    class SyntheticEvent(base):
+        rows = None
+
+        def __init__(self, schema, table, primary_key, rows):
+            self.schema = schema
+            self.table = table
+            self.primary_key = primary_key
+            self.rows = rows
+            self.flags = STMT_END_F
+            self.timestamp = time.time()
+
+    SyntheticEvent.__name__ = 'Synthetic' + base.__name__
+
+    return SyntheticEvent
+
+
+SyntheticWriteRowsEvent = synthetic_event(WriteRowsEvent)
+SyntheticUpdateRowsEvent = synthetic_event(UpdateRowsEvent)
+SyntheticDeleteRowsEvent = synthetic_event(DeleteRowsEvent)
+
+
+class EventGenerator:
+    """Generates a reproducible stream of insert, update and delete events on one table
+
+    Args:
+        args (object): parsed command line arguments
+
+    """
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.columns = ['c' + str(i) for i in range(1, args.columns)]
+        self.pool = [''.join(self.random.choice(string.ascii_letters) for i in range(args.value_size))
+                     for j in range(1000)]
+        weights = [int(w) for w in args.mix.split(':')]
+        self.kinds = ['insert'] * weights[0] + ['update'] * weights[1] + ['delete'] * weights[2]
+        self.live = list()
+        self.rows = dict()
+        self.next_id = 1
+
+    def value(self):
+        return self.random.choice(self.pool)
+
+    def pick(self):
+        """Pick the position in ``live`` of an existing row, preferring the hot ones with ``hot_fraction``
+
+        """
+        if self.args.hot_keys > 0 and self.random.random() < self.args.hot_fraction:
+            return self.random.randrange(min(self.args.hot_keys, len(self.live)))
+
+        return self.random.randrange(len(self.live))
+
+    def row(self, kind):
+        # every event gets its own copy of the values, like the rows decoded from a binlog packet: the apply
+        # workers add the mongo _id to them
+        if kind == 'insert' or len(self.live) == 0:
+            row_id = self.next_id
+            self.next_id += 1
+            values = {'id': row_id}
+            for column in self.columns:
+                values[column] = self.value()
+            self.live.append(row_id)
+            self.rows[row_id] = values
+            return 'insert', {'values': dict(values)}
+
+        pos = self.pick()
+        row_id = self.live[pos]
+        before = self.rows[row_id]
+        if kind == 'update':
+            after = dict(before)
+            for column in self.random.sample(self.columns, min(self.args.update_columns, len(self.columns))):
+                after[column] = self.value()
+            self.rows[row_id] = after
+            return 'update', {'before_values': dict(before), 'after_values': dict(after)}
+
+        self.live[pos] = self.live[-1]
+        self.live.pop()
+        del self.rows[row_id]
+        return 'delete', {'values': dict(before)}
+
+    def events(self):
+        """Generate the events
+
+        Returns:
+            list: synthetic binlog rows events of ``rows_per_event`` rows of the same type
+
+        """
+        classes = {'insert': SyntheticWriteRowsEvent, 'update': SyntheticUpdateRowsEvent,
+                   'delete': SyntheticDeleteRowsEvent}
+        events = list()
+        for i in range(self.args.events):
+            kind, row = self.row(self.random.choice(self.kinds))
+            rows = [row]
+            for j in range(self.args.rows_per_event - 1):
+                if kind != 'insert' and len(self.live) == 0:
+                    break
+                rows.append(self.row(kind)[1])
+            events.append(classes[kind](self.args.schema, self.args.table, 'id', rows))
+
+        return events
+
+
+class CountingCollection:
+    """Proxy of a pymongo collection counting the calls of its methods
+
+    Args:
+        coll (object): pymongo collection
+        ops (object): Counter of the calls by method name
+        lock (object): lock shared by all the counters
+        serialize (bool): run the calls holding the lock, for clients not thread safe like mongomock
+
+    """
+    def __init__(self, coll, ops, lock, serialize):
+        self.coll = coll
+        self.ops = ops
+        self.lock = lock
+        self.serialize = serialize
+
+    def __getattr__(self, name):
+        attr = getattr(self.coll, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            with self.lock:
+                self.ops[name] += 1
+                if self.serialize:
+                    return attr(*args, **kwargs)
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+class BenchMongoDB(MyMongoDB):
+    """:class:`.MyMongoDB` counting the mongo operations
+
+    """
+    def __init__(self, conf, client, ops, lock, serialize=False):
+        MyMongoDB.__init__(self, conf, client)
+        self.ops = ops
+        self.lock = lock
+        self.serialize = serialize
+
+    def get_coll(self, coll_name, db_name):
+        with self.lock:
+            coll = MyMongoDB.get_coll(self, coll_name, db_name)
+
+        return CountingCollection(coll, self.ops, self.lock, self.serialize)
+
+
+class BenchDataMunging(DataMunging):
+    """:class:`.DataMunging` recording the latency between the capture and the application of every record
+
+    """
+    latencies = None
+
+    def applied_metrics(self, doc):
+        if doc.get('timestamp') is not None:
+            self.latencies.append(time.time() - doc['timestamp'])
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+
+    return values[int(round(q * (len(values) - 1)))]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replication throughput benchmark')
+    parser.add_argument('--mongo-uri', help='mongod to write to, default to mongomock')
+    parser.add_argument('--events', type=int, default=10000, help='binlog rows events to replay')
+    parser.add_argument('--rows-per-event', type=int, default=1, help='rows in each binlog event')
+    parser.add_argument('--mix', default='60:30:10', help='insert:update:delete weights')
+    parser.add_argument('--columns', type=int, default=5, help='columns of the table, primary key included')
+    parser.add_argument('--value-size', type=int, default=16, help='bytes of the column values')
+    parser.add_argument('--update-columns', type=int, default=1, help='columns changed by an update')
+    parser.add_argument('--hot-keys', type=int, default=0, help='number of hot rows, 0 for a uniform choice')
+    parser.add_argument('--hot-fraction', type=float, default=0.9,
+                        help='fraction of updates and deletes hitting the hot rows')
+    parser.add_argument('--workers', type=int, default=1, help='data munging workers (partitions)')
+    parser.add_argument('--pipeline', default='queue', choices=['queue', 'direct'])
+    parser.add_argument('--flush-rows', type=int, default=1000)
+    parser.add_argument('--max-pending', type=int, default=0,
+                        help='rows waiting to be applied above which the capture pauses, 0 to never pause')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--apply-mode', default='bulk', choices=['bulk', 'single'])
+    parser.add_argument('--update-mode', default='delta', choices=['delta', 'replace'])
+    parser.add_argument('--id-mode', default='objectid', choices=['objectid', 'primary_key'])
+    parser.add_argument('--no-coalesce', action='store_true', help='apply every event of a batch')
+    parser.add_argument('--timeout', type=float, default=600, help='max seconds to wait for the apply')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--schema', default='mymongo_bench')
+    parser.add_argument('--table', default='bench')
+    parser.add_argument('--utildb', default='mymongo_bench_utils')
+    parser.add_argument('--output', help='file where the JSON results are written, default to stdout')
+
+    return parser.parse_args(argv)
+
+
+def run(args):
+    """Run the benchmark
+
+    Args:
+        args (object): parsed command line arguments
+
+    Returns:
+        dict: results
+
+    """
+    if args.mongo_uri is not None:
+        import pymongo
+        client = pymongo.MongoClient(args.mongo_uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'mongodb': {'host': '', 'port': '', 'user': '', 'password': '', 'utildb': args.utildb,
+                    'id_mode': args.id_mode},
+        'datamunging': {'pipeline': args.pipeline, 'apply_mode': args.apply_mode, 'batch_size': args.batch_size,
+                        'update_mode': args.update_mode, 'coalesce': not args.no_coalesce,
+                        'idle_timeout': 0.05, 'state_interval': 1}
+    })
+    client.drop_database(args.schema)
+    client.drop_database(args.utildb)
+
+    generator = EventGenerator(args)
+    events = generator.events()
+
+    monitor = MyMongoDB(config['mongodb'], client)
+    columns = [['id', 'int(11)']] + [[column, 'varchar(255)'] for column in generator.columns]
+    monitor.insert_primary_key({'_id': args.schema + '.' + args.table, 'primary_key': ['id'],
+                                'columns': columns, 'indexes': []})
+    rows = sum(len(event.rows) for event in events)
+
+    ops = Counter()
+    lock = threading.RLock()
+    serialize = args.mongo_uri is None
+    queues_out = [queue.Queue() for partition in range(args.workers)]
+    ack_queue = queue.Queue() if args.pipeline == 'direct' else None
+    latencies = list()
+    for partition in range(args.workers):
+        munging = BenchDataMunging(BenchMongoDB(config['mongodb'], client, ops, lock, serialize), queues_out[partition],
+                                   config['datamunging'], partition, ack_queue)
+        munging.latencies = latencies
+        worker = threading.Thread(target=munging.run)
+        worker.daemon = True
+        worker.start()
+
+    mongo = BenchMongoDB(config['mongodb'], client, ops, lock, serialize)
+    mongo.init_seqnum()
+    capture = BinlogCapture(mongo, queues_out, flush_rows=args.flush_rows, flush_interval=0, ack_queue=ack_queue,
+                            max_pending=args.max_pending)
+
+    start = time.time()
+    for pos, event in enumerate(events):
+        event.timestamp = time.time()
+        capture.add_event(event, 'mysql-bin.000001', pos + 1)
+    capture.flush()
+    captured = time.time()
+
+    applied = False
+    while time.time() - captured < args.timeout:
+        if ack_queue is not None:
+            with capture.lock:
+                capture.check_acks()
+                applied = len(capture.pending) == 0
+        else:
+            with lock:
+                applied = monitor.count_queue() == 0
+        if applied:
+            break
+        time.sleep(0.01)
+    end = time.time()
+
+    latencies.sort()
+    total_ops = sum(ops.values())
+
+    return {
+        'params': vars(args),
+        'events': len(events),
+        'rows': rows,
+        'applied': applied,
+        'capture': {
+            'seconds': captured - start,
+            'rows_per_second': rows / (captured - start),
+        },
+        'end_to_end': {
+            'seconds': end - start,
+            'rows_per_second': rows / (end - start),
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p99': percentile(latencies, 0.99),
+        },
+        'mongo_ops': total_ops,
+        'mongo_ops_per_row': total_ops / rows if rows > 0 else None,
+        'mongo_ops_by_method': dict(ops),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = json.dumps(run(args), indent=2, sort_keys=True)
+    if args.output is None:
+        sys.stdout.write(results + '\n')
+    else:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import asyncio
+import time
+
+from collections import OrderedDict, deque
+from pymongo.errors import BulkWriteError
+
+from .datamunging import DataMunging
+from .exceptions import SysException
+
+try:
+    from motor import motor_asyncio
+except ImportError:
+    motor_asyncio = None
+
+
+def check_engine(conf):
+    """Check the apply engine of the data munging configuration can start
+
+    Args:
+        conf (object): configparser section with the data munging parameters
+
+    Raises:
+        :class:`.SysException`: if the engine is unknown, or async and motor is not installed
+
+    """
+    engine = conf.get('engine', 'sync')
+    if engine not in ['sync', 'async']:
+        raise SysException('Unknown apply engine ' + engine + ', use sync or async')
+    if engine == 'async' and motor_asyncio is None:
+        raise SysException('The async apply engine requires motor, install it with pip install -r requirements.txt')
+
+
+class AsyncDataMunging(DataMunging):
+    """Apply engine keeping many bulk writes in flight with asyncio and motor
+
+    The records are read, parsed and translated in mongo operations like :class:`.DataMunging` does, then the
+    operations of every (schema, table) become a write task. The tasks of the same collection are chained, each
+    one starting when the previous one is done, so the changes to a row are applied in order, while the tasks of
+    different collections run concurrently. The next batch is read while the writes are in flight, from the last
+    sequence number read.
+
+    At most ``max_in_flight`` writes run at the same time and at most ``max_in_flight`` tasks wait to run, so
+    the reads stop when mongo does not keep up. When a write fails, the following tasks of its collection are
+    skipped and, once the tasks in flight are done, the queue is read again from its first record.
+
+    The progress reported to the maintenance jobs is the highest sequence number up to which all the records
+    read are applied, advanced while the writes complete.
+
+    Only the queue pipeline is supported: in direct pipeline the records are applied by
+    :meth:`.DataMunging.run_direct`.
+
+    Args:
+        mongo (object): :class:`.MyMongoDB` instance
+        replicator_queue (object): multiprocessing queue used by the replicator to notify new records
+        conf (object): configparser section with the data munging parameters
+        *args: the other :class:`.DataMunging` arguments
+        **kwargs: the other :class:`.DataMunging` arguments
+
+    Attributes:
+        max_in_flight (int): max number of bulk writes running at the same time
+
+    Raises:
+        :class:`.SysException`: if motor is not installed
+
+    """
+    def __init__(self, mongo, replicator_queue, conf, *args, **kwargs):
+        if motor_asyncio is None:
+            raise SysException('The async apply engine requires motor')
+
+        DataMunging.__init__(self, mongo, replicator_queue, conf, *args, **kwargs)
+        self.max_in_flight = conf.getint('max_in_flight', fallback=8)
+        self.client = None
+        self.loop = None
+        self.window = None
+        self.tasks = set()
+        self.chains = dict()
+        self.failed = False
+        self.unapplied = deque()
+        self.applied = set()
+        self.watermark = None
+
+    def run(self, module_instance=None):
+        if self.pipeline == 'direct':
+            self.logger.warning('Async apply engine not available in direct pipeline, using the sync one')
+            self.run_direct(module_instance)
+            return
+
+        try:
+            self.mongo.ensure_queue_index()
+        except Exception as e:
+            self.logger.error('Cannot create replicator queue index. Error: ' + str(e))
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.run_async(module_instance))
+
+    async def run_async(self, module_instance=None):
+        self.client = motor_asyncio.AsyncIOMotorClient(self.mongo.conn_string)
+        self.window = asyncio.Semaphore(self.max_in_flight)
+        queue_coll = self.client[self.mongo.utildb]['replicator_queue']
+        after = None
+        while True:
+            self.beat()
+            while len(self.tasks) >= self.max_in_flight:
+                await asyncio.wait(self.tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            if self.failed:
+                await self.drain()
+                self.failed = False
+                after = None
+                self.unapplied.clear()
+                self.applied.clear()
+                await asyncio.sleep(1)
+
+            query = self.mongo.partition_query(self.partition, {'$gt': after} if after is not None else None)
+            try:
+                start = time.time()
+                queue = await queue_coll.find(query).sort('seqnum', 1).to_list(self.batch_size)
+                self.metrics.observe('mymongo_mongo_seconds', time.time() - start, {'op': 'queue_read'})
+            except Exception as e:
+                self.logger.error('Cannot get entries from replicator queue. Error: ' + str(e))
+                await asyncio.sleep(1)
+                continue
+
+            if len(queue) < 1:
+                await self.drain()
+                if self.failed:
+                    continue
+                self.save_state(self.advance_watermark())
+                self.metrics.publish()
+                await self.loop.run_in_executor(None, self.wait_for_entries)
+                continue
+
+            after = queue[-1]['seqnum']
+            self.unapplied.extend((record['_id'], record['seqnum']) for record in queue)
+            docs = list()
+            for record in queue:
+                docs.append(self.parse_record(record, module_instance))
+
+            if self.coalesce:
+                docs, dropped = self.coalesce_events(docs)
+                self.applied.update(dropped)
+                if len(dropped) > 0:
+                    try:
+                        await queue_coll.delete_many({'_id': {'$in': dropped}})
+                    except Exception as e:
+                        self.logger.error('Cannot delete documents from queue Error: ' + str(e))
+
+            # a write failed while reading: the batch is read again with the failed records
+            if self.failed:
+                continue
+
+            groups = OrderedDict()
+            for doc in docs:
+                requests = self.make_requests(doc)
+                if requests is None:
+                    self.logger.error('Unknown event type ' + str(doc['event_type']) + ' for document ' +
+                                      str(doc['_id']))
+                    continue
+                groups.setdefault((doc['schema'], doc['table']), list()).append((doc, requests))
+
+            for key, group in groups.items():
+                task = self.loop.create_task(self.apply_group(key, group, self.chains.get(key), queue_coll))
+                self.chains[key] = task
+                self.tasks.add(task)
+                task.add_done_callback(self.task_done)
+
+            self.update_lag(docs)
+            self.save_state(self.advance_watermark())
+            self.metrics.publish()
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        for key, chained in list(self.chains.items()):
+            if chained is task:
+                del self.chains[key]
+
+    def advance_watermark(self):
+        """Move the watermark over the records read and applied, in sequence number order
+
+        Returns:
+            int: sequence number up to which all the records read are applied, None if none is applied yet
+
+        """
+        while len(self.unapplied) > 0 and self.unapplied[0][0] in self.applied:
+            queue_id, self.watermark = self.unapplied.popleft()
+            self.applied.discard(queue_id)
+
+        return self.watermark
+
+    async def drain(self):
+        """Wait for all the writes in flight
+
+        """
+        while len(self.tasks) > 0:
+            await asyncio.wait(self.tasks)
+
+    async def apply_group(self, key, group, previous, queue_coll):
+        """Apply the operations of a batch on a collection, after the previous batch on the same collection
+
+        Args:
+            key (tuple): schema and table
+            group (list): records and their mongo operations, sorted by seqnum
+            previous (Optional[object]): task applying the previous batch on the collection
+            queue_coll (object): motor collection of the replicator queue
+
+        Returns:
+            bool: True if all the records have been applied
+
+        """
+        if previous is not None and not await previous:
+            return False
+
+        schema, table = key
+        requests = list()
+        for doc, doc_requests in group:
+            requests.extend(doc_requests)
+
+        ok = True
+        async with self.window:
+            try:
+                if len(requests) > 0:
+                    start = time.time()
+                    await self.client[schema][table].bulk_write(requests, ordered=True)
+                    self.metrics.observe('mymongo_mongo_seconds', time.time() - start, {'op': 'bulk_write'})
+                    self.metrics.observe('mymongo_batch_size', len(requests), {'stage': 'apply'})
+                applied = len(requests)
+            except Exception as e:
+                ok = False
+                applied = self.bulk_applied(SysException(e)) if isinstance(e, BulkWriteError) else 0
+                self.logger.error('Cannot apply ' + str(len(requests) - applied) + ' operations into collection ' +
+                                  table + ' db ' + schema + ' Error: ' + str(e))
+
+            to_delete = list()
+            for doc, doc_requests in group:
+                applied -= len(doc_requests)
+                if applied < 0:
+                    break
+                to_delete.append(doc['_id'])
+                to_delete.extend(doc.get('coalesced', []))
+                if doc['seqnum'] > self.last_seqnum:
+                    self.last_seqnum = doc['seqnum']
+                self.applied_metrics(doc)
+            self.applied.update(to_delete)
+
+            if len(to_delete) > 0:
+                try:
+                    start = time.time()
+                    await queue_coll.delete_many({'_id': {'$in': to_delete}})
+                    self.metrics.observe('mymongo_mongo_seconds', time.time() - start, {'op': 'queue_delete'})
+                except Exception as e:
+                    self.logger.error('Cannot delete documents from queue Error: ' + str(e))
+
+        if not ok:
+            self.failed = True
+
+        return ok
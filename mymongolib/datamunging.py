@@ -1,133 +1,653 @@
 import logging
 import time
-import threading
+import queue as queue_mod
+
+from collections import OrderedDict
+from pymongo import InsertOne, ReplaceOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from .exceptions import SysException
+from .tracing import Tracer
+from .metrics import Metrics
 
 
 class DataMunging:
+    """Reads the mysql records from the replicator queue and writes them to mongo
+
+    Args:
+        mongo (object): :class:`.MyMongoDB` instance
+        replicator_queue (object): multiprocessing queue used by the replicator to notify new records
+        conf (object): configparser section with the data munging parameters
+        partition (Optional[int]): replicator queue partition applied by this worker. Default to None, all the
+            partitions
+        ack_queue (Optional[object]): multiprocessing queue where the batches applied are acknowledged to the
+            replicator in direct pipeline. Default to None
+        tracer (Optional[object]): :class:`.Tracer` of the applied records. Default to None, tracing enabled
+            only at runtime
+        metrics (Optional[object]): :class:`.Metrics` of the process. Default to None, metrics disabled
+        heartbeat (Optional[object]): multiprocessing.Value where the time of the last heartbeat is written for
+            the daemon supervisor. Default to None
+
+    Attributes:
+        apply_mode (str): ``bulk`` to apply each batch with one ordered bulk write per collection,
+            ``single`` to apply the records one by one
+        batch_size (int): number of records read from the replicator queue at each iteration
+        update_mode (str): ``replace`` to rewrite the whole document on update, ``delta`` to set only the
+            changed fields
+        coalesce (bool): collapse the events on the same row within a batch before applying them
+        pipeline (str): ``queue`` to read the records from the replicator queue in mongo, ``direct`` to receive
+            them from the replicator through ``replicator_queue``
+        idle_timeout (float): max seconds to wait for a replicator notification when the queue is empty
+        state_interval (float): min seconds between two writes of the applied sequence number and heartbeat
+        lag (float): seconds between the last binlog event applied and its application to mongo
+
+    """
     mongo = None
 
-    def __init__(self, mongo, replicator_queue):
+    def __init__(self, mongo, replicator_queue, conf, partition=None, ack_queue=None, tracer=None, metrics=None,
+                 heartbeat=None):
         self.mongo = mongo
         self.logger = logging.getLogger(__name__)
         self.replicator_queue = replicator_queue
-        self.lock = threading.Lock()
+        self.partition = partition
+        self.ack_queue = ack_queue
+        self.tracer = tracer if tracer is not None else Tracer(mongo=mongo, name=__name__)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.heartbeat = heartbeat
         self.last_seqnum = 0
         self.run_parser = False
+        self.apply_mode = conf.get('apply_mode', 'bulk')
+        self.batch_size = conf.getint('batch_size', fallback=100)
+        self.update_mode = conf.get('update_mode', 'replace')
+        self.coalesce = conf.getboolean('coalesce', fallback=False)
+        self.pipeline = conf.get('pipeline', 'queue')
+        self.idle_timeout = conf.getfloat('idle_timeout', fallback=60)
+        self.lag = 0.0
+        self.lag_log_interval = conf.getfloat('lag_log_interval', fallback=60)
+        self.lag_logged = 0.0
+        self.state_interval = conf.getfloat('state_interval', fallback=10)
+        self.state_saved = 0.0
+        self.applied_seqnum = None
+        self.progressed = time.time()
 
     def run(self, module_instance=None):
+        if self.pipeline == 'direct':
+            self.run_direct(module_instance)
+            return
 
-        queue_thread = threading.Thread(target=self.check_queue)
-        queue_thread.daemon = True
-        queue_thread.start()
+        try:
+            self.mongo.ensure_queue_index()
+        except Exception as e:
+            self.logger.error('Cannot create replicator queue index. Error: ' + str(e))
 
         while True:
+            self.beat()
             try:
-                queue = self.mongo.get_from_queue(100)
+                with self.metrics.timer('mymongo_mongo_seconds', {'op': 'queue_read'}):
+                    queue = list(self.mongo.get_from_queue(self.batch_size, self.partition))
             except Exception as e:
                 self.logger.error('Cannot get entries from replicator queue. Error: ' + str(e))
+                time.sleep(1)
+                continue
 
-            if queue.count() < 1:
+            if len(queue) < 1:
                 self.logger.debug('No entries in replicator queue')
-                time.sleep(1)
+                # nothing left to apply, the worker is up to date
+                self.progressed = time.time()
+                self.wait_for_entries()
+                self.save_state()
                 continue
-                # if not self.run_parser:
-                #    self.logger.debug('No messages from replicator queue')
-                #    continue
 
-            to_delete = list()
+            # the watermark is computed on the positions read, before the records are parsed and coalesced
+            read = [(record['_id'], record['seqnum']) for record in queue]
+            docs = list()
             for record in queue:
-                if module_instance is not None:
-                    try:
-                        doc = module_instance.run(record, self.mongo)
-                    except Exception as e:
-                        self.logger.error('Error during parse data with module. Error: ' + str(e))
-                        doc = record
+                docs.append(self.parse_record(record, module_instance))
 
-                key = None
-                self.logger.debug('Event: ' + doc['event_type'])
-                if doc['event_type'] in ['update', 'delete']:
-                    self.logger.debug('Event: ' + doc['event_type'])
+            dropped = list()
+            if self.coalesce:
+                docs, dropped = self.coalesce_events(docs)
+                if len(dropped) > 0:
                     try:
-                        key = self.mongo.get_primary_key(doc['table'], doc['schema'])
-                        self.logger.debug(key)
+                        self.mongo.delete_many_from_queue(dropped)
                     except Exception as e:
-                        self.logger.error('Cannot get primary key for table ' + doc['table'] +
-                                          ' in schema ' + doc['schema'] + '. Error: ' + str(e))
+                        self.logger.error('Cannot delete documents from queue Error: ' + str(e))
 
-                if doc['event_type'] == 'insert':
-                    try:
-                        self.mongo.insert(doc['values'], doc['schema'], doc['table'])
-                        to_delete.append(str(doc['_id']))
-                        self.last_seqnum = doc['seqnum']
-                    except Exception as e:
-                        self.logger.error('Cannot insert document into collection ' + doc['table'] +
-                                          ' db ' + doc['schema'] + ' Error: ' + str(e))
-                elif doc['event_type'] == 'update':
-                    if key is None:
-                        primary_key = doc['values']['before']
-                    else:
-                        primary_key = dict()
-                        for k in key['primary_key']:
-                            primary_key[k] = str(doc['values']['after'][k])
-                    try:
-                        self.mongo.update(doc['values']['after'], doc['schema'], doc['table'], primary_key)
-                        to_delete.append(doc['_id'])
-                        self.last_seqnum = doc['seqnum']
-                    except Exception as e:
-                        self.logger.error('Cannot update document ' + str(doc['_id']) +
-                                          ' into collection ' + doc['table'] +
-                                          ' db ' + doc['schema'] + ' Error: ' + str(e))
-                elif doc['event_type'] == 'delete':
-                    if key is not None:
-                        primary_key = dict()
-                        for k in key['primary_key']:
-                            primary_key[k] = str(doc['values'][k])
-                    else:
-                        primary_key = None
+            if self.apply_mode == 'bulk':
+                applied = set(self.apply_bulk(docs))
+            else:
+                applied = set(self.apply_single(docs))
+            applied.update(dropped)
 
-                    try:
-                        self.mongo.delete(doc=doc['values'], schema=doc['schema'], collection=doc['table'],
-                                          primary_key=primary_key)
-                        to_delete.append(doc['_id'])
-                        self.last_seqnum = doc['seqnum']
-                    except Exception as e:
-                        self.logger.error('Cannot delete document ' + str(doc['_id']) +
-                                            ' into collection ' + doc['table'] +
-                                            ' db ' + doc['schema'] + ' Error: ' + str(e))
+            self.update_lag(docs)
+            self.save_state(self.applied_watermark(read, applied))
+            self.metrics.publish()
 
-            self.logger.debug('Delete records: ' + str(to_delete))
-            for queue_id in to_delete:
-                try:
-                    self.mongo.delete_from_queue({'_id': queue_id})
-                except Exception as e:
-                    self.logger.error('Cannot delete document from queue Error: ' + str(e))
+            if len(queue) < self.batch_size:
+                self.wait_for_entries()
 
-            time.sleep(5)
+    def run_direct(self, module_instance=None):
+        """Apply the batches sent by the replicator in direct pipeline
 
-    def check_queue(self):
-        self.logger.info('Start QueueMonitor')
+        A batch is retried until it is completely applied, then it is acknowledged to the replicator, which
+        checkpoints the binlog position only after that.
 
+        Args:
+            module_instance (Optional[object]): parse data module instance. Default to None
+
+        """
         while True:
-            if not self.replicator_queue.empty():
-                try:
-                    self.logger.debug('Try to read from replicator queue')
-                    msg_queue = self.replicator_queue.get()
-                    self.logger.debug('Read from replicator queue')
-                    self.manage_replicator_msg(msg_queue)
-                    self.logger.debug('Replicator message managed')
-                except Exception as e:
-                    self.logger.error('Cannot read and manage replicator message. Error: ' + str(e))
-
-            time.sleep(.1)
+            self.beat()
+            try:
+                msg = self.replicator_queue.get(timeout=self.idle_timeout)
+            except queue_mod.Empty:
+                self.save_state()
+                continue
 
-    def manage_replicator_msg(self, msg):
-        with self.lock:
-            self.logger.debug('Message from queue')
-            self.logger.debug(msg)
-            self.logger.debug('Last seqnum: ' + str(self.last_seqnum))
-            if msg['seqnum'] > self.last_seqnum:
-                self.logger.debug('new entries in queue')
-                self.run_parser = True
+            docs = list()
+            for record in msg['events']:
+                docs.append(self.parse_record(record, module_instance))
+
+            if self.coalesce:
+                docs, dropped = self.coalesce_events(docs)
+
+            self.update_lag(docs)
+            while len(docs) > 0:
+                if self.apply_mode == 'bulk':
+                    applied = set(self.apply_bulk(docs))
+                else:
+                    applied = set(self.apply_single(docs))
+                docs = [doc for doc in docs if doc['_id'] not in applied]
+                if len(docs) > 0:
+                    self.logger.error('Retrying ' + str(len(docs)) + ' records not applied')
+                    time.sleep(1)
+                    self.beat()
+
+            self.ack_queue.put({'partition': self.partition, 'seqnum': msg['seqnum'],
+                                'generation': msg.get('generation')})
+            self.save_state(msg['seqnum'])
+            self.metrics.publish()
+
+    def beat(self):
+        """Write the heartbeat read by the daemon supervisor
+
+        """
+        if self.heartbeat is not None:
+            self.heartbeat.value = time.time()
+
+    @staticmethod
+    def applied_watermark(records, applied):
+        """Highest sequence number up to which all the records of a batch are applied
+
+        Args:
+            records (list): (id, seqnum) of the records read from the replicator queue, sorted by seqnum
+            applied (set): ids of the records applied
+
+        Returns:
+            int: sequence number, or None if the first record is not applied
+
+        """
+        watermark = None
+        for queue_id, seqnum in records:
+            if queue_id not in applied:
+                break
+            watermark = seqnum
+
+        return watermark
+
+    def save_state(self, seqnum=None):
+        """Report the progress of the worker to the maintenance jobs
+
+        The sequence number, the time it last advanced and a heartbeat are written at most every
+        ``state_interval`` seconds.
+
+        Args:
+            seqnum (Optional[int]): all the records of the partition up to this sequence number are applied.
+                Default to None, no new records applied
+
+        """
+        now = time.time()
+        if seqnum is not None and seqnum != self.applied_seqnum:
+            self.applied_seqnum = seqnum
+            self.progressed = now
+
+        if self.partition is None or now - self.state_saved < self.state_interval:
+            return
+
+        try:
+            self.mongo.write_apply_state(self.partition, self.applied_seqnum, self.progressed)
+        except Exception as e:
+            self.logger.error('Cannot write apply state. Error: ' + str(e))
+        self.state_saved = now
+
+    def wait_for_entries(self):
+        """Block until the replicator notifies new entries in the replicator queue
+
+        All the pending notifications are consumed. The wait ends anyway after ``idle_timeout`` seconds, so
+        entries written while the process was not listening are not left behind.
+
+        Returns:
+            bool: True if the replicator notified entries not applied yet
+
+        """
+        self.run_parser = False
+        try:
+            msg = self.replicator_queue.get(timeout=self.idle_timeout)
+        except queue_mod.Empty:
+            return False
+
+        while True:
+            try:
+                self.manage_replicator_msg(msg)
+            except Exception as e:
+                self.logger.error('Cannot manage replicator message. Error: ' + str(e))
+
+            try:
+                msg = self.replicator_queue.get_nowait()
+            except queue_mod.Empty:
+                break
+
+        return self.run_parser
+
+    def update_lag(self, docs):
+        """Update the replication lag and the primary key cache metrics with the last records applied
+
+        The lag is the time between the binlog event and its application to mongo.
+
+        Args:
+            docs (list): records applied
+
+        """
+        self.metrics.set('mymongo_pk_cache_hits_total', self.mongo.pk_cache_hits)
+        self.metrics.set('mymongo_pk_cache_misses_total', self.mongo.pk_cache_misses)
+        timestamps = [doc['timestamp'] for doc in docs if doc.get('timestamp') is not None]
+        if len(timestamps) < 1:
+            return
+
+        now = time.time()
+        self.lag = now - max(timestamps)
+        self.metrics.set('mymongo_replication_lag_seconds', self.lag, {'partition': self.partition})
+        if now - self.lag_logged >= self.lag_log_interval:
+            self.logger.info('Replication lag: {0:.1f}s, primary key cache hits: {1} misses: {2}'.format(
+                self.lag, self.mongo.pk_cache_hits, self.mongo.pk_cache_misses))
+            self.lag_logged = now
+
+    def parse_record(self, record, module_instance=None):
+        """Run the parse data module on a record read from the replicator queue
+
+        Args:
+            record (dict): record read from the replicator queue
+            module_instance (Optional[object]): parse data module instance. Default to None
+
+        Returns:
+            dict: the parsed record, or the original one if the module fails
+
+        """
+        if module_instance is None:
+            return record
+
+        try:
+            return module_instance.run(record, self.mongo)
+        except Exception as e:
+            self.logger.error('Error during parse data with module. Error: ' + str(e))
+            return record
+
+    def get_key(self, doc):
+        """Gets the primary key columns of the table of a record
+
+        Args:
+            doc (dict): record read from the replicator queue
+
+        Returns:
+            list: primary key columns, None if the table has no primary key or it is unknown
+
+        """
+        key = None
+        try:
+            key = self.mongo.get_primary_key(doc['table'], doc['schema'])
+        except Exception as e:
+            self.logger.error('Cannot get primary key for table ' + doc['table'] +
+                              ' in schema ' + doc['schema'] + '. Error: ' + str(e))
+
+        if key is None or len(key['primary_key']) == 0:
+            return None
+
+        return key['primary_key']
+
+    def get_filter(self, values, key):
+        """Build the filter used to find the mongo document of a row
+
+        The filter is made of the primary key fields of the row, or of the ``_id`` derived from them when the
+        primary key is used as mongo id. If the primary key is unknown the whole row is used.
+
+        Args:
+            values (dict): row values
+            key (list): primary key columns, None if unknown
+
+        Returns:
+            dict: mongo filter
+
+        """
+        if key is None:
+            return values
+
+        if self.mongo.id_mode == 'primary_key':
+            return {'_id': self.mongo.make_id(values, key)}
+
+        primary_key = dict()
+        for k in key:
+            primary_key[k] = values[k]
+
+        return primary_key
+
+    def make_requests(self, doc):
+        """Translate a record of the replicator queue in pymongo write operations
+
+        When the primary key is used as mongo id, inserts and updates are upserts on ``_id``, and an update
+        changing the primary key becomes a delete of the old document and an upsert of the new one. With mongo
+        generated ids, the insert of a row with a primary key is an upsert on the primary key fields, so replaying
+        it after a restart does not fail on the unique index. Only rows without primary key are plain inserts.
+
+        With ``update_mode`` ``delta`` an update sets only the fields changed between the before and after images
+        of the row; the other fields are set only if the document is missing, so the whole after image is written.
+
+        Args:
+            doc (dict): record read from the replicator queue
+
+        Returns:
+            list: pymongo InsertOne, ReplaceOne or DeleteOne operations, None if the event type is unknown
+
+        """
+        key = self.get_key(doc)
+        use_id = key is not None and self.mongo.id_mode == 'primary_key'
+
+        if doc['event_type'] == 'insert':
+            values = doc['values']
+            if use_id:
+                values['_id'] = self.mongo.make_id(values, key)
+                return [ReplaceOne({'_id': values['_id']}, values, upsert=True)]
+            if key is not None:
+                return [ReplaceOne(self.get_filter(values, key), values, upsert=True)]
+            return [InsertOne(values)]
+        elif doc['event_type'] == 'update':
+            after = doc['values']['after']
+            primary_key = self.get_filter(doc['values']['before'], key)
+            if use_id:
+                after['_id'] = self.mongo.make_id(after, key)
+                if primary_key['_id'] != after['_id']:
+                    return [DeleteOne(primary_key), ReplaceOne({'_id': after['_id']}, after, upsert=True)]
+                if self.update_mode == 'delta':
+                    delta = self.make_delta(primary_key, doc['values']['before'], after)
+                    return [delta] if delta is not None else []
+                return [ReplaceOne(primary_key, after, upsert=True)]
+            if self.update_mode == 'delta':
+                delta = self.make_delta(primary_key, doc['values']['before'], after)
+                return [delta] if delta is not None else []
+            return [ReplaceOne(primary_key, after)]
+        elif doc['event_type'] == 'delete':
+            return [DeleteOne(self.get_filter(doc['values'], key))]
+
+        return None
+
+    @staticmethod
+    def make_delta(primary_key, before, after):
+        """Build an update setting only the fields changed by a row update
+
+        The unchanged fields go in $setOnInsert, so if the document is missing the upsert writes the whole after
+        image, like a replace.
+
+        Args:
+            primary_key (dict): mongo filter of the document
+            before (dict): row values before the update
+            after (dict): row values after the update
+
+        Returns:
+            object: pymongo UpdateOne operation, None if there is nothing to write
+
+        """
+        changed = dict()
+        unchanged = dict()
+        for k, v in after.items():
+            if k == '_id':
+                continue
+            if k in before and before[k] == v:
+                # fields of the filter are already written by the upsert
+                if k not in primary_key:
+                    unchanged[k] = v
+            else:
+                changed[k] = v
+
+        update = dict()
+        if len(changed) > 0:
+            update['$set'] = changed
+        if len(unchanged) > 0:
+            update['$setOnInsert'] = unchanged
+        removed = [k for k in before if k not in after]
+        if len(removed) > 0:
+            update['$unset'] = dict((k, '') for k in removed)
+        if len(update) == 0:
+            return None
+
+        return UpdateOne(primary_key, update, upsert=True)
+
+    def coalesce_events(self, docs):
+        """Collapse the consecutive events on the same row of a batch
+
+        An insert followed by updates becomes an insert of the last image, consecutive updates become one
+        update from the first before image to the last after image, an update followed by a delete becomes a
+        delete and an insert followed by a delete disappears. The collapsed event keeps the position of the
+        first event of the row, so the changes to different rows keep their order. An update changing the primary
+        key is not collapsed in the events before it, so it is not moved before the events on its new key. Rows
+        of tables without primary key are not collapsed.
+
+        The queue ids of the events merged in another one are kept in its ``coalesced`` list. The records are not
+        modified: a collapsed event is a copy of the first record of the row.
+
+        Args:
+            docs (list): records read from the replicator queue, sorted by seqnum
+
+        Returns:
+            tuple: records to apply and queue ids of the records cancelled out
+
+        """
+        events = list()
+        rows = dict()
+        dropped = list()
+        for doc in docs:
+            key = self.get_key(doc)
+            if key is None or doc['event_type'] not in ['insert', 'update', 'delete']:
+                events.append(doc)
+                continue
+
+            if doc['event_type'] == 'update':
+                row = self.row_id(doc, doc['values']['before'], key)
+                new_row = self.row_id(doc, doc['values']['after'], key)
+            else:
+                row = self.row_id(doc, doc['values'], key)
+                new_row = row
+
+            i = rows.pop(row, None)
+            prev = events[i] if i is not None else None
+            if prev is None or doc['event_type'] == 'insert' or new_row != row:
+                events.append(doc)
+                if doc['event_type'] != 'delete':
+                    rows[new_row] = len(events) - 1
+                continue
+
+            if 'coalesced' not in prev:
+                prev = events[i] = dict(prev, coalesced=list())
+            prev['coalesced'].append(doc['_id'])
+            prev['seqnum'] = doc['seqnum']
+            if doc.get('timestamp') is not None:
+                prev['timestamp'] = doc['timestamp']
+
+            if doc['event_type'] == 'update':
+                if prev['event_type'] == 'insert':
+                    prev['values'] = doc['values']['after']
+                else:
+                    prev['values'] = {'before': prev['values']['before'], 'after': doc['values']['after']}
+                rows[new_row] = i
+            elif prev['event_type'] == 'insert':
+                dropped.append(prev['_id'])
+                dropped.extend(prev['coalesced'])
+                events[i] = None
             else:
-                self.logger.debug('NO new entries in queue')
-                self.run_parser = False
+                prev['values'] = prev['values']['before']
+                prev['event_type'] = 'delete'
+
+        events = [doc for doc in events if doc is not None]
+        self.logger.debug('Coalesced %d events in %d', len(docs), len(events))
+
+        return events, dropped
+
+    @staticmethod
+    def row_id(doc, values, key):
+        return repr((doc['schema'], doc['table'], [values.get(k) for k in key]))
+
+    def apply_bulk(self, docs):
+        """Apply a batch of records with one ordered bulk write per collection
+
+        The records are grouped by schema and table keeping their queue order, so the changes to the same row
+        are applied in sequence. The records applied are removed from the replicator queue with a single delete,
+        when reading from it.
+
+        Args:
+            docs (list): records read from the replicator queue, sorted by seqnum
+
+        Returns:
+            list: ids of the records applied
+
+        """
+        groups = OrderedDict()
+        for doc in docs:
+            requests = self.make_requests(doc)
+            if requests is None:
+                self.logger.error('Unknown event type ' + str(doc['event_type']) + ' for document ' + str(doc['_id']))
+                continue
+            groups.setdefault((doc['schema'], doc['table']), list()).append((doc, requests))
+
+        to_delete = list()
+        for (schema, table), group in groups.items():
+            traced = self.tracer.active(schema, table)
+            requests = list()
+            for doc, doc_requests in group:
+                requests.extend(doc_requests)
+                if traced:
+                    self.tracer.trace(schema, table, '%s %s seqnum %s: %s', doc['event_type'], doc['_id'],
+                                      doc['seqnum'], doc_requests)
+
+            try:
+                if len(requests) > 0:
+                    with self.metrics.timer('mymongo_mongo_seconds', {'op': 'bulk_write'}):
+                        self.mongo.bulk_write(requests, schema, table)
+                    self.metrics.observe('mymongo_batch_size', len(requests), {'stage': 'apply'})
+                applied = len(requests)
+            except SysException as e:
+                applied = self.bulk_applied(e)
+                self.logger.error('Cannot apply ' + str(len(requests) - applied) + ' operations into collection ' +
+                                  table + ' db ' + schema + ' Error: ' + str(e))
+
+            for doc, doc_requests in group:
+                applied -= len(doc_requests)
+                if applied < 0:
+                    break
+                to_delete.append(doc['_id'])
+                to_delete.extend(doc.get('coalesced', []))
+                if doc['seqnum'] > self.last_seqnum:
+                    self.last_seqnum = doc['seqnum']
+                self.applied_metrics(doc)
+
+        self.logger.debug('Delete records: %s', to_delete)
+        if len(to_delete) > 0 and self.pipeline == 'queue':
+            try:
+                with self.metrics.timer('mymongo_mongo_seconds', {'op': 'queue_delete'}):
+                    self.mongo.delete_many_from_queue(to_delete)
+            except Exception as e:
+                self.logger.error('Cannot delete documents from queue Error: ' + str(e))
+
+        return to_delete
+
+    def applied_metrics(self, doc):
+        """Count a record applied in the metrics
+
+        Args:
+            doc (dict): record applied
+
+        """
+        if not self.metrics.enabled:
+            return
+
+        self.metrics.inc('mymongo_events_applied_total', {'schema': doc['schema'], 'table': doc['table']},
+                         1 + len(doc.get('coalesced', [])))
+        if doc.get('timestamp') is not None:
+            self.metrics.observe('mymongo_apply_latency_seconds', time.time() - doc['timestamp'])
+
+    @staticmethod
+    def bulk_applied(error):
+        """Number of operations applied by an ordered bulk write before it failed
+
+        Args:
+            error (object): :class:`.SysException` raised by :meth:`.MyMongoDB.bulk_write`
+
+        Returns:
+            int: number of operations applied
+
+        """
+        if len(error.args) > 0 and isinstance(error.args[0], BulkWriteError):
+            write_errors = error.args[0].details.get('writeErrors', [])
+            if len(write_errors) > 0:
+                return write_errors[0]['index']
+
+        return 0
+
+    def apply_single(self, docs):
+        """Apply a batch of records one by one
+
+        Every record is written and removed from the replicator queue with its own round trips.
+
+        Args:
+            docs (list): records read from the replicator queue, sorted by seqnum
+
+        Returns:
+            list: ids of the records applied
+
+        """
+        to_delete = list()
+        for doc in docs:
+            requests = self.make_requests(doc)
+            if requests is None:
+                self.logger.error('Unknown event type ' + str(doc['event_type']) + ' for document ' + str(doc['_id']))
+                continue
+            self.tracer.trace(doc['schema'], doc['table'], '%s %s seqnum %s: %s', doc['event_type'], doc['_id'],
+                              doc['seqnum'], requests)
+
+            try:
+                if len(requests) > 0:
+                    with self.metrics.timer('mymongo_mongo_seconds', {'op': 'bulk_write'}):
+                        self.mongo.bulk_write(requests, doc['schema'], doc['table'])
+                    self.metrics.observe('mymongo_batch_size', len(requests), {'stage': 'apply'})
+                to_delete.append(doc['_id'])
+                to_delete.extend(doc.get('coalesced', []))
+                self.last_seqnum = doc['seqnum']
+                self.applied_metrics(doc)
+            except Exception as e:
+                self.logger.error('Cannot ' + doc['event_type'] + ' document ' + str(doc['_id']) +
+                                  ' into collection ' + doc['table'] +
+                                  ' db ' + doc['schema'] + ' Error: ' + str(e))
+
+        self.logger.debug('Delete records: %s', to_delete)
+        if self.pipeline != 'queue':
+            return to_delete
+
+        for queue_id in to_delete:
+            try:
+                self.mongo.delete_from_queue({'_id': queue_id})
+            except Exception as e:
+                self.logger.error('Cannot delete document from queue Error: ' + str(e))
+
+        return to_delete
+
+    def manage_replicator_msg(self, msg):
+        self.logger.debug('Message from queue: %s, last seqnum: %s', msg, self.last_seqnum)
+        if msg['seqnum'] > self.last_seqnum:
+            self.run_parser = True
@@ -0,0 +1,348 @@
+import logging
+import queue
+import re
+import threading
+import time
+
+from lxml import etree
+from .exceptions import SysException
+from .mysql import CaptureFilter
+from .typeconv import TypeConverter
+
+XSI_NIL = '{http://www.w3.org/2001/XMLSchema-instance}nil'
+# parser errors of a dump cut before its end, recovered by closing the open elements
+TRUNCATED = ('ERR_TAG_NOT_FINISHED', 'ERR_TAG_NAME_MISMATCH')
+
+
+class DumpImporter:
+    """Imports a mysqldump xml file into mongo
+
+    The dump is streamed with lxml iterparse, clearing every element once read, so memory does not grow with the
+    dump size and the dump can be read straight from the mysqldump pipe. The table structures are imported
+    while parsing. The rows of each table are grouped in batches and put in a bounded queue, while writer threads
+    insert them with unordered insert_many, overlapping parsing and writing. Before writing, the values are
+    converted to the BSON types of their mysql column types and, when the mongo ids are derived from the
+    primary key, get their ``_id``.
+
+    The mysql keys of each table become mongo indexes: a unique index on the primary key and plain indexes for
+    the secondary keys. With ``index_mode`` ``before`` they are built on the empty collection before loading
+    its rows, with ``after`` once all the rows have been written.
+
+    The tables and columns excluded from the binlog capture by ``capture_filter`` are left out of the import too,
+    so the collections hold the same documents the replicator keeps up to date.
+
+    Args:
+        mongodb (object): :class:`.MyMongoDB` instance
+        schema (Optional[bool]): import the table structures. Default to False
+        data (Optional[bool]): import the rows. Default to True
+        drop_db (Optional[bool]): drop the mongo database before importing the rows. Default to True
+        index_mode (Optional[str]): ``before`` or ``after`` the rows are loaded. Default to ``before``
+        batch_size (Optional[int]): rows per insert_many. Default to 1000
+        writers (Optional[int]): number of writer threads. Default to 2
+        queue_size (Optional[int]): max number of batches waiting to be written. Default to 8
+        capture_filter (Optional[object]): :class:`.CaptureFilter` of the imported tables and columns. Default to
+            None, import all
+
+    Attributes:
+        stats (dict): rows written, start of the first write and end of the last one by (database, table)
+
+    """
+    master_log = re.compile(r'.*CHANGE MASTER.*', re.IGNORECASE | re.DOTALL)
+
+    def __init__(self, mongodb, schema=False, data=True, drop_db=True, index_mode='before', batch_size=1000,
+                 writers=2, queue_size=8, capture_filter=None):
+        self.logger = logging.getLogger(__name__)
+        self.mongodb = mongodb
+        self.schema = schema
+        self.data = data
+        self.drop_db = drop_db
+        self.index_mode = index_mode
+        self.batch_size = batch_size
+        self.writers = writers
+        self.batches = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.stats = dict()
+        self.structures = dict()
+        self.error = None
+        self.capture_filter = capture_filter if capture_filter is not None else CaptureFilter()
+
+    def run(self, dump_file, verify=None):
+        """Import the dump
+
+        The binlog position is saved only if the whole dump has been read: a truncated dump is an error, even
+        if the xml parser recovers from it.
+
+        Args:
+            dump_file: path or file object of the mysqldump xml output
+            verify (Optional[callable]): called once the dump has been read, before the indexes are built and the
+                binlog position is saved, raising :class:`.SysException` if the dump failed. Default to None
+
+        Returns:
+            list: names of the databases imported
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        threads = list()
+        for i in range(self.writers):
+            writer = threading.Thread(target=self.write_batches)
+            writer.daemon = True
+            writer.start()
+            threads.append(writer)
+
+        try:
+            dbs, log_file, log_pos, complete = self.parse(dump_file)
+        finally:
+            for writer in threads:
+                self.batches.put(None)
+            for writer in threads:
+                writer.join()
+
+        if self.error is not None:
+            raise SysException(self.error)
+
+        if verify is not None:
+            verify()
+        if not complete:
+            raise SysException('Dump truncated, the import is not complete')
+
+        self.report()
+
+        if self.data and self.index_mode == 'after':
+            for db, table in self.stats:
+                self.create_indexes(db, table)
+
+        if self.data and log_file is not None and log_pos is not None:
+            try:
+                self.mongodb.write_log_pos(log_file, log_pos)
+            except Exception as e:
+                raise SysException(e)
+
+        return dbs
+
+    def parse(self, dump_file):
+        """Stream the dump and queue the rows in batches
+
+        Args:
+            dump_file: path or file object of the mysqldump xml output
+
+        Returns:
+            tuple: databases found, binlog file and position written by --master-data, True if the end of the
+            dump has been read
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        dbs = list()
+        db = ''
+        table = ''
+        log_file = None
+        log_pos = None
+        batch = list()
+        converter = None
+        key = []
+        allowed = True
+        excluded = None
+
+        context = etree.iterparse(dump_file, events=('start', 'end', 'comment'), recover=True, huge_tree=True)
+        for event, elem in context:
+            if self.error is not None:
+                break
+
+            if event == 'comment':
+                if elem.text is not None and self.master_log.match(elem.text):
+                    log_file = re.findall("MASTER_LOG_FILE='(.*?)'", elem.text, re.DOTALL)[0]
+                    log_pos = re.findall("MASTER_LOG_POS=(.*?);", elem.text, re.DOTALL)[0]
+                continue
+
+            if event == 'start':
+                if elem.tag == 'database':
+                    db = elem.get('name')
+                    dbs.append(db)
+                    if self.data and self.drop_db:
+                        try:
+                            self.mongodb.drop_db(db)
+                        except Exception as e:
+                            raise SysException(e)
+                elif elem.tag == 'table_data' and self.data:
+                    table = elem.get('name')
+                    allowed = self.capture_filter.table_allowed(db, table)
+                    excluded = None
+                    if not allowed:
+                        continue
+                    converter = TypeConverter(self.get_structure(db, table).get('columns', []))
+                    key = self.get_structure(db, table).get('primary_key', [])
+                    if self.index_mode == 'before':
+                        self.create_indexes(db, table)
+                continue
+
+            if elem.tag == 'table_structure':
+                if self.schema and self.capture_filter.table_allowed(db, elem.get('name')):
+                    self.import_structure(elem, db)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif elem.tag == 'row' and self.data and not allowed:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif elem.tag == 'row' and self.data:
+                doc = dict()
+                for child in elem:
+                    if child.tag == 'field':
+                        if child.get(XSI_NIL) == 'true':
+                            doc[child.get('name')] = None
+                        else:
+                            doc[child.get('name')] = child.text if child.text is not None else ''
+                if excluded is None:
+                    excluded = self.capture_filter.excluded_columns(db, table, doc.keys(), key)
+                for column in excluded:
+                    doc.pop(column, None)
+                batch.append(doc)
+                if len(batch) >= self.batch_size:
+                    self.batches.put((db, table, converter, key, batch))
+                    batch = list()
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif elem.tag == 'table_data' and self.data:
+                if len(batch) > 0:
+                    self.batches.put((db, table, converter, key, batch))
+                    batch = list()
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+        complete = not any(error.type_name in TRUNCATED for error in context.error_log)
+
+        return dbs, log_file, log_pos, complete
+
+    def get_structure(self, db, table):
+        """Gets the structure of a table: primary key, column types and indexes
+
+        The structure comes from the table structure imported in this run or, for data only dumps, from a
+        previous schema import.
+
+        Args:
+            db (str): database name
+            table (str): table name
+
+        Returns:
+            dict: document of utildb.primary_keys, empty if not found
+
+        """
+        doc = self.structures.get((db, table))
+        if doc is None:
+            try:
+                doc = self.mongodb.get_primary_key(table, db)
+            except Exception as e:
+                self.logger.error('Cannot get structure of table ' + db + '.' + table + ' Error: ' + str(e))
+            if doc is None or 'columns' not in doc:
+                self.logger.warning('No structure for table ' + db + '.' + table + ', values kept as text')
+                doc = dict()
+            self.structures[(db, table)] = doc
+
+        return doc
+
+    def create_indexes(self, db, table):
+        """Create the mongo indexes of a table from its mysql keys
+
+        A failed index is logged and skipped, the import goes on.
+
+        Args:
+            db (str): database name
+            table (str): table name
+
+        """
+        for index in self.get_structure(db, table).get('indexes', []):
+            try:
+                self.mongodb.create_index(index['keys'], db, table, name=index['name'], unique=index['unique'])
+            except Exception as e:
+                self.logger.error('Cannot create index ' + index['name'] + ' on collection ' + table + ' db ' + db +
+                                  ' Error: ' + str(e))
+
+    def import_structure(self, elem, db):
+        """Import the primary key, the column types and the keys of a table
+
+        Only the primary key becomes a unique index: mysql unique keys allow many NULLs, a mongo unique index
+        does not.
+
+        Args:
+            elem (object): lxml table_structure element
+            db (str): database name
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        table = elem.get('name')
+        doc = dict()
+        doc['_id'] = db + '.' + table
+        doc['primary_key'] = []
+        doc['columns'] = []
+        doc['indexes'] = []
+        doc['table'] = table
+        doc['db'] = db
+        keys = dict()
+        for child in elem:
+            if child.tag == 'field':
+                if child.get('Key') == 'PRI':
+                    doc['primary_key'].append(child.get('Field'))
+                doc['columns'].append([child.get('Field'), child.get('Type')])
+            elif child.tag == 'key':
+                name = child.get('Key_name')
+                if name not in keys:
+                    keys[name] = {'name': name, 'keys': [], 'unique': name == 'PRIMARY'}
+                    doc['indexes'].append(keys[name])
+                keys[name]['keys'].append([int(child.get('Seq_in_index')), child.get('Column_name')])
+
+        for index in doc['indexes']:
+            index['keys'] = [column for seq, column in sorted(index['keys'])]
+
+        self.structures[(db, table)] = doc
+
+        try:
+            self.mongodb.insert_primary_key(doc)
+        except Exception as e:
+            raise SysException(e)
+
+        if not self.data:
+            self.create_indexes(db, table)
+
+    def write_batches(self):
+        while True:
+            item = self.batches.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+
+            db, table, converter, key, docs = item
+            start = time.time()
+            try:
+                converter.convert_rows(docs)
+                if self.mongodb.id_mode == 'primary_key' and len(key) > 0:
+                    for doc in docs:
+                        doc['_id'] = self.mongodb.make_id(doc, key)
+                self.mongodb.insert_many(docs, db, table, ordered=False)
+            except Exception as e:
+                self.logger.error('Cannot insert rows into collection ' + table + ' db ' + db + ' Error: ' + str(e))
+                self.error = e
+                continue
+
+            now = time.time()
+            with self.lock:
+                stats = self.stats.setdefault((db, table), [0, start, now])
+                stats[0] += len(docs)
+                stats[2] = now
+
+    def report(self):
+        """Log the rows imported and the rows per second of every table
+
+        """
+        for (db, table), (rows, first, last) in sorted(self.stats.items()):
+            elapsed = last - first
+            rate = rows / elapsed if elapsed > 0 else float(rows)
+            self.logger.info('Imported {0} rows in {1}.{2} ({3:.0f} rows/s)'.format(rows, db, table, rate))
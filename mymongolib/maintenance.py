@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+
+from . import mysql
+from .metrics import Metrics
+
+
+class Maintenance:
+    """Periodic maintenance jobs run by the daemon scheduler
+
+    Every job logs its duration and observes it in the ``mymongo_job_seconds`` metric, to tell when the
+    maintenance contends with the apply path. A job with a zero interval is not scheduled.
+
+    Args:
+        mongo (object): :class:`.MyMongoDB` instance
+        conf (object): configparser section with the scheduler parameters
+        mysql_conf (object): configparser section with the mysql parameters
+        workers (int): number of apply worker partitions
+        direct (Optional[bool]): True if the apply workers receive the records without the replicator queue.
+            Default to False
+        metrics (Optional[object]): :class:`.Metrics` of the scheduler process. Default to None, metrics
+            disabled
+        metrics_registry (Optional[object]): :class:`.MetricsRegistry` of the daemon, used to checkpoint the
+            metrics. Default to None
+
+    """
+    def __init__(self, mongo, conf, mysql_conf, workers, direct=False, metrics=None, metrics_registry=None):
+        self.logger = logging.getLogger(__name__)
+        self.mongo = mongo
+        self.conf = conf
+        self.mysql_conf = mysql_conf
+        self.capture_filter = mysql.CaptureFilter(mysql_conf)
+        self.workers = workers
+        self.direct = direct
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics_registry = metrics_registry
+        self.metrics_lock = threading.Lock()
+        self.stuck_timeout = conf.getfloat('stuck_timeout', fallback=300)
+        self.metrics_retention = conf.getfloat('metrics_retention', fallback=7)
+
+    def add_jobs(self, sched):
+        """Add the maintenance jobs to a scheduler
+
+        Args:
+            sched (object): apscheduler scheduler
+
+        """
+        jobs = [('compact_queue', self.compact_queue, 10),
+                ('refresh_primary_keys', self.refresh_primary_keys, 60),
+                ('checkpoint_metrics', self.checkpoint_metrics, 5),
+                ('check_workers', self.check_workers, 1),
+                ('check_row_counts', self.check_row_counts, 1440)]
+        for name, job, default in jobs:
+            interval = self.conf.getfloat(name + '_interval', fallback=default)
+            if interval <= 0:
+                continue
+            if name == 'compact_queue' and self.direct:
+                continue
+            if name == 'checkpoint_metrics' and self.metrics_registry is None:
+                continue
+            sched.add_job(self.timed, 'interval', args=(name, job), minutes=interval, name=name, max_instances=1)
+
+    def timed(self, name, job):
+        """Run a job and report its duration
+
+        Args:
+            name (str): job name
+            job (callable): job to run
+
+        """
+        start = time.time()
+        try:
+            job()
+        except Exception as e:
+            self.logger.error('Cannot run job ' + name + '. Error: ' + str(e))
+        elapsed = time.time() - start
+        self.logger.info('Job {0} done in {1:.2f}s'.format(name, elapsed))
+        with self.metrics_lock:
+            self.metrics.observe('mymongo_job_seconds', elapsed, {'job': name})
+            self.metrics.publish(True)
+
+    def compact_queue(self):
+        """Delete the replicator queue records acknowledged by the apply workers
+
+        The workers remove the records they apply, this job removes the ones left behind by a failed delete,
+        up to the sequence number every worker reports as applied.
+
+        """
+        deleted = 0
+        for state in self.mongo.get_apply_state():
+            if state.get('seqnum') is None or state['_id'] >= self.workers:
+                continue
+            deleted += self.mongo.compact_queue(state['_id'], state['seqnum'])
+
+        if deleted > 0:
+            self.logger.info('Removed ' + str(deleted) + ' applied records from replicator queue')
+
+    def refresh_primary_keys(self):
+        """Make all the processes reload their primary key cache
+
+        """
+        self.mongo.invalidate_primary_keys()
+
+    def checkpoint_metrics(self):
+        """Save a snapshot of the daemon metrics in utildb
+
+        """
+        samples = list()
+        for (name, labels), value in self.metrics_registry.collect().items():
+            samples.append({'name': name, 'labels': dict(labels), 'value': value})
+
+        self.mongo.write_metrics_history(samples, self.metrics_retention)
+
+    def check_workers(self):
+        """Log the apply workers that made no progress for ``stuck_timeout`` seconds
+
+        A worker is stuck if it has records to apply and its applied sequence number did not advance, or in direct
+        pipeline if it stopped sending heartbeats. A worker retrying a failed record keeps sending heartbeats, so
+        they are not taken as progress in the queue pipeline.
+
+        """
+        now = time.time()
+        states = dict((state['_id'], state) for state in self.mongo.get_apply_state())
+        for partition in range(self.workers):
+            state = states.get(partition)
+            if state is None:
+                self.logger.warning('Apply worker ' + str(partition) + ' never reported its state')
+                continue
+
+            if self.direct:
+                idle = now - state['heartbeat']
+                if idle >= self.stuck_timeout:
+                    self.logger.error('Apply worker {0} stuck: no heartbeat for {1:.0f}s'.format(partition, idle))
+                continue
+
+            idle = now - state.get('progress', state['heartbeat'])
+            if idle < self.stuck_timeout:
+                continue
+
+            pending = self.mongo.count_queue(partition, state.get('seqnum'))
+            if pending > 0:
+                self.logger.error('Apply worker {0} stuck: no progress for {1:.0f}s with {2} records pending'.format(
+                    partition, idle, pending))
+
+    def check_row_counts(self):
+        """Compare the rows of the mysql tables with the documents of the mongo collections
+
+        The counts are saved in the utildb row_counts collection. Small differences are expected while the
+        replication lags behind. The tables not captured from the binlog are not compared.
+
+        """
+        for db in self.mysql_conf['databases'].split(','):
+            for table, mysql_rows in mysql.table_row_counts(self.mysql_conf, db, self.capture_filter).items():
+                mongo_rows = self.mongo.count(db, table)
+                self.mongo.write_row_count(db, table, mysql_rows, mongo_rows)
+                if mysql_rows != mongo_rows:
+                    self.logger.warning('Row count mismatch on {0}.{1}: {2} in mysql, {3} in mongo'.format(
+                        db, table, mysql_rows, mongo_rows))
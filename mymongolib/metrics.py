@@ -0,0 +1,308 @@
+import bisect
+import json
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Array
+
+# name: (type, help, histogram buckets)
+DEFINITIONS = {
+    'mymongo_events_captured_total': ('counter', 'Rows read from the mysql binlog', None),
+    'mymongo_events_applied_total': ('counter', 'Rows applied to mongo', None),
+    'mymongo_apply_latency_seconds': ('histogram', 'Seconds between the binlog event and its application to mongo',
+                                      (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900)),
+    'mymongo_batch_size': ('histogram', 'Rows or operations written to mongo with a single request',
+                           (1, 10, 50, 100, 500, 1000, 5000)),
+    'mymongo_mongo_seconds': ('histogram', 'Duration of the mongo round trips',
+                              (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)),
+    'mymongo_job_seconds': ('histogram', 'Duration of the maintenance jobs', (0.1, 0.5, 1, 5, 10, 30, 60, 300)),
+    'mymongo_replication_lag_seconds': ('gauge', 'Seconds between the last binlog event applied and its '
+                                        'application to mongo', None),
+    'mymongo_queue_depth': ('gauge', 'Records waiting in the replicator queue', None),
+    'mymongo_pending_flushes': ('gauge', 'Flushes sent to the data munging processes and not yet applied', None),
+    'mymongo_capture_paused': ('gauge', '1 while the replicator waits for the backlog to drain', None),
+    'mymongo_notifications_dropped_total': ('counter', 'Notifications not sent to a full data munging queue', None),
+    'mymongo_binlog_file': ('gauge', 'Number of the binlog file read by the replicator', None),
+    'mymongo_binlog_position': ('gauge', 'Position in the binlog file read by the replicator', None),
+    'mymongo_master_binlog_file': ('gauge', 'Number of the binlog file written by the mysql master', None),
+    'mymongo_master_binlog_position': ('gauge', 'Position in the binlog file written by the mysql master', None),
+    'mymongo_pk_cache_hits_total': ('counter', 'Primary key lookups served by the cache', None),
+    'mymongo_pk_cache_misses_total': ('counter', 'Primary key lookups read from mongo', None),
+    'mymongo_process_up': ('gauge', '1 if the daemon process is running', None),
+    'mymongo_process_restarts_total': ('counter', 'Restarts of the daemon processes', None),
+    'mymongo_last_publish_timestamp_seconds': ('gauge', 'Last time a process published its metrics', None),
+}
+
+
+def binlog_number(log_file):
+    """Number of a binlog file
+
+    Args:
+        log_file (str): binlog file name, e.g. mysql-bin.000042
+
+    Returns:
+        int: the file extension as number, 0 if it is not numeric
+
+    """
+    try:
+        return int(log_file.rsplit('.', 1)[-1])
+    except (AttributeError, ValueError):
+        return 0
+
+
+class Metrics:
+    """Counters, gauges and histograms of a process
+
+    The values are kept in process memory and published as a JSON snapshot to a shared memory array, read by
+    the daemon to serve the /metrics endpoint. Without the shared array all the methods do nothing, so the
+    instrumented code pays no cost when metrics are disabled.
+
+    Args:
+        shared (Optional[object]): multiprocessing.Array of chars where the snapshot is published. Default to
+            None, metrics disabled
+        publish_interval (Optional[float]): min seconds between two publications. Default to 1
+
+    """
+    def __init__(self, shared=None, publish_interval=1.0):
+        self.logger = logging.getLogger(__name__)
+        self.shared = shared
+        self.enabled = shared is not None
+        self.publish_interval = publish_interval
+        self.published = 0.0
+        self.values = dict()
+
+    @staticmethod
+    def key(name, labels):
+        if labels is None:
+            return name, ()
+
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, labels=None, value=1):
+        """Increment a counter
+
+        Args:
+            name (str): metric name
+            labels (Optional[dict]): metric labels. Default to None
+            value (Optional[float]): increment. Default to 1
+
+        """
+        if not self.enabled:
+            return
+
+        key = self.key(name, labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        """Set a gauge
+
+        Args:
+            name (str): metric name
+            value (float): metric value
+            labels (Optional[dict]): metric labels. Default to None
+
+        """
+        if not self.enabled:
+            return
+
+        self.values[self.key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        """Add a value to a histogram
+
+        Args:
+            name (str): metric name
+            value (float): observed value
+            labels (Optional[dict]): metric labels. Default to None
+
+        """
+        if not self.enabled:
+            return
+
+        key = self.key(name, labels)
+        buckets = DEFINITIONS[name][2]
+        hist = self.values.get(key)
+        if hist is None:
+            hist = self.values[key] = [0] * (len(buckets) + 2)
+        hist[bisect.bisect_left(buckets, value)] += 1
+        hist[-1] += value
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """Observe the duration of a block in a histogram
+
+        Args:
+            name (str): metric name
+            labels (Optional[dict]): metric labels. Default to None
+
+        """
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, labels)
+
+    def publish(self, force=False):
+        """Write the snapshot of the metrics to the shared memory
+
+        Args:
+            force (Optional[bool]): publish even if ``publish_interval`` has not passed. Default to False
+
+        """
+        if not self.enabled:
+            return
+
+        now = time.time()
+        if not force and now - self.published < self.publish_interval:
+            return
+
+        self.published = now
+        self.set('mymongo_last_publish_timestamp_seconds', now)
+        snapshot = json.dumps([[name, labels, value] for (name, labels), value in self.values.items()])
+        data = snapshot.encode('utf-8')
+        if len(data) >= len(self.shared):
+            self.logger.error('Cannot publish metrics. Error: snapshot of ' + str(len(data)) +
+                              ' bytes larger than shared memory')
+            return
+
+        with self.shared.get_lock():
+            self.shared.value = data
+
+
+class MetricsRegistry:
+    """Shared memory of the metrics of the daemon processes
+
+    The arrays are created by the daemon before starting the processes, which inherit them.
+
+    Args:
+        size (Optional[int]): bytes of shared memory for each process. Default to 65536
+
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.shared = dict()
+
+    def create(self, process):
+        """Create the shared memory of a process
+
+        Args:
+            process (str): process name
+
+        Returns:
+            object: multiprocessing.Array of chars
+
+        """
+        self.shared[process] = Array('c', self.size)
+
+        return self.shared[process]
+
+    def collect(self):
+        """Merge the snapshots of all the processes
+
+        Counters and histograms are summed, the last publication time is kept per process.
+
+        Returns:
+            dict: metric values by (name, labels)
+
+        """
+        values = dict()
+        for process, shared in self.shared.items():
+            with shared.get_lock():
+                data = shared.value
+            if len(data) == 0:
+                continue
+
+            for name, labels, value in json.loads(data.decode('utf-8')):
+                if name == 'mymongo_last_publish_timestamp_seconds':
+                    labels = [['process', process]]
+                key = (name, tuple(tuple(label) for label in labels))
+                if DEFINITIONS[name][0] == 'gauge' or key not in values:
+                    values[key] = value
+                elif DEFINITIONS[name][0] == 'histogram':
+                    values[key] = [a + b for a, b in zip(values[key], value)]
+                else:
+                    values[key] += value
+
+        return values
+
+    @staticmethod
+    def format_labels(labels, extra=None):
+        labels = list(labels)
+        if extra is not None:
+            labels.append(extra)
+        if len(labels) == 0:
+            return ''
+
+        return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+    def render(self):
+        """Render the metrics in the Prometheus text format
+
+        Returns:
+            str: metrics page
+
+        """
+        values = self.collect()
+        lines = list()
+        for name in sorted(set(name for name, labels in values)):
+            metric_type, metric_help, buckets = DEFINITIONS[name]
+            lines.append('# HELP ' + name + ' ' + metric_help)
+            lines.append('# TYPE ' + name + ' ' + metric_type)
+            for (key_name, labels), value in sorted(values.items(), key=lambda item: str(item[0])):
+                if key_name != name:
+                    continue
+                if metric_type != 'histogram':
+                    lines.append(name + self.format_labels(labels) + ' ' + repr(value))
+                    continue
+
+                count = 0
+                for bucket, bucket_count in zip(buckets + ('+Inf', ), value[:-1]):
+                    count += bucket_count
+                    lines.append(name + '_bucket' + self.format_labels(labels, ('le', bucket)) + ' ' + str(count))
+                lines.append(name + '_sum' + self.format_labels(labels) + ' ' + repr(value[-1]))
+                lines.append(name + '_count' + self.format_labels(labels) + ' ' + str(count))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host='127.0.0.1', port=9108):
+        """Serve the /metrics endpoint from a daemon thread
+
+        Args:
+            host (Optional[str]): listening address. Default to 127.0.0.1
+            port (Optional[int]): listening port. Default to 9108
+
+        Returns:
+            object: the http server
+
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), MetricsHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        return server
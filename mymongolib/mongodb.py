@@ -1,10 +1,11 @@
 import pymongo
 import urllib.parse
 import logging
+import time
 
 from .exceptions import SysException
+from bson.son import SON
 from pymongo.errors import CollectionInvalid
-from datetime import datetime
 
 # logger = logging.getLogger(__name__)
 
@@ -14,11 +15,26 @@ class MyMongoDB:
 
     Args:
         conf (dict): dictionary with the connection parameters to mongodb
+        client (Optional[object]): pymongo client to use instead of connecting with ``conf``, e.g. a mongomock
+            client in the benchmarks. Default to None
 
     Attributes:
         mdb (object): pymongo client instance
+        conn_string (str): mongodb connection string, None if the client was given
         utildb (str): utility database used for synchro
-        checked_colls (list): collections already created
+        checked_colls (set): (database, collection) pairs known to exist
+        colls (dict): pymongo collections already checked, by (database, collection)
+        warmed_dbs (set): databases whose existing collections have been loaded in ``checked_colls``
+        seqnum (int): last sequence number given to a record of the replicator queue
+        seqnum_reserved (int): highest sequence number saved in utildb as reserved, the numbers are given only
+            up to it
+        seqnum_block (int): sequence numbers reserved with a single write
+        primary_keys (dict): primary key cache, ``db.table`` -> document of utildb.primary_keys
+        pk_cache_ttl (float): seconds between two checks of the primary key cache invalidation signal
+        pk_cache_hits (int): primary key lookups served by the cache
+        pk_cache_misses (int): primary key lookups read from mongo
+        id_mode (str): ``objectid`` to let mongo generate the document ids, ``primary_key`` to derive them from
+            the mysql primary key
 
     Raises:
         :class:`.SysException`
@@ -26,30 +42,47 @@ class MyMongoDB:
     """
     mdb = None
     utildb = ''
-    checked_colls = []
+    seqnum = None
+    seqnum_reserved = None
+    seqnum_block = 10000
 
-    def __init__(self, conf):
+    def __init__(self, conf, client=None):
         self.logger = logging.getLogger(__name__)
         try:
             password = urllib.parse.quote(conf['password'])
         except Exception as e:
             raise SysException(e)
 
-        if conf['user'] == '':
-            conn_string = 'mongodb://' + \
-                            conf['host'] + ':' + \
-                            conf['port'] + '/'
+        self.conn_string = None
+        if client is not None:
+            self.mdb = client
         else:
-            conn_string = 'mongodb://' + \
-                            conf['user'] + ':' + \
-                            password + '@' + \
-                            conf['host'] + ':' + \
-                            conf['port'] + '/'
-        try:
-            self.mdb = pymongo.MongoClient(conn_string, connect=False)
-        except Exception as e:
-            raise SysException(e)
+            if conf['user'] == '':
+                conn_string = 'mongodb://' + \
+                                conf['host'] + ':' + \
+                                conf['port'] + '/'
+            else:
+                conn_string = 'mongodb://' + \
+                                conf['user'] + ':' + \
+                                password + '@' + \
+                                conf['host'] + ':' + \
+                                conf['port'] + '/'
+            self.conn_string = conn_string
+            try:
+                self.mdb = pymongo.MongoClient(conn_string, connect=False)
+            except Exception as e:
+                raise SysException(e)
         self.utildb = conf['utildb']
+        self.checked_colls = set()
+        self.colls = dict()
+        self.warmed_dbs = set()
+        self.primary_keys = None
+        self.pk_cache_ttl = conf.getfloat('pk_cache_ttl', fallback=300)
+        self.pk_cache_checked = 0.0
+        self.pk_cache_version = None
+        self.pk_cache_hits = 0
+        self.pk_cache_misses = 0
+        self.id_mode = conf.get('id_mode', 'objectid')
 
     def get_db(self, db_name):
         """Check if database exists, otherwise creates it
@@ -88,15 +121,17 @@ class MyMongoDB:
             :class:`.SysException`
 
         """
+        coll = self.colls.get((db_name, coll_name))
+        if coll is not None:
+            return coll
+
         new = False
-        db = None
+        db = self.get_db(db_name)
 
-        try:
-            db = self.get_db(db_name)
-        except Exception as e:
-            SysException(e)
+        if db_name not in self.warmed_dbs:
+            self.warm_colls(db_name)
 
-        if coll_name not in self.checked_colls:
+        if (db_name, coll_name) not in self.checked_colls:
             try:
                 db.create_collection(coll_name)
                 new = True
@@ -105,7 +140,7 @@ class MyMongoDB:
             except Exception as e:
                 raise SysException(e)
 
-            self.checked_colls.append(coll_name)
+            self.checked_colls.add((db_name, coll_name))
 
         coll = db[coll_name]
 
@@ -117,14 +152,42 @@ class MyMongoDB:
                     coll.insert_one({'_id': 'delete_seq', 'num': 0})
                 except Exception as e:
                     raise SysException(e)
+            elif coll_name == 'replicator_queue':
+                try:
+                    coll.create_index([('seqnum', pymongo.ASCENDING)])
+                    coll.create_index([('partition', pymongo.ASCENDING), ('seqnum', pymongo.ASCENDING)])
+                except Exception as e:
+                    raise SysException(e)
             elif coll_name == 'mysqllog':
                 try:
                     coll.insert_one({'_id': 'last_log_pos', 'log_file': 'NA', 'log_pos': 'NA'})
                 except Exception as e:
                     raise SysException(e)
 
+        self.colls[(db_name, coll_name)] = coll
+
         return coll
 
+    def warm_colls(self, db_name):
+        """Mark as checked all the collections already in a database
+
+        Args:
+            db_name (str): mongo database name
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        db = self.get_db(db_name)
+        try:
+            names = db.collection_names()
+        except Exception as e:
+            raise SysException(e)
+
+        for name in names:
+            self.checked_colls.add((db_name, name))
+        self.warmed_dbs.add(db_name)
+
     '''
     def get_next_seqnum(self, seq_name):
         coll = self.get_coll('counters', self.utildb)
@@ -140,20 +203,24 @@ class MyMongoDB:
         return seq['num']
     '''
 
-    def write_log_pos(self, log_file, log_pos):
+    def write_log_pos(self, log_file, log_pos, seqnum=None):
         """Write mysql replication log position to trace it
 
         Args:
             log_file (str): mysql binlog file name
             log_pos (int): position in the log file
+            seqnum (Optional[int]): last sequence number written to the replicator queue. Default to None
 
         Raises:
             :class:`.SysException`
 
         """
         coll = self.get_coll('mysqllog', self.utildb)
+        doc = {'log_file': log_file, 'log_pos': log_pos}
+        if seqnum is not None:
+            doc['seqnum'] = seqnum
         try:
-            coll.replace_one({'_id': 'last_log_pos'}, {'log_file': log_file, 'log_pos': log_pos})
+            coll.update_one({'_id': 'last_log_pos'}, {'$set': doc}, upsert=True)
         except Exception as e:
             raise SysException(e)
 
@@ -175,7 +242,143 @@ class MyMongoDB:
 
         return last_log
 
-    def write_to_queue(self, event_type, values, schema, table):
+    def ensure_queue_index(self):
+        """Create the indexes on the sequence number of the replicator queue, if missing
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('replicator_queue', self.utildb)
+        try:
+            coll.create_index([('seqnum', pymongo.ASCENDING)])
+            coll.create_index([('partition', pymongo.ASCENDING), ('seqnum', pymongo.ASCENDING)])
+        except Exception as e:
+            raise SysException(e)
+
+    def repartition_queue(self, partitions):
+        """Move the records of the replicator queue to the partitions of their hash for the number of partitions
+
+        It happens when the number of apply workers changes with records still in the replicator queue. The
+        records are moved by the hash of their primary key, so the changes to a row stay in the same partition,
+        and the progress reported by the partitions receiving records is reset, the records moved being older.
+        Records written without the hash can be moved only by draining the queue with the previous number of
+        apply workers.
+
+        Args:
+            partitions (int): number of partitions
+
+        Returns:
+            int: number of records moved
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('replicator_queue', self.utildb)
+        moves = dict()
+        try:
+            unhashed = coll.count({'hash': None, 'partition': {'$gte': partitions}})
+            for record in coll.find({'hash': {'$ne': None}}, {'hash': 1, 'partition': 1}):
+                partition = record['hash'] % partitions if partitions > 1 else 0
+                if record.get('partition') != partition:
+                    moves.setdefault(partition, list()).append(record['_id'])
+        except Exception as e:
+            raise SysException(e)
+
+        if unhashed > 0:
+            raise SysException('Replicator queue has records of more than ' + str(partitions) + ' partitions, '
+                               'restart with the previous number of apply workers until the queue is drained')
+
+        moved = 0
+        for partition, ids in moves.items():
+            try:
+                for i in range(0, len(ids), 1000):
+                    coll.update_many({'_id': {'$in': ids[i:i + 1000]}}, {'$set': {'partition': partition}})
+                self.get_coll('apply_state', self.utildb).update_one({'_id': partition}, {'$unset': {'seqnum': ''}})
+            except Exception as e:
+                raise SysException(e)
+            moved += len(ids)
+
+        if moved > 0:
+            self.logger.warning('Moved ' + str(moved) + ' records of replicator queue to ' + str(partitions) +
+                                ' partitions')
+
+        return moved
+
+    def init_seqnum(self):
+        """Initialize the replicator queue sequence number
+
+        The sequence restarts from the highest number between the one saved with the last log position, the
+        last one reserved, the last one still in the replicator queue and the ones reported as applied by the
+        apply workers, so a number is never given twice even if the queue has been drained.
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        self.ensure_queue_index()
+        seqnums = [0]
+
+        last_log = self.get_log_pos()
+        if last_log is not None:
+            seqnums.append(last_log.get('seqnum') or 0)
+            seqnums.append(last_log.get('seqnum_reserved') or 0)
+
+        coll = self.get_coll('replicator_queue', self.utildb)
+        try:
+            last = coll.find_one(sort=[('seqnum', pymongo.DESCENDING)])
+        except Exception as e:
+            raise SysException(e)
+
+        if last is not None:
+            seqnums.append(last['seqnum'])
+
+        for state in self.get_apply_state():
+            seqnums.append(state.get('seqnum') or 0)
+
+        self.seqnum = int(max(seqnums))
+        self.seqnum_reserved = self.seqnum
+
+    def reserve_seqnum(self):
+        """Save in utildb the highest sequence number that can be given before the next reservation
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        reserved = self.seqnum + self.seqnum_block
+        coll = self.get_coll('mysqllog', self.utildb)
+        try:
+            coll.update_one({'_id': 'last_log_pos'}, {'$set': {'seqnum_reserved': reserved},
+                                                      '$setOnInsert': {'log_file': 'NA', 'log_pos': 'NA'}},
+                            upsert=True)
+        except Exception as e:
+            raise SysException(e)
+
+        self.seqnum_reserved = reserved
+
+    def next_seqnum(self):
+        """Gets the next replicator queue sequence number
+
+        Returns:
+            int: sequence number
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        if self.seqnum is None:
+            self.init_seqnum()
+
+        if self.seqnum >= self.seqnum_reserved:
+            self.reserve_seqnum()
+
+        self.seqnum += 1
+
+        return self.seqnum
+
+    def write_to_queue(self, event_type, values, schema, table, timestamp=None, partition=None):
         """Write the new mysql record to a mongo queue
 
         This function write the mysql records in mysql replication logs to a queue in mongo to be processed later
@@ -185,15 +388,17 @@ class MyMongoDB:
             values: values to be handled
             schema (str): mongo database name
             table (str): mongo collection name
+            timestamp (Optional[int]): time of the binlog event. Default to None
+            partition (Optional[int]): apply worker partition of the record. Default to None
 
         Returns:
-            datetime: mongo sequence number (id)
+            int: mongo sequence number (id)
 
         Raises:
             :class:`.SysException`
 
         """
-        seqnum = datetime.now().timestamp()
+        seqnum = self.next_seqnum()
         if event_type == 'insert':
             coll = self.get_coll('replicator_queue', self.utildb)
         elif event_type == 'update':
@@ -207,6 +412,10 @@ class MyMongoDB:
         doc['event_type'] = event_type
         doc['seqnum'] = seqnum
         doc['values'] = values
+        if timestamp is not None:
+            doc['timestamp'] = timestamp
+        if partition is not None:
+            doc['partition'] = partition
 
         try:
             coll.insert_one(doc)
@@ -215,6 +424,50 @@ class MyMongoDB:
 
         return seqnum
 
+    def write_many_to_queue(self, events):
+        """Write a batch of mysql records to the mongo queue with a single insert
+
+        Args:
+            events (list): records to be queued, each one a dict with event_type, values, schema, table and
+                optionally the binlog event timestamp, the apply worker partition and the hash it was taken from
+
+        Returns:
+            int: mongo sequence number (id) of the last record
+
+        Raises:
+            :class:`.SysException`
+
+        See Also:
+            :meth:`.write_to_queue`
+
+        """
+        coll = self.get_coll('replicator_queue', self.utildb)
+
+        docs = list()
+        seqnum = None
+        for event in events:
+            seqnum = self.next_seqnum()
+            doc = dict()
+            doc['schema'] = event['schema']
+            doc['table'] = event['table']
+            doc['event_type'] = event['event_type']
+            doc['seqnum'] = seqnum
+            doc['values'] = event['values']
+            if event.get('timestamp') is not None:
+                doc['timestamp'] = event['timestamp']
+            if event.get('partition') is not None:
+                doc['partition'] = event['partition']
+            if event.get('hash') is not None:
+                doc['hash'] = event['hash']
+            docs.append(doc)
+
+        try:
+            coll.insert_many(docs)
+        except Exception as e:
+            raise SysException(e)
+
+        return seqnum
+
     def insert(self, doc, schema, collection):
         """Insert a document in mongo
 
@@ -234,6 +487,50 @@ class MyMongoDB:
         except Exception as e:
             raise SysException(e)
 
+    def insert_many(self, docs, schema, collection, ordered=True):
+        """Insert a list of documents in mongo with a single round trip
+
+        Args:
+            docs (list): the documents to be inserted
+            schema (str): mongo database name
+            collection (str): mongo collection name
+            ordered (Optional[bool]): stop at the first failed insert. Default to True
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll(collection, schema)
+
+        try:
+            coll.insert_many(docs, ordered=ordered)
+        except Exception as e:
+            raise SysException(e)
+
+    def create_index(self, keys, schema, collection, name=None, unique=False):
+        """Create an ascending index on a collection, built in background
+
+        Args:
+            keys (list): fields of the index
+            schema (str): mongo database name
+            collection (str): mongo collection name
+            name (Optional[str]): index name. Default to None, mongo default name
+            unique (Optional[bool]): unique index. Default to False
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll(collection, schema)
+        options = {'unique': unique, 'background': True}
+        if name is not None:
+            options['name'] = name
+
+        try:
+            coll.create_index([(key, pymongo.ASCENDING) for key in keys], **options)
+        except Exception as e:
+            raise SysException(e)
+
     def update(self, doc, schema, collection, primary_key):
         """Update a document in mongo
 
@@ -276,9 +573,8 @@ class MyMongoDB:
                 raise SysException(e)
         else:
             try:
-                self.logger.debug('try to delete doc with key: ' + str(primary_key))
                 result = coll.delete_one(primary_key)
-                self.logger.debug('delete result: ' + str(result.deleted_count))
+                self.logger.debug('Deleted %d documents with key %s', result.deleted_count, primary_key)
             except Exception as e:
                 raise SysException(e)
 
@@ -286,7 +582,7 @@ class MyMongoDB:
         """Delete mysql record from mongo queue
 
         Args:
-            queue_id (datetime): id of record in queue
+            queue_id (dict): filter on the id of the record in queue
 
         Raises:
             :class:`.SysException`
@@ -302,6 +598,56 @@ class MyMongoDB:
         except Exception as e:
             raise SysException(e)
 
+    def delete_many_from_queue(self, queue_ids):
+        """Delete a batch of mysql records from mongo queue with a single round trip
+
+        Args:
+            queue_ids (list): ids of the records in queue
+
+        Returns:
+            int: number of records deleted
+
+        Raises:
+            :class:`.SysException`
+
+        See Also:
+            :meth:`.delete_from_queue`
+
+        """
+        coll = self.get_coll('replicator_queue', self.utildb)
+
+        try:
+            result = coll.delete_many({'_id': {'$in': queue_ids}})
+        except Exception as e:
+            raise SysException(e)
+
+        return result.deleted_count
+
+    def bulk_write(self, requests, schema, collection, ordered=True):
+        """Apply a list of write operations to a collection with a single bulk write
+
+        Args:
+            requests (list): pymongo write operations (InsertOne, ReplaceOne, DeleteOne, ...)
+            schema (str): mongo database name
+            collection (str): mongo collection name
+            ordered (Optional[bool]): apply the operations in order and stop at the first error. Default to True
+
+        Returns:
+            BulkWriteResult: pymongo bulk write result
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll(collection, schema)
+
+        try:
+            result = coll.bulk_write(requests, ordered=ordered)
+        except Exception as e:
+            raise SysException(e)
+
+        return result
+
     def drop_db(self, db_name):
         """Drop mongo database
 
@@ -318,11 +664,18 @@ class MyMongoDB:
             except Exception as e:
                 raise SysException(e)
 
-    def get_from_queue(self, batch_size):
+        self.checked_colls = set(c for c in self.checked_colls if c[0] != db_name)
+        self.colls = dict((k, v) for k, v in self.colls.items() if k[0] != db_name)
+        self.warmed_dbs.discard(db_name)
+
+    def get_from_queue(self, batch_size, partition=None):
         """Gets a batch size number or records from mongo queue
 
+        Partition 0 gets also the records written without a partition.
+
         Args:
             batch_size (int): number of recordds to retrieve from queue
+            partition (Optional[int]): apply worker partition. Default to None, all the partitions
 
         Returns:
             cursor: pymongo cursor with search results
@@ -336,12 +689,178 @@ class MyMongoDB:
         """
         coll = self.get_coll('replicator_queue', self.utildb)
         try:
-            queue = coll.find().sort('seqnum', 1)[0:batch_size]
+            queue = coll.find(self.partition_query(partition)).sort('seqnum', 1)[0:batch_size]
         except Exception as e:
             raise SysException(e)
 
         return queue
 
+    @staticmethod
+    def partition_query(partition, seqnum=None):
+        """Query of the replicator queue records of a partition
+
+        Args:
+            partition (Optional[int]): apply worker partition, None for all the partitions. Partition 0 has
+                also the records written without a partition
+            seqnum (Optional[dict]): condition on the record sequence number. Default to None
+
+        Returns:
+            dict: mongo query
+
+        """
+        if partition is None:
+            query = {}
+        elif partition == 0:
+            query = {'partition': {'$in': [0, None]}}
+        else:
+            query = {'partition': partition}
+        if seqnum is not None:
+            query['seqnum'] = seqnum
+
+        return query
+
+    def count_queue(self, partition=None, after=None):
+        """Count the records waiting in the replicator queue
+
+        Args:
+            partition (Optional[int]): apply worker partition. Default to None, all the partitions
+            after (Optional[int]): count only the records with a higher sequence number. Default to None
+
+        Returns:
+            int: number of records
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('replicator_queue', self.utildb)
+        seqnum = {'$gt': after} if after is not None else None
+        try:
+            return coll.count(self.partition_query(partition, seqnum))
+        except Exception as e:
+            raise SysException(e)
+
+    def compact_queue(self, partition, seqnum):
+        """Delete the replicator queue records of a partition already applied
+
+        Args:
+            partition (int): apply worker partition
+            seqnum (int): all the records of the partition up to this sequence number are applied
+
+        Returns:
+            int: number of records deleted
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('replicator_queue', self.utildb)
+        try:
+            result = coll.delete_many(self.partition_query(partition, {'$lte': seqnum}))
+        except Exception as e:
+            raise SysException(e)
+
+        return result.deleted_count
+
+    def write_apply_state(self, partition, seqnum=None, progress=None):
+        """Write the progress of an apply worker
+
+        Args:
+            partition (int): apply worker partition
+            seqnum (Optional[int]): all the records of the partition up to this sequence number are applied.
+                Default to None, only the heartbeat is updated
+            progress (Optional[float]): time the sequence number last advanced. Default to None, not updated
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('apply_state', self.utildb)
+        doc = {'heartbeat': time.time()}
+        if seqnum is not None:
+            doc['seqnum'] = seqnum
+        if progress is not None:
+            doc['progress'] = progress
+        try:
+            coll.update_one({'_id': partition}, {'$set': doc}, upsert=True)
+        except Exception as e:
+            raise SysException(e)
+
+    def get_apply_state(self):
+        """Read the progress of the apply workers
+
+        Returns:
+            list: one document per partition with the applied sequence number and the last heartbeat
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('apply_state', self.utildb)
+        try:
+            return list(coll.find())
+        except Exception as e:
+            raise SysException(e)
+
+    def write_metrics_history(self, samples, retention):
+        """Save a snapshot of the replication metrics and remove the old ones
+
+        Args:
+            samples (list): metric samples, each one a dict with name, labels and value
+            retention (float): days the snapshots are kept
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('metrics_history', self.utildb)
+        now = time.time()
+        try:
+            coll.insert_one({'time': now, 'samples': samples})
+            coll.delete_many({'time': {'$lt': now - retention * 86400}})
+        except Exception as e:
+            raise SysException(e)
+
+    def count(self, schema, collection):
+        """Count the documents of a collection
+
+        Args:
+            schema (str): mongo database name
+            collection (str): mongo collection name
+
+        Returns:
+            int: number of documents
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll(collection, schema)
+        try:
+            return coll.count()
+        except Exception as e:
+            raise SysException(e)
+
+    def write_row_count(self, schema, table, mysql_rows, mongo_rows):
+        """Save the result of a row count consistency check
+
+        Args:
+            schema (str): mysql database name
+            table (str): mysql table name
+            mysql_rows (int): rows in mysql
+            mongo_rows (int): documents in mongo
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('row_counts', self.utildb)
+        doc = {'mysql': mysql_rows, 'mongo': mongo_rows, 'checked': time.time()}
+        try:
+            coll.update_one({'_id': schema + '.' + table}, {'$set': doc}, upsert=True)
+        except Exception as e:
+            raise SysException(e)
+
     def insert_primary_key(self, doc):
         """Insert the primary keys found during the import of a mysql dump
 
@@ -361,6 +880,9 @@ class MyMongoDB:
     def get_primary_key(self, table, db):
         """Read mysql database primary keys
 
+        The primary keys are served from an in-process cache loaded with all the documents of
+        utildb.primary_keys. The tables not found in the cache are read from mongo and cached as well.
+
         Args:
             table (str): name of the table for which the primary key is searched
             db (str): name of the database for which the primary key is searched
@@ -375,16 +897,130 @@ class MyMongoDB:
             :meth:`.insert_primary_key`
 
         """
+        self.check_primary_keys()
+
+        key_id = db + '.' + table
+        if key_id in self.primary_keys:
+            self.pk_cache_hits += 1
+            return self.primary_keys[key_id]
+
+        self.pk_cache_misses += 1
         coll = self.get_coll('primary_keys', self.utildb)
         primary = None
         try:
-            self.logger.debug('Try to retrieve primary key: ' + db + '.' + table)
-            primary = coll.find_one({'_id': db + '.' + table})
+            self.logger.debug('Try to retrieve primary key: %s', key_id)
+            primary = coll.find_one({'_id': key_id})
         except Exception as e:
             raise SysException(e)
 
+        self.primary_keys[key_id] = primary
+
         return primary
 
+    @staticmethod
+    def make_id(values, primary_key):
+        """Derive the mongo document id from the mysql primary key of a row
+
+        Args:
+            values (dict): row values
+            primary_key (list): primary key columns
+
+        Returns:
+            the primary key value for single column keys, a sub document with the key columns otherwise
+
+        """
+        if len(primary_key) == 1:
+            return values[primary_key[0]]
+
+        return SON([(k, values[k]) for k in primary_key])
+
+    def load_primary_keys(self):
+        """Load all the primary keys in the cache
+
+        Raises:
+            :class:`.SysException`
+
+        See Also:
+            :meth:`.get_primary_key`
+
+        """
+        coll = self.get_coll('primary_keys', self.utildb)
+        try:
+            primary_keys = dict()
+            for doc in coll.find():
+                primary_keys[doc['_id']] = doc
+        except Exception as e:
+            raise SysException(e)
+
+        self.primary_keys = primary_keys
+        self.logger.info('Loaded ' + str(len(primary_keys)) + ' primary keys in cache')
+
+    def check_primary_keys(self):
+        """Reload the primary key cache if it has been invalidated
+
+        The invalidation signal is checked at most once every ``pk_cache_ttl`` seconds.
+
+        Raises:
+            :class:`.SysException`
+
+        See Also:
+            :meth:`.invalidate_primary_keys`
+
+        """
+        now = time.time()
+        if self.primary_keys is not None and now - self.pk_cache_checked < self.pk_cache_ttl:
+            return
+
+        coll = self.get_coll('settings', self.utildb)
+        try:
+            doc = coll.find_one({'_id': 'primary_keys'})
+        except Exception as e:
+            raise SysException(e)
+
+        version = doc['version'] if doc is not None else 0
+        if self.primary_keys is None or version != self.pk_cache_version:
+            self.load_primary_keys()
+            self.pk_cache_version = version
+
+        self.pk_cache_checked = now
+
+    def invalidate_primary_keys(self):
+        """Signal all the processes to reload their primary key cache
+
+        Raises:
+            :class:`.SysException`
+
+        See Also:
+            :meth:`.check_primary_keys`
+
+        """
+        coll = self.get_coll('settings', self.utildb)
+        try:
+            coll.update_one({'_id': 'primary_keys'}, {'$inc': {'version': 1}}, upsert=True)
+        except Exception as e:
+            raise SysException(e)
+
+        self.primary_keys = None
+
+    def get_settings(self, key):
+        """Read a runtime settings document from utildb
+
+        Args:
+            key (str): settings document id
+
+        Returns:
+            dict: settings document or None if missing
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        coll = self.get_coll('settings', self.utildb)
+        try:
+            return coll.find_one({'_id': key})
+        except Exception as e:
+            raise SysException(e)
+
     def make_db_as_parsed(self, db, parse_type):
         """Write to utildb if the db has been parsed and which part of it (schema, data, both)
 
@@ -419,6 +1055,9 @@ class MyMongoDB:
         except Exception as e:
             raise SysException(e)
 
+        if parse_type == 'schema':
+            self.invalidate_primary_keys()
+
     def get_db_as_parsed(self, db):
         """Find if a database has been parsed
 
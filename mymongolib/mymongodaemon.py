@@ -1,18 +1,22 @@
 import sys
-import time
 import logging
 import os
 import configparser
 
 from importlib import util
-from multiprocessing import Process
 from multiprocessing import Queue
+from multiprocessing import Value
 from apscheduler.schedulers.blocking import BlockingScheduler
 
 from mymongolib.daemon import Daemon
 from mymongolib import mysql
 from mymongolib.mongodb import MyMongoDB
 from mymongolib.datamunging import DataMunging
+from mymongolib.asyncmunging import AsyncDataMunging
+from mymongolib.tracing import Tracer
+from mymongolib.metrics import Metrics, MetricsRegistry
+from mymongolib.maintenance import Maintenance
+from mymongolib.supervisor import Supervisor
 from mymongomodules.parse_data import ParseData
 from mymongomodules.process_data import ProcessData
 
@@ -27,7 +31,11 @@ class MyMongoDaemon(Daemon):
     def run(self):
         """Runs the daemon
 
-        Thims method runs the daemon and creates all the process needed. Then waits forever
+        Thims method runs the daemon and creates all the process needed. Then supervises them forever,
+        restarting the ones that fail
+
+        See Also:
+            :class:`.Supervisor`
 
         """
         self.logger = logging.getLogger(__name__)
@@ -42,46 +50,104 @@ class MyMongoDaemon(Daemon):
     
         self.logger.info("Running")
 
+        workers = config['datamunging'].getint('workers', fallback=1)
         self.queues = dict()
-        self.queues['replicator_out'] = Queue()
-        procs = dict()
-        procs['scheduler'] = Process(name='scheduler', target=self.scheduler)
-        procs['scheduler'].daemon = True
-        procs['scheduler'].start()
-        procs['replicator'] = Process(name='replicator', target=self.replicator)
-        procs['replicator'].daemon = True
-        procs['replicator'].start()
-        procs['datamunging'] = Process(name='datamunging', target=self.data_munging)
-        procs['datamunging'].daemon = True
-        procs['datamunging'].start()
-        procs['dataprocess'] = Process(name='dataprocess', target=self.data_process)
-        procs['dataprocess'].daemon = True
-        procs['dataprocess'].start()
-
-        while True:
-            self.logger.info('Working...')
-            time.sleep(60)
+        ipc_queue_size = config['mysql'].getint('ipc_queue_size', fallback=1000)
+        self.queues['replicator_out'] = [Queue(ipc_queue_size) for partition in range(workers)]
+        if config['datamunging'].get('pipeline', 'queue') == 'direct':
+            self.queues['apply_ack'] = Queue()
+        else:
+            self.queues['apply_ack'] = None
+
+        self.metrics_registry = None
+        if config.has_section('metrics') and config['metrics'].getboolean('enabled', fallback=False):
+            self.metrics_registry = MetricsRegistry(config['metrics'].getint('shm_size', fallback=65536))
+            self.metrics_registry.create('daemon')
+            self.metrics_registry.create('replicator')
+            self.metrics_registry.create('scheduler')
+            for partition in range(workers):
+                self.metrics_registry.create('datamunging_' + str(partition))
+            try:
+                self.metrics_registry.serve(config['metrics'].get('host', '127.0.0.1'),
+                                            config['metrics'].getint('port', fallback=9108))
+            except Exception as e:
+                self.logger.error('Cannot start metrics endpoint. Error: ' + str(e))
+
+        supervisor_conf = config['supervisor'] if config.has_section('supervisor') else None
+        supervisor = Supervisor(supervisor_conf, self.process_metrics('daemon'))
+        self.heartbeats = dict()
+        supervisor.add('scheduler', self.scheduler)
+        self.heartbeats['replicator'] = Value('d', 0.0)
+        supervisor.add('replicator', self.replicator, heartbeat=self.heartbeats['replicator'])
+        for partition in range(workers):
+            name = 'datamunging_' + str(partition)
+            self.heartbeats[name] = Value('d', 0.0)
+            # in direct pipeline the records a worker was applying are lost with it, the replicator restarts
+            # from the last binlog position applied to send them again
+            restart_with = ['replicator'] if self.queues['apply_ack'] is not None else None
+            supervisor.add(name, self.data_munging, args=(partition, ), heartbeat=self.heartbeats[name],
+                           restart_with=restart_with)
+        supervisor.add('dataprocess', self.data_process)
+        supervisor.run()
 
     def scheduler(self):
-        """Runs the daemon scheduler
+        """Runs the daemon scheduler with the maintenance jobs
+
+        See Also:
+            :class:`.Maintenance`
 
         """
         self.write_pid(str(os.getpid()))
         if self.setproctitle:
             import setproctitle
             setproctitle.setproctitle('mymongo_scheduler')
+
+        if config.has_section('scheduler'):
+            sched_conf = config['scheduler']
+        else:
+            sched_conf = configparser.ConfigParser()['DEFAULT']
+
+        mongo = MyMongoDB(config['mongodb'])
+        maintenance = Maintenance(mongo, sched_conf, config['mysql'],
+                                  config['datamunging'].getint('workers', fallback=1),
+                                  direct=self.queues['apply_ack'] is not None,
+                                  metrics=self.process_metrics('scheduler'),
+                                  metrics_registry=self.metrics_registry)
         sched = BlockingScheduler()
         try:
-            sched.add_job(self.dummy_sched, 'interval', minutes=1)
+            maintenance.add_jobs(sched)
             sched.start()
         except Exception as e:
             self.logger.error('Cannot start scheduler. Error: ' + str(e))
-    
-    def dummy_sched(self):
-        """Dummy method to keep the schedule running
+
+    @staticmethod
+    def tracing_conf():
+        """Configuration section of the capture and apply tracing
+
+        Returns:
+            object: the tracing section or None if missing
 
         """
-        self.logger.info('Scheduler works!')
+        if config.has_section('tracing'):
+            return config['tracing']
+
+        return None
+
+    def process_metrics(self, process):
+        """Metrics of a daemon process
+
+        Args:
+            process (str): process name
+
+        Returns:
+            object: :class:`.Metrics` publishing to the process shared memory, disabled if metrics are off
+
+        """
+        if self.metrics_registry is None:
+            return Metrics()
+
+        return Metrics(self.metrics_registry.shared[process],
+                       config['metrics'].getfloat('publish_interval', fallback=1.0))
 
     def write_pid(self, pid):
         """Write pid to the pidfile
@@ -105,11 +171,19 @@ class MyMongoDaemon(Daemon):
             setproctitle.setproctitle('mymongo_replicator')
 
         mongo = MyMongoDB(config['mongodb'])
-        mysql.mysql_stream(config['mysql'], mongo, self.queues['replicator_out'])
-
-    def data_munging(self):
+        tracer = Tracer(self.tracing_conf(), mongo, mysql.__name__)
+        poll_interval = 0
+        if self.metrics_registry is not None:
+            poll_interval = config['metrics'].getfloat('poll_interval', fallback=10)
+        mysql.mysql_stream(config['mysql'], mongo, self.queues['replicator_out'], self.queues['apply_ack'], tracer,
+                           self.process_metrics('replicator'), poll_interval, self.heartbeats['replicator'])
+
+    def data_munging(self, partition=0):
         """Reads data from replpication queue and writes to mongo
 
+        Args:
+            partition (Optional[int]): replication queue partition applied by the process. Default to 0
+
         See Also:
             :meth:`.replicator`
 
@@ -117,12 +191,19 @@ class MyMongoDaemon(Daemon):
         self.write_pid(str(os.getpid()))
         if self.setproctitle:
             import setproctitle
-            setproctitle.setproctitle('mymongo_datamunging')
+            setproctitle.setproctitle('mymongo_datamunging_' + str(partition))
 
         module_instance = ParseData()
 
         mongo = MyMongoDB(config['mongodb'])
-        munging = DataMunging(mongo, self.queues['replicator_out'])
+        tracer = Tracer(self.tracing_conf(), mongo, DataMunging.__module__)
+        if config['datamunging'].get('engine', 'sync') == 'async':
+            engine = AsyncDataMunging
+        else:
+            engine = DataMunging
+        munging = engine(mongo, self.queues['replicator_out'][partition], config['datamunging'], partition,
+                         self.queues['apply_ack'], tracer, self.process_metrics('datamunging_' + str(partition)),
+                         self.heartbeats['datamunging_' + str(partition)])
         munging.run(module_instance)
 
     def data_process(self):
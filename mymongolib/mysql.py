@@ -1,17 +1,669 @@
 import signal
 import sys
+import time
 import logging
+import threading
+import zlib
+import queue
+
+from fnmatch import fnmatchcase
+
+import pymysql
+
+from .exceptions import SysException
+from .typeconv import convert_binlog_row
+from .tracing import Tracer
+from .metrics import Metrics, binlog_number
 
 from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.constants import FIELD_TYPE
 from pymysqlreplication.row_event import (
     DeleteRowsEvent,
     UpdateRowsEvent,
     WriteRowsEvent,
 )
 
+# rows event flag set on the last event of a statement
+STMT_END_F = 0x0001
+
+
+def partition_hash(schema, table, key):
+    """Gets the stable hash of a row used to choose its apply worker partition
+
+    Args:
+        schema (str): mysql database name
+        table (str): mysql table name
+        key (Optional[tuple]): primary key values of the row. None if the table has no primary key
+
+    Returns:
+        int: unsigned 32 bit hash
+
+    """
+    return zlib.crc32(repr((schema, table, key)).encode('utf-8'))
+
+
+def get_partition(schema, table, key, partitions):
+    """Gets the apply worker partition of a row
+
+    The partition is a stable hash of schema, table and primary key values, so all the changes to the same row
+    are applied by the same worker and in order.
+
+    Args:
+        schema (str): mysql database name
+        table (str): mysql table name
+        key (Optional[tuple]): primary key values of the row. None if the table has no primary key
+        partitions (int): number of partitions
+
+    Returns:
+        int: partition number
+
+    """
+    if partitions <= 1:
+        return 0
+
+    return partition_hash(schema, table, key) % partitions
+
+
+def master_status(conf):
+    """Read the binlog position of the mysql master
+
+    Args:
+        conf (object): configparser section with the mysql parameters
+
+    Returns:
+        tuple: binlog file and position
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    try:
+        conn = pymysql.connect(host=conf['host'], port=conf.getint('port'), user=conf['user'],
+                               passwd=conf['password'])
+    except Exception as e:
+        raise SysException(e)
+
+    try:
+        cur = conn.cursor()
+        cur.execute('SHOW MASTER STATUS')
+        master = cur.fetchone()
+        cur.close()
+    except Exception as e:
+        raise SysException(e)
+    finally:
+        conn.close()
+
+    if master is None:
+        return None, None
+
+    return master[0], master[1]
+
+
+def table_row_counts(conf, db, capture_filter=None):
+    """Count the rows of the tables of a mysql database
+
+    Args:
+        conf (object): configparser section with the mysql parameters
+        db (str): mysql database name
+        capture_filter (Optional[object]): :class:`.CaptureFilter` of the tables counted. Default to None, all
+            the tables
+
+    Returns:
+        dict: number of rows by table name
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    try:
+        conn = pymysql.connect(host=conf['host'], port=conf.getint('port'), user=conf['user'],
+                               passwd=conf['password'])
+    except Exception as e:
+        raise SysException(e)
+
+    counts = dict()
+    try:
+        cur = conn.cursor()
+        cur.execute("SHOW FULL TABLES FROM `" + db + "` WHERE Table_type = 'BASE TABLE'")
+        for row in cur.fetchall():
+            if capture_filter is not None and not capture_filter.table_allowed(db, row[0]):
+                continue
+            cur.execute("SELECT COUNT(*) FROM `" + db + "`.`" + row[0] + "`")
+            counts[row[0]] = cur.fetchone()[0]
+        cur.close()
+    except Exception as e:
+        raise SysException(e)
+    finally:
+        conn.close()
+
+    return counts
+
+
+def event_rows(binlogevent, partitions=1, capture_filter=None):
+    """Translate the rows of a binlog rows event in replicator queue records
+
+    The values are converted to the same BSON types used by the mysqldump import, TIMESTAMP columns in UTC. Rows of
+    tables without primary key all go in the same partition. An update changing the primary key of a row to a key of
+    another partition becomes a delete of the old row in the partition of the old key and an insert of the new one in
+    the partition of the new key, so both keys keep the order of their changes. Every record keeps the
+    :func:`partition_hash` of its key, used to move it when the number of partitions changes.
+
+    Args:
+        binlogevent (object): pymysqlreplication rows event
+        partitions (Optional[int]): number of apply worker partitions. Default to 1
+        capture_filter (Optional[object]): :class:`.CaptureFilter` whose excluded columns are removed from the
+            rows before the conversion. Default to None, all the columns
+
+    Returns:
+        list: records with event_type, values, schema, table, partition, hash and the event timestamp
+
+    """
+    schema = "%s" % binlogevent.schema
+    table = "%s" % binlogevent.table
+    primary_key = binlogevent.primary_key
+    if isinstance(primary_key, str):
+        primary_key = (primary_key, ) if primary_key != '' else ()
+
+    excluded = None
+    if capture_filter is not None and len(binlogevent.rows) > 0:
+        first = binlogevent.rows[0]
+        columns = first["after_values"] if isinstance(binlogevent, UpdateRowsEvent) else first["values"]
+        excluded = capture_filter.excluded_columns(schema, table, columns, primary_key)
+    timestamps = [column.name for column in getattr(binlogevent, 'columns', ())
+                  if column.type in (FIELD_TYPE.TIMESTAMP, FIELD_TYPE.TIMESTAMP2)]
+
+    def project(values):
+        if excluded:
+            values = {k: v for k, v in values.items() if k not in excluded}
+        return convert_binlog_row(values, timestamps)
+
+    rows = list()
+    for row in binlogevent.rows:
+        if isinstance(binlogevent, DeleteRowsEvent):
+            vals = project(row["values"])
+            event_type = 'delete'
+        elif isinstance(binlogevent, UpdateRowsEvent):
+            vals = dict()
+            vals["before"] = project(row["before_values"])
+            vals["after"] = project(row["after_values"])
+            event_type = 'update'
+        elif isinstance(binlogevent, WriteRowsEvent):
+            vals = project(row["values"])
+            event_type = 'insert'
+        else:
+            continue
+
+        # (event type, values, values of the primary key)
+        changes = [(event_type, vals, vals['after'] if event_type == 'update' else vals)]
+        if event_type == 'update' and len(primary_key) > 0:
+            old_key = tuple(vals['before'].get(k) for k in primary_key)
+            new_key = tuple(vals['after'].get(k) for k in primary_key)
+            if get_partition(schema, table, old_key, partitions) != get_partition(schema, table, new_key, partitions):
+                changes = [('delete', vals['before'], vals['before']), ('insert', vals['after'], vals['after'])]
+
+        for change_type, change_vals, key_vals in changes:
+            key = tuple(key_vals.get(k) for k in primary_key) if len(primary_key) > 0 else None
+            rows.append({'event_type': change_type, 'values': change_vals, 'schema': schema, 'table': table,
+                         'timestamp': binlogevent.timestamp,
+                         'partition': get_partition(schema, table, key, partitions),
+                         'hash': partition_hash(schema, table, key)})
+
+    return rows
+
+
+class CaptureFilter:
+    """Tables and columns captured from the binlog
+
+    The rules are lists of shell-style patterns (``*``, ``?``, ``[...]``) matched against ``schema.table``
+    names, e.g. ``shop.*``, ``*.audit_log`` or ``shop.order_*``, and against ``schema.table.column`` names for
+    the excluded columns. A table is captured if it matches one of the included patterns, or there are none,
+    and none of the excluded ones. The primary key columns are never excluded, they are needed to apply the
+    updates and deletes. The results are cached by table, so the patterns are matched once per table.
+
+    Args:
+        conf (Optional[object]): configparser section with the mysql parameters. Default to None, capture all
+
+    Attributes:
+        tables (list): included ``schema.table`` patterns, empty for all the tables
+        exclude_tables (list): excluded ``schema.table`` patterns
+        exclude_columns (list): excluded ``schema.table.column`` patterns
+
+    """
+    def __init__(self, conf=None):
+        if conf is not None:
+            self.tables = self.parse_patterns(conf.get('tables', ''))
+            self.exclude_tables = self.parse_patterns(conf.get('exclude_tables', ''))
+            self.exclude_columns = self.parse_patterns(conf.get('exclude_columns', ''))
+        else:
+            self.tables = list()
+            self.exclude_tables = list()
+            self.exclude_columns = list()
+        self.allowed = dict()
+        self.excluded = dict()
+
+    @staticmethod
+    def parse_patterns(patterns):
+        """Parse a comma separated list of patterns
+
+        Args:
+            patterns (str): comma separated patterns
+
+        Returns:
+            list: patterns
+
+        """
+        return [pattern.strip() for pattern in patterns.split(',') if pattern.strip() != '']
+
+    def only_tables(self):
+        """Table names the binlog stream can be restricted to
+
+        pymysqlreplication filters the table names without schema before decoding the rows, so the names are
+        returned only when every included pattern names a single table.
+
+        Returns:
+            list: table names, None if the stream cannot be restricted
+
+        """
+        names = set()
+        for pattern in self.tables:
+            table = pattern.split('.', 1)[-1]
+            if '.' not in pattern or any(c in table for c in '*?['):
+                return None
+            names.add(table)
+
+        return sorted(names) if len(names) > 0 else None
+
+    def table_allowed(self, schema, table):
+        """Check if the rows of a table are captured
+
+        Args:
+            schema (str): mysql database name
+            table (str): mysql table name
+
+        Returns:
+            bool: True if the table is captured
+
+        """
+        key = (schema, table)
+        allowed = self.allowed.get(key)
+        if allowed is None:
+            name = schema + '.' + table
+            allowed = (len(self.tables) == 0 or any(fnmatchcase(name, p) for p in self.tables)) and \
+                not any(fnmatchcase(name, p) for p in self.exclude_tables)
+            self.allowed[key] = allowed
 
-def mysql_stream(conf, mongo, queue_out):
-    logger = logging.getLogger(__name__)
+        return allowed
+
+    def excluded_columns(self, schema, table, columns, primary_key=()):
+        """Columns of a table removed from the captured rows
+
+        Args:
+            schema (str): mysql database name
+            table (str): mysql table name
+            columns (iterable): column names of the table
+            primary_key (Optional[tuple]): primary key columns, never excluded. Default to ()
+
+        Returns:
+            set: excluded column names, empty if no column is excluded
+
+        """
+        if len(self.exclude_columns) == 0:
+            return set()
+
+        key = (schema, table, tuple(columns))
+        excluded = self.excluded.get(key)
+        if excluded is None:
+            prefix = schema + '.' + table + '.'
+            excluded = set(column for column in key[2] if column not in primary_key and
+                           any(fnmatchcase(prefix + column, p) for p in self.exclude_columns))
+            self.excluded[key] = excluded
+
+        return excluded
+
+
+class BinlogCapture:
+    """Buffers the rows read from the binlog and writes them to the replicator queue in batches
+
+    The buffer is flushed with a single insert into the replicator queue when it reaches ``flush_rows`` rows or
+    when ``flush_interval`` seconds passed since the last flush. After every flush the binlog position is
+    checkpointed, but only up to the end of the last statement whose rows are all in the queue, so a restart
+    never skips rows.
+
+    In direct mode, enabled by ``ack_queue``, the rows skip the replicator queue: every flush sends them to the
+    data munging processes through ``queues_out``, and the binlog position of a flush is checkpointed only
+    when all the processes have acknowledged they applied it. Flushes and acknowledgements carry the
+    ``generation`` of the capture, so the acknowledgements of a previous run of the replicator, still in the ipc
+    queues after a restart, never checkpoint the flushes of this one.
+
+    When ``max_pending`` rows are waiting to be applied, in the replicator queue or in the flushes not yet
+    acknowledged, the capture stops reading the binlog until the backlog drops to ``resume_pending`` rows. In
+    queue mode the backlog is estimated from the rows written and counted in the replicator queue only when the
+    estimate reaches the high watermark. In direct mode the capture stops also when ``max_flushes`` flushes are
+    not acknowledged, until half of them are, so a flush never waits for room in the bounded ipc queues while
+    holding the buffer lock.
+
+    Args:
+        mongo (object): :class:`.MyMongoDB` instance
+        queues_out (list): multiprocessing queues used to notify the data munging processes, one per partition
+        flush_rows (Optional[int]): max number of rows kept in the buffer. Default to 1000
+        flush_interval (Optional[float]): max seconds a row waits in the buffer. Default to 1
+        ack_queue (Optional[object]): multiprocessing queue where the data munging processes acknowledge the
+            rows applied in direct mode. Default to None, rows written to the replicator queue
+        metrics (Optional[object]): :class:`.Metrics` of the replicator process. Default to None, metrics
+            disabled
+        heartbeat (Optional[object]): multiprocessing.Value where the time of the last heartbeat is written for
+            the daemon supervisor. While the reader waits for the next binlog event the heartbeat is the current
+            time, while it handles an event it is the time of its last progress, so a reader hung in
+            :meth:`add_event` stops the heartbeats. Default to None
+        max_pending (Optional[int]): rows waiting to be applied above which the capture pauses. Default to 0,
+            never pause
+        resume_pending (Optional[int]): rows waiting to be applied below which a paused capture resumes.
+            Default to None, half of ``max_pending``
+        capture_filter (Optional[object]): :class:`.CaptureFilter` of the captured tables and columns. Default
+            to None, capture all
+        max_flushes (Optional[int]): flushes not yet acknowledged above which the capture pauses in direct mode,
+            lower than the size of the ipc queues. Default to 0, never pause
+
+    Attributes:
+        paused (bool): True while the capture waits for the backlog to drain
+        generation (float): start time of the capture, identifies its flushes in direct mode
+        waiting (bool): True while the reader waits for the next binlog event
+        progress (float): last time the reader made progress
+
+    """
+    def __init__(self, mongo, queues_out, flush_rows=1000, flush_interval=1.0, ack_queue=None, metrics=None,
+                 heartbeat=None, max_pending=0, resume_pending=None, capture_filter=None,
+                 max_flushes=0):
+        self.logger = logging.getLogger(__name__)
+        self.mongo = mongo
+        self.queues_out = queues_out
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffer = list()
+        self.log_file = None
+        self.log_pos = None
+        self.checkpoint = (None, None)
+        self.last_flush = time.time()
+        self.ack_queue = ack_queue
+        self.pending = list()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.heartbeat = heartbeat
+        self.max_pending = max_pending
+        self.resume_pending = resume_pending if resume_pending is not None else max_pending // 2
+        self.max_flushes = max_flushes
+        self.queued = 0
+        self.paused = False
+        self.generation = time.time()
+        self.waiting = True
+        self.progress = time.time()
+        self.capture_filter = capture_filter if capture_filter is not None else CaptureFilter()
+
+    def start_timer(self):
+        """Start the thread flushing the buffer when the stream is idle and sending the heartbeats
+
+        """
+        if self.flush_interval <= 0 and self.heartbeat is None:
+            return
+
+        timer_thread = threading.Thread(target=self.run_timer)
+        timer_thread.daemon = True
+        timer_thread.start()
+
+    def run_timer(self):
+        while True:
+            time.sleep(self.flush_interval if self.flush_interval > 0 else 1.0)
+            self.tick()
+
+    def tick(self):
+        """Send the heartbeat and flush the buffer if the stream is idle
+
+        """
+        with self.lock:
+            if self.heartbeat is not None:
+                self.heartbeat.value = time.time() if self.waiting else self.progress
+            try:
+                if 0 < self.flush_interval <= time.time() - self.last_flush:
+                    self._flush()
+                elif self.ack_queue is not None:
+                    self.check_acks()
+                self.metrics.publish()
+            except Exception as e:
+                self.logger.error('Cannot flush replicator buffer. Error: ' + str(e))
+
+    def start_poller(self, conf, interval):
+        """Start the thread reading the master binlog position and the replicator queue depth for the metrics
+
+        Args:
+            conf (object): configparser section with the mysql parameters
+            interval (float): seconds between two reads
+
+        """
+        if not self.metrics.enabled or interval <= 0:
+            return
+
+        poller_thread = threading.Thread(target=self.run_poller, args=(conf, interval))
+        poller_thread.daemon = True
+        poller_thread.start()
+
+    def run_poller(self, conf, interval):
+        while True:
+            try:
+                master_file, master_pos = master_status(conf)
+                depth = self.mongo.count_queue() if self.ack_queue is None else None
+            except Exception as e:
+                self.logger.error('Cannot read replication status. Error: ' + str(e))
+            else:
+                with self.lock:
+                    if master_file is not None:
+                        self.metrics.set('mymongo_master_binlog_file', binlog_number(master_file))
+                        self.metrics.set('mymongo_master_binlog_position', master_pos)
+                    if depth is not None:
+                        self.metrics.set('mymongo_queue_depth', depth)
+                    self.metrics.publish(True)
+            time.sleep(interval)
+
+    def add_event(self, binlogevent, log_file, log_pos):
+        """Add the rows of a binlog event to the buffer
+
+        The rows of the tables not captured are not decoded, but the event still moves the checkpoint forward
+        when it ends a statement.
+
+        Args:
+            binlogevent (object): pymysqlreplication rows event
+            log_file (str): binlog file of the event
+            log_pos (int): binlog position after the event
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        self.waiting = False
+        self.progress = time.time()
+        try:
+            self._add_event(binlogevent, log_file, log_pos)
+        finally:
+            self.progress = time.time()
+            self.waiting = True
+
+    def _add_event(self, binlogevent, log_file, log_pos):
+        if self.capture_filter.table_allowed("%s" % binlogevent.schema, "%s" % binlogevent.table):
+            rows = event_rows(binlogevent, len(self.queues_out), self.capture_filter)
+        else:
+            rows = list()
+        with self.lock:
+            self.buffer.extend(rows)
+            if self.metrics.enabled and len(rows) > 0:
+                self.metrics.inc('mymongo_events_captured_total', {'schema': rows[0]['schema'],
+                                                                   'table': rows[0]['table']}, len(rows))
+                self.metrics.set('mymongo_binlog_file', binlog_number(log_file))
+                self.metrics.set('mymongo_binlog_position', log_pos)
+            if binlogevent.flags & STMT_END_F:
+                self.log_file = log_file
+                self.log_pos = log_pos
+            if len(self.buffer) >= self.flush_rows:
+                self._flush()
+
+        if self.max_pending > 0 or self.max_flushes > 0:
+            self.throttle()
+
+    def backlog(self):
+        """Rows waiting to be applied by the data munging processes
+
+        Returns:
+            int: rows in the flushes not yet acknowledged in direct mode, estimated rows in the replicator
+            queue otherwise
+
+        """
+        if self.ack_queue is not None:
+            return sum(flush['rows'] for flush in self.pending)
+
+        return self.queued
+
+    def backlog_full(self):
+        if self.max_flushes > 0 and len(self.pending) >= self.max_flushes:
+            return True
+        return self.max_pending > 0 and self.backlog() >= self.max_pending
+
+    def backlog_drained(self):
+        if self.max_flushes > 0 and len(self.pending) > self.max_flushes // 2:
+            return False
+        return self.max_pending <= 0 or self.backlog() <= self.resume_pending
+
+    def refresh_backlog(self):
+        if self.ack_queue is not None:
+            self.check_acks()
+        else:
+            self.queued = self.mongo.count_queue()
+            self.metrics.set('mymongo_queue_depth', self.queued)
+
+    def throttle(self):
+        """Block while the backlog is above the watermarks
+
+        Reading the binlog stops while the capture is paused. If mysql drops the idle replication connection, the
+        binlog stream reconnects from the last event read.
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        with self.lock:
+            if not self.backlog_full():
+                return
+            self.refresh_backlog()
+            if not self.backlog_full():
+                return
+            self.paused = True
+            self.metrics.set('mymongo_capture_paused', 1)
+            self.metrics.publish(True)
+            self.logger.warning('Replicator paused, %d rows waiting to be applied', self.backlog())
+
+        while True:
+            time.sleep(1)
+            with self.lock:
+                self.progress = time.time()
+                try:
+                    self.refresh_backlog()
+                except SysException as e:
+                    self.logger.error('Cannot read replicator backlog. Error: ' + str(e))
+                    continue
+                if self.backlog_drained():
+                    self.paused = False
+                    self.metrics.set('mymongo_capture_paused', 0)
+                    self.metrics.publish(True)
+                    self.logger.info('Replicator resumed, %d rows waiting to be applied', self.backlog())
+                    return
+
+    def flush(self):
+        """Write the buffered rows to the replicator queue and checkpoint the binlog position
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.ack_queue is not None:
+            self.flush_direct()
+            return
+
+        if len(self.buffer) > 0:
+            with self.metrics.timer('mymongo_mongo_seconds', {'op': 'queue_insert'}):
+                seqnum = self.mongo.write_many_to_queue(self.buffer)
+            self.metrics.observe('mymongo_batch_size', len(self.buffer), {'stage': 'capture'})
+            self.logger.debug('Flushed %d rows to replicator queue', len(self.buffer))
+            partitions = set(row['partition'] for row in self.buffer)
+            self.queued += len(self.buffer)
+            self.buffer = list()
+            for partition in partitions:
+                try:
+                    self.queues_out[partition].put_nowait({'seqnum': seqnum})
+                except queue.Full:
+                    # the process has notifications to read yet and then reads the queue until it is empty
+                    self.metrics.inc('mymongo_notifications_dropped_total', {'partition': str(partition)})
+
+        if self.log_pos is not None and self.checkpoint != (self.log_file, self.log_pos):
+            self.mongo.write_log_pos(self.log_file, self.log_pos, self.mongo.seqnum)
+            self.checkpoint = (self.log_file, self.log_pos)
+
+        self.last_flush = time.time()
+
+    def flush_direct(self):
+        partitions = dict()
+        for row in self.buffer:
+            row['seqnum'] = self.mongo.next_seqnum()
+            row['_id'] = row['seqnum']
+            partitions.setdefault(row['partition'], list()).append(row)
+        self.buffer = list()
+
+        seqnum = self.mongo.seqnum
+        for partition, events in partitions.items():
+            self.queues_out[partition].put({'seqnum': seqnum, 'generation': self.generation, 'events': events})
+
+        self.pending.append({'seqnum': seqnum, 'partitions': set(partitions),
+                             'rows': sum(len(events) for events in partitions.values()),
+                             'log_file': self.log_file, 'log_pos': self.log_pos})
+        self.check_acks()
+        self.last_flush = time.time()
+
+    def check_acks(self):
+        """Read the acknowledgements of the data munging processes and checkpoint the binlog position of the
+        flushes applied by all of them
+
+        Raises:
+            :class:`.SysException`
+
+        """
+        while True:
+            try:
+                ack = self.ack_queue.get_nowait()
+            except queue.Empty:
+                break
+            if ack.get('generation') != self.generation:
+                # applied before a restart of the replicator, its binlog position is read again
+                continue
+            for flush in self.pending:
+                if flush['seqnum'] is None or flush['seqnum'] > ack['seqnum']:
+                    break
+                flush['partitions'].discard(ack['partition'])
+
+        applied = None
+        while len(self.pending) > 0 and len(self.pending[0]['partitions']) == 0:
+            applied = self.pending.pop(0)
+        self.metrics.set('mymongo_pending_flushes', len(self.pending))
+
+        if applied is not None and applied['log_pos'] is not None and \
+                self.checkpoint != (applied['log_file'], applied['log_pos']):
+            self.mongo.write_log_pos(applied['log_file'], applied['log_pos'], applied['seqnum'])
+            self.checkpoint = (applied['log_file'], applied['log_pos'])
+
+
+def mysql_stream(conf, mongo, queues_out, ack_queue=None, tracer=None, metrics=None, poll_interval=10,
+                 heartbeat=None):
+    if tracer is None:
+        tracer = Tracer(mongo=mongo, name=__name__)
 
     # server_id is your slave identifier, it should be unique.
     # set blocking to True if you want to block and wait for the next event at
@@ -22,7 +674,13 @@ def mysql_stream(conf, mongo, queue_out):
         "user": conf['user'],
         "passwd": conf['password']
     }
+    # a stream without events for stream_timeout seconds reconnects, so the reader never waits on a dead connection
+    stream_timeout = conf.getfloat('stream_timeout', fallback=60)
+    if stream_timeout > 0:
+        mysql_settings["read_timeout"] = stream_timeout
 
+    mongo.init_seqnum()
+    mongo.repartition_queue(len(queues_out))
     last_log = mongo.get_log_pos()
     if last_log['log_file'] == 'NA':
         log_file = None
@@ -33,6 +691,7 @@ def mysql_stream(conf, mongo, queue_out):
         log_pos = int(last_log['log_pos'])
         resume_stream = True
 
+    capture_filter = CaptureFilter(conf)
     stream = BinLogStreamReader(connection_settings=mysql_settings,
                                 server_id=conf.getint('slaveid'),
                                 only_events=[DeleteRowsEvent, WriteRowsEvent, UpdateRowsEvent],
@@ -40,32 +699,25 @@ def mysql_stream(conf, mongo, queue_out):
                                 resume_stream=resume_stream,
                                 log_file=log_file,
                                 log_pos=log_pos,
-                                only_schemas=conf['databases'].split(','))
+                                only_schemas=conf['databases'].split(','),
+                                only_tables=capture_filter.only_tables())
+
+    capture = BinlogCapture(mongo, queues_out,
+                            flush_rows=conf.getint('flush_rows', fallback=1000),
+                            flush_interval=conf.getfloat('flush_interval', fallback=1.0),
+                            ack_queue=ack_queue,
+                            metrics=metrics,
+                            heartbeat=heartbeat,
+                            max_pending=conf.getint('max_pending', fallback=0),
+                            resume_pending=conf.getint('resume_pending', fallback=None),
+                            max_flushes=conf.getint('ipc_queue_size', fallback=1000) // 2,
+                            capture_filter=capture_filter)
+    capture.start_timer()
+    capture.start_poller(conf, poll_interval)
 
     for binlogevent in stream:
-        binlogevent.dump()
-        schema = "%s" % binlogevent.schema
-        table = "%s" % binlogevent.table
-
-        for row in binlogevent.rows:
-            if isinstance(binlogevent, DeleteRowsEvent):
-                vals = row["values"]
-                event_type = 'delete'
-            elif isinstance(binlogevent, UpdateRowsEvent):
-                vals = dict()
-                vals["before"] = row["before_values"]
-                vals["after"] = row["after_values"]
-                event_type = 'update'
-            elif isinstance(binlogevent, WriteRowsEvent):
-                vals = row["values"]
-                event_type = 'insert'
-
-            seqnum = mongo.write_to_queue(event_type, vals, schema, table)
-            mongo.write_log_pos(stream.log_file, stream.log_pos)
-            queue_out.put({'seqnum': seqnum})
-            logger.debug(row)
-            logger.debug(stream.log_pos)
-            logger.debug(stream.log_file)
+        tracer.trace_event(binlogevent, stream.log_file, stream.log_pos)
+        capture.add_event(binlogevent, stream.log_file, stream.log_pos)
 
+    capture.flush()
     stream.close()
-
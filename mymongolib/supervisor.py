@@ -0,0 +1,149 @@
+import logging
+import time
+
+from multiprocessing import Process
+
+from .metrics import Metrics
+
+
+class Supervisor:
+    """Starts the daemon processes and restarts them when they die or stop sending heartbeats
+
+    A failed process is restarted after a delay doubling at every consecutive failure, from ``backoff_base`` up
+    to ``backoff_max`` seconds. The failures are no more consecutive once the process ran for ``stable_time``
+    seconds.
+
+    Args:
+        conf (Optional[object]): configparser section with the supervisor parameters. Default to None, the
+            default parameters
+        metrics (Optional[object]): :class:`.Metrics` of the daemon process. Default to None, metrics disabled
+
+    Attributes:
+        check_interval (float): seconds between two checks of the processes
+        heartbeat_timeout (float): seconds without heartbeat after which a process is restarted
+        restarts (dict): number of restarts by process name
+
+    """
+    def __init__(self, conf=None, metrics=None):
+        self.logger = logging.getLogger(__name__)
+        if conf is not None:
+            self.check_interval = conf.getfloat('check_interval', fallback=5)
+            self.heartbeat_timeout = conf.getfloat('heartbeat_timeout', fallback=180)
+            self.backoff_base = conf.getfloat('backoff_base', fallback=1)
+            self.backoff_max = conf.getfloat('backoff_max', fallback=300)
+            self.stable_time = conf.getfloat('stable_time', fallback=600)
+        else:
+            self.check_interval = 5
+            self.heartbeat_timeout = 180
+            self.backoff_base = 1
+            self.backoff_max = 300
+            self.stable_time = 600
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.procs = dict()
+        self.restarts = dict()
+
+    def add(self, name, target, args=(), heartbeat=None, restart_with=None):
+        """Add a process to the supervised ones
+
+        Args:
+            name (str): process name
+            target (callable): process function
+            args (Optional[tuple]): process function arguments. Default to ()
+            heartbeat (Optional[object]): multiprocessing.Value where the process writes the time of its last
+                heartbeat. Default to None, only the liveness is checked
+            restart_with (Optional[list]): names of the processes to restart when this one fails. Default to None
+
+        """
+        self.procs[name] = {'target': target, 'args': args, 'heartbeat': heartbeat,
+                            'restart_with': restart_with or [], 'process': None, 'started': 0.0,
+                            'failures': 0, 'next_start': 0.0}
+        self.restarts[name] = 0
+
+    def start(self, name):
+        """Start a process
+
+        Args:
+            name (str): process name
+
+        """
+        proc = self.procs[name]
+        if proc['heartbeat'] is not None:
+            proc['heartbeat'].value = time.time()
+        proc['process'] = Process(name=name, target=proc['target'], args=proc['args'])
+        proc['process'].daemon = True
+        proc['process'].start()
+        proc['started'] = time.time()
+        self.metrics.set('mymongo_process_up', 1, {'process': name})
+
+    def stop(self, name):
+        """Terminate a process
+
+        Args:
+            name (str): process name
+
+        """
+        process = self.procs[name]['process']
+        if process is not None and process.is_alive():
+            process.terminate()
+            process.join(5)
+        self.procs[name]['process'] = None
+        self.metrics.set('mymongo_process_up', 0, {'process': name})
+
+    def fail(self, name, reason):
+        """Stop a failed process and schedule its restart
+
+        Args:
+            name (str): process name
+            reason (str): failure description
+
+        """
+        now = time.time()
+        proc = self.procs[name]
+        self.stop(name)
+        if now - proc['started'] >= self.stable_time:
+            proc['failures'] = 0
+        delay = min(self.backoff_max, self.backoff_base * 2 ** proc['failures'])
+        proc['failures'] += 1
+        proc['next_start'] = now + delay
+        self.restarts[name] += 1
+        self.metrics.inc('mymongo_process_restarts_total', {'process': name})
+        self.logger.error('Process {0} {1}, restart {2} in {3:.1f}s'.format(name, reason, self.restarts[name],
+                                                                            delay))
+
+        for other in proc['restart_with']:
+            if self.procs[other]['process'] is not None:
+                self.logger.warning('Restarting process ' + other + ' with ' + name)
+                self.stop(other)
+                self.procs[other]['next_start'] = now
+                self.restarts[other] += 1
+                self.metrics.inc('mymongo_process_restarts_total', {'process': other})
+
+    def check(self):
+        """Check the processes once, restarting the failed ones whose backoff delay passed
+
+        """
+        now = time.time()
+        for name, proc in self.procs.items():
+            process = proc['process']
+            if process is None:
+                if now >= proc['next_start']:
+                    self.start(name)
+                continue
+
+            if not process.is_alive():
+                self.fail(name, 'exited with code ' + str(process.exitcode))
+            elif proc['heartbeat'] is not None and now - proc['heartbeat'].value > self.heartbeat_timeout:
+                self.fail(name, 'sent no heartbeat for {0:.0f}s'.format(now - proc['heartbeat'].value))
+
+        self.metrics.publish()
+
+    def run(self):
+        """Start all the processes and supervise them forever
+
+        """
+        for name in self.procs:
+            self.start(name)
+
+        while True:
+            time.sleep(self.check_interval)
+            self.check()
@@ -0,0 +1,142 @@
+import io
+import logging
+import time
+
+from contextlib import redirect_stdout
+
+
+class Tracer:
+    """Per table tracing of the capture and apply paths
+
+    The traces are written at INFO level to the ``<name>.trace`` logger, only for the tables selected in the
+    ``[tracing]`` configuration section or in the ``tracing`` document of the utildb settings collection, which
+    is read again every ``refresh_interval`` seconds to turn tracing on and off at runtime. When no table is
+    selected the checks cost a set lookup and no message is formatted.
+
+    Args:
+        conf (Optional[object]): configparser section with the tracing parameters. Default to None, tracing off
+        mongo (Optional[object]): :class:`.MyMongoDB` instance used to read the runtime settings. Default to None
+        name (Optional[str]): name of the traced module. Default to mymongolib
+
+    Attributes:
+        tables (set): traced tables as ``schema.table``, ``schema.*`` or ``*`` for all the tables
+        sample_rate (int): the full dump of a binlog event is logged once every ``sample_rate`` traced events,
+            0 to never dump them
+        refresh_interval (float): seconds between two reads of the runtime settings
+
+    """
+    def __init__(self, conf=None, mongo=None, name='mymongolib'):
+        self.logger = logging.getLogger(name + '.trace')
+        self.mongo = mongo
+        if conf is not None:
+            self.tables = self.parse_tables(conf.get('tables', ''))
+            self.sample_rate = conf.getint('sample_rate', fallback=0)
+            self.refresh_interval = conf.getfloat('refresh_interval', fallback=10)
+        else:
+            self.tables = set()
+            self.sample_rate = 0
+            self.refresh_interval = 10
+        self.conf_tables = self.tables
+        self.conf_sample_rate = self.sample_rate
+        self.refreshed = time.time()
+        self.sampled = 0
+
+    @staticmethod
+    def parse_tables(tables):
+        """Parse a list of traced tables
+
+        Args:
+            tables (str or list): comma separated string or list of ``schema.table`` names
+
+        Returns:
+            set: table names
+
+        """
+        if isinstance(tables, str):
+            tables = tables.split(',')
+
+        return set(table.strip() for table in tables if table.strip() != '')
+
+    def refresh(self):
+        """Read the runtime tracing settings from utildb
+
+        The settings document overrides the configured tables and sample rate while it exists.
+
+        """
+        self.refreshed = time.time()
+        try:
+            settings = self.mongo.get_settings('tracing')
+        except Exception as e:
+            self.logger.error('Cannot read tracing settings. Error: ' + str(e))
+            return
+
+        if settings is None:
+            self.tables = self.conf_tables
+            self.sample_rate = self.conf_sample_rate
+        else:
+            self.tables = self.parse_tables(settings.get('tables', []))
+            self.sample_rate = settings.get('sample_rate', self.conf_sample_rate)
+
+    def active(self, schema, table):
+        """Check if a table is traced
+
+        Args:
+            schema (str): mysql database name
+            table (str): mysql table name
+
+        Returns:
+            bool: True if the table is traced
+
+        """
+        if self.mongo is not None and time.time() - self.refreshed >= self.refresh_interval:
+            self.refresh()
+
+        if len(self.tables) == 0 or not self.logger.isEnabledFor(logging.INFO):
+            return False
+
+        return '*' in self.tables or schema + '.*' in self.tables or schema + '.' + table in self.tables
+
+    def trace(self, schema, table, msg, *args):
+        """Log a trace message for a table
+
+        The message is formatted only if the table is traced.
+
+        Args:
+            schema (str): mysql database name
+            table (str): mysql table name
+            msg (str): message with ``%`` placeholders
+            *args: message arguments
+
+        """
+        if self.active(schema, table):
+            self.logger.info('%s.%s ' + msg, schema, table, *args)
+
+    def trace_event(self, binlogevent, log_file, log_pos):
+        """Log a binlog event read by the replicator
+
+        The position is logged for every event of a traced table, the full event dump once every
+        ``sample_rate`` of them.
+
+        Args:
+            binlogevent (object): pymysqlreplication rows event
+            log_file (str): binlog file of the event
+            log_pos (int): binlog position after the event
+
+        """
+        schema = "%s" % binlogevent.schema
+        table = "%s" % binlogevent.table
+        if not self.active(schema, table):
+            return
+
+        self.logger.info('%s.%s %s with %d rows at %s:%s', schema, table, type(binlogevent).__name__,
+                         len(binlogevent.rows), log_file, log_pos)
+        if self.sample_rate <= 0:
+            return
+
+        self.sampled += 1
+        if self.sampled >= self.sample_rate:
+            self.sampled = 0
+            out = io.StringIO()
+            with redirect_stdout(out):
+                binlogevent.dump()
+            self.logger.info('%s.%s event dump:\n%s', schema, table, out.getvalue())
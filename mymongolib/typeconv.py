@@ -0,0 +1,233 @@
+import datetime
+import decimal
+import re
+import time
+
+try:
+    from bson.decimal128 import Decimal128
+except ImportError:
+    Decimal128 = None
+
+INT_TYPES = ['tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint', 'year']
+FLOAT_TYPES = ['float', 'double', 'real']
+DECIMAL_TYPES = ['decimal', 'numeric']
+DATETIME_TYPES = ['datetime', 'timestamp']
+BINARY_TYPES = ['binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob']
+
+ZERO_DATES = ['0000-00-00', '0000-00-00 00:00:00']
+
+base_type = re.compile(r'\s*(\w+)')
+bit_width = re.compile(r'\s*bit\s*\(\s*(\d+)\s*\)', re.IGNORECASE)
+
+
+def to_decimal(value):
+    """Convert a decimal value to the BSON decimal type
+
+    Falls back to the string representation when the bson module has no Decimal128 (pymongo < 3.4).
+
+    Args:
+        value: decimal.Decimal or string
+
+    Returns:
+        Decimal128 or str
+
+    """
+    if Decimal128 is None:
+        return str(value)
+
+    return Decimal128(decimal.Decimal(value))
+
+
+def to_datetime(value):
+    if value in ZERO_DATES:
+        return None
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def to_date(value):
+    if value in ZERO_DATES:
+        return None
+
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def to_binary(value):
+    if value.startswith('0x'):
+        value = value[2:]
+
+    return bytes.fromhex(value)
+
+
+def to_set(value):
+    # the binlog reader decodes an empty set as NULL
+    if value == '':
+        return None
+
+    return sorted(value.split(','))
+
+
+def to_bits(width):
+    """Gets the function converting the hex text of a BIT column to the string of bits read from the binlog
+
+    Args:
+        width (int): bits of the column
+
+    Returns:
+        function: converter
+
+    """
+    def convert(value):
+        if value.startswith('0x'):
+            value = value[2:]
+        return format(int(value, 16) if value != '' else 0, '0' + str(width) + 'b')
+
+    return convert
+
+
+def utc_timestamp(value):
+    """Convert a TIMESTAMP decoded from the binlog in local time to UTC, like mysqldump --tz-utc writes it
+
+    Args:
+        value (datetime.datetime): local time
+
+    Returns:
+        datetime.datetime: UTC time, without tzinfo
+
+    """
+    utc = datetime.datetime.utcfromtimestamp(time.mktime(value.timetuple()))
+
+    return utc.replace(microsecond=value.microsecond)
+
+
+def dump_converter(mysql_type):
+    """Gets the function converting the text of a mysqldump xml field to the BSON type of its mysql type
+
+    Args:
+        mysql_type (str): column type as written in the table structure, e.g. ``int(10) unsigned``
+
+    Returns:
+        function: converter, None if the text is kept as it is
+
+    """
+    match = base_type.match(mysql_type)
+    if match is None:
+        return None
+
+    name = match.group(1).lower()
+    if name in INT_TYPES:
+        return int
+    elif name in FLOAT_TYPES:
+        return float
+    elif name in DECIMAL_TYPES:
+        return to_decimal
+    elif name in DATETIME_TYPES:
+        return to_datetime
+    elif name == 'date':
+        return to_date
+    elif name in BINARY_TYPES:
+        return to_binary
+    elif name == 'set':
+        return to_set
+    elif name == 'bit':
+        match = bit_width.match(mysql_type)
+        return to_bits(int(match.group(1)) if match is not None else 1)
+
+    return None
+
+
+def binlog_value(value):
+    """Convert a value read from the binlog to the same BSON type used for the mysqldump import
+
+    Args:
+        value: value decoded by pymysqlreplication
+
+    Returns:
+        converted value
+
+    """
+    if isinstance(value, decimal.Decimal):
+        return to_decimal(value)
+    elif isinstance(value, datetime.datetime):
+        return value
+    elif isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    elif isinstance(value, datetime.timedelta):
+        seconds = int(value.total_seconds())
+        sign = '-' if seconds < 0 else ''
+        seconds = abs(seconds)
+        return '{0}{1:02d}:{2:02d}:{3:02d}'.format(sign, seconds // 3600, seconds // 60 % 60, seconds % 60)
+    elif isinstance(value, datetime.time):
+        return value.strftime('%H:%M:%S')
+    elif isinstance(value, (set, frozenset)):
+        return sorted(value)
+
+    return value
+
+
+def convert_binlog_row(values, timestamps=()):
+    """Convert in place the values of a binlog row
+
+    The binlog reader decodes the TIMESTAMP columns in local time, they are converted to UTC as in the dump.
+
+    Args:
+        values (dict): column name -> value
+        timestamps (Optional[iterable]): names of the TIMESTAMP columns. Default to (), none
+
+    Returns:
+        dict: the same dict, converted
+
+    """
+    for name, value in values.items():
+        if value is not None and not isinstance(value, (int, str, float, bytes)):
+            values[name] = binlog_value(value)
+
+    for name in timestamps:
+        if values.get(name) is not None:
+            values[name] = utc_timestamp(values[name])
+
+    return values
+
+
+class TypeConverter:
+    """Converts the rows of a mysqldump xml import to BSON types, using the column types of the table structure
+
+    The rows are converted one column at a time over the whole batch, so the converter of each column is
+    looked up once per batch.
+
+    Args:
+        columns (list): [column name, mysql type] pairs of the table
+
+    """
+    def __init__(self, columns):
+        self.converters = list()
+        for name, mysql_type in columns:
+            converter = dump_converter(mysql_type)
+            if converter is not None:
+                self.converters.append((name, converter))
+
+    def convert_rows(self, rows):
+        """Convert in place a batch of rows
+
+        Values that cannot be converted are kept as text.
+
+        Args:
+            rows (list): dicts column name -> text, None for NULL
+
+        Returns:
+            list: the same rows, converted
+
+        """
+        for name, converter in self.converters:
+            for row in rows:
+                value = row.get(name)
+                if value is None:
+                    continue
+                try:
+                    row[name] = converter(value)
+                except ValueError:
+                    pass
+
+        return rows
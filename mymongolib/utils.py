@@ -1,12 +1,18 @@
 import argparse
+import configparser
 import logging
 import subprocess
 import os
-import re
+import time
+import pymysql
 
-from tempfile import NamedTemporaryFile
-from lxml import etree
+from multiprocessing import Pool
+
+from tempfile import NamedTemporaryFile, TemporaryFile
 from .exceptions import SysException
+from .dumpimport import DumpImporter
+from .mongodb import MyMongoDB
+from .mysql import CaptureFilter
 
 
 logger = logging.getLogger(__name__)
@@ -44,174 +50,330 @@ def cmd_parser():
     return parser
 
 
-def run_mysqldump(dump_type, conf, mongodb):
+def run_mysqldump(dump_type, conf, mongodb, mongo_conf=None):
+    if mongo_conf is not None and conf.getint('dump_workers', fallback=1) > 1:
+        if not conf.getboolean('dump_consistent', fallback=False):
+            return run_mysqldump_parallel(dump_type, conf, mongodb, mongo_conf)
+        logger.info('dump_consistent is set, dumping each database from a single snapshot')
+
+    import_args = {
+        'batch_size': conf.getint('import_batch_size', fallback=1000),
+        'writers': conf.getint('import_writers', fallback=2),
+        'queue_size': conf.getint('import_queue_size', fallback=8),
+        'index_mode': conf.get('import_index_mode', 'before'),
+        'capture_filter': CaptureFilter(conf)
+    }
+    stream = conf.getboolean('dump_stream', fallback=True)
+    spool_dir = conf.get('dump_spool_dir', '')
+
     for db in conf['databases'].split(','):
+        if stream:
+            try:
+                mysqldump_import_stream(conf, db, dump_type, mongodb, import_args, spool_dir)
+            except Exception as e:
+                raise SysException(e)
+            continue
+
         try:
             dump_file = mysqldump_cmd(conf, db, dump_type=dump_type)
         except Exception as e:
             raise SysException(e)
 
-        if dump_type == 'data':
-            try:
-                mysqldump_parser_data(dump_file, mongodb)
-            except Exception as e:
-                raise SysException(e)
+        try:
+            mysqldump_import(dump_file, mongodb, dump_type, import_args)
+        except Exception as e:
+            raise SysException(e)
+        finally:
+            os.remove(dump_file)
 
-        if dump_type == 'schema':
-            try:
-                mysqldump_parser_schema(dump_file, mongodb)
-            except Exception as e:
-                raise SysException(e)
+    return True
 
-        if dump_type == 'complete':
-            try:
-                mysqldump_parser_schema(dump_file, mongodb)
-            except Exception as e:
-                raise SysException(e)
 
+def run_mysqldump_parallel(dump_type, conf, mongodb, mongo_conf):
+    """Import the databases running one mysqldump per table in a pool of worker processes
+
+    The binlog position for the replicator is read under a global read lock, released before starting the
+    dumps. Every table is dumped from its own snapshot, so the changes made while dumping are replayed by the
+    replicator on rows already imported. The replay is idempotent only for tables with a primary key, the
+    import is refused if a table of a data dump has none. The tables excluded from the binlog capture are not
+    dumped. If the dump of a table fails the import stops and the binlog position is not saved.
+
+    Args:
+        dump_type (str): schema, data or complete
+        conf (dict): mysql connection and dump parameters
+        mongodb (object): :class:`.MyMongoDB` instance
+        mongo_conf (dict): mongodb connection parameters, used by the worker processes
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    import_args = {
+        'batch_size': conf.getint('import_batch_size', fallback=1000),
+        'writers': conf.getint('import_writers', fallback=2),
+        'queue_size': conf.getint('import_queue_size', fallback=8),
+        'index_mode': conf.get('import_index_mode', 'before'),
+        'capture_filter': CaptureFilter(conf)
+    }
+    dbs = conf['databases'].split(',')
+
+    try:
+        conn = pymysql.connect(host=conf['host'], port=conf.getint('port'), user=conf['user'],
+                               passwd=conf['password'])
+    except Exception as e:
+        raise SysException(e)
+
+    try:
+        tasks = list()
+        cur = conn.cursor()
+        for db in dbs:
+            cur.execute("SHOW FULL TABLES FROM `" + db + "` WHERE Table_type = 'BASE TABLE'")
+            for row in cur.fetchall():
+                if import_args['capture_filter'].table_allowed(db, row[0]):
+                    tasks.append((dict(conf), db, row[0], dump_type, import_args))
+
+        if dump_type in ['data', 'complete']:
+            no_key = list()
+            for task in tasks:
+                cur.execute("SHOW KEYS FROM `" + task[1] + "`.`" + task[2] + "` WHERE Key_name = 'PRIMARY'")
+                if len(cur.fetchall()) == 0:
+                    no_key.append(task[1] + '.' + task[2])
+            if len(no_key) > 0:
+                raise SysException('Cannot dump tables without primary key in parallel, set dump_consistent or '
+                                   'dump_workers = 1: ' + ', '.join(no_key))
+
+        cur.execute('FLUSH TABLES WITH READ LOCK')
+        cur.execute('SHOW MASTER STATUS')
+        master = cur.fetchone()
+        cur.execute('UNLOCK TABLES')
+
+        if dump_type in ['data', 'complete']:
+            for db in dbs:
+                mongodb.drop_db(db)
+
+        logger.info('Dumping ' + str(len(tasks)) + ' tables with ' + conf['dump_workers'] + ' workers')
+        pool = Pool(processes=conf.getint('dump_workers'), initializer=init_dump_worker,
+                    initargs=(dict(mongo_conf), ))
+        try:
+            for db, table, elapsed in pool.imap_unordered(mysqldump_import_table, tasks):
+                logger.info('Imported table {0}.{1} in {2:.1f}s'.format(db, table, elapsed))
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        cur.close()
+    except Exception as e:
+        raise SysException(e)
+    finally:
+        conn.close()
+
+    if dump_type in ['data', 'complete'] and master is not None:
+        try:
+            mongodb.write_log_pos(master[0], master[1])
+        except Exception as e:
+            raise SysException(e)
+
+    for db in dbs:
+        for parse_type in ['schema', 'data']:
+            if dump_type not in [parse_type, 'complete']:
+                continue
             try:
-                mysqldump_parser_data(dump_file, mongodb)
+                mongodb.make_db_as_parsed(db, parse_type)
             except Exception as e:
-                raise SysException(e)
+                logger.error('Cannot insert db ' + db + ' as parsed')
 
     return True
 
 
-def process_data_buffer(buf, table, db, mongodb):
-    parser = etree.XMLParser(recover=True)
-    tnode = etree.fromstring(buf, parser=parser)
-    doc = dict()
-    for child in tnode:
-        if child.tag == 'field':
-            doc[child.attrib['name']] = child.text
+dump_worker_mongo = None
+
+
+def init_dump_worker(mongo_conf):
+    """Initialize a worker process of :func:`.run_mysqldump_parallel` with its own mongo connection
+
+    Args:
+        mongo_conf (dict): mongodb connection parameters
+
+    """
+    global dump_worker_mongo
+    parser = configparser.ConfigParser()
+    parser['mongodb'] = mongo_conf
+    dump_worker_mongo = MyMongoDB(parser['mongodb'])
+
+
+def mysqldump_import_table(task):
+    """Dump a single table and import it, reading the mysqldump output while it is produced
+
+    Args:
+        task (tuple): mysql parameters, database, table, dump type and :class:`.DumpImporter` parameters
 
+    Returns:
+        tuple: database, table and seconds elapsed
+
+    Raises:
+        :class:`.SysException`
+
+    """
+    conf, db, table, dump_type, import_args = task
+    start = time.time()
+    dumpcommand = mysqldump_command(conf, db, dump_type, table=table)
+    errors = TemporaryFile()
     try:
-        mongodb.insert(doc, db, table)
+        p1 = subprocess.Popen(dumpcommand, stdout=subprocess.PIPE, stderr=errors)
     except Exception as e:
+        errors.close()
         raise SysException(e)
 
-    del tnode
+    importer = DumpImporter(dump_worker_mongo, schema=dump_type in ['schema', 'complete'],
+                            data=dump_type in ['data', 'complete'], drop_db=False, **import_args)
+    try:
+        importer.run(p1.stdout, mysqldump_verifier(p1, errors, 'table ' + db + '.' + table))
+    finally:
+        p1.stdout.close()
+        p1.wait()
+        errors.close()
+
+    return db, table, time.time() - start
+
+
+def mysqldump_verifier(p1, errors, name):
+    """Build the check of a mysqldump process run by :meth:`.DumpImporter.run` before saving its state
+
+    Args:
+        p1 (object): mysqldump process, its stdout read to the end
+        errors (object): file where the process writes its stderr
+        name (str): database or table dumped, for the error message
+
+    Returns:
+        callable: function raising :class:`.SysException` if mysqldump failed
+
+    """
+    def verify():
+        p1.wait()
+        errors.seek(0)
+        message = errors.read().decode('utf-8', 'replace').strip()
+        if p1.returncode != 0:
+            raise SysException('mysqldump of ' + name + ' exited with code ' + str(p1.returncode) + ': ' + message)
+        if message != '':
+            logger.warning('mysqldump of ' + name + ': ' + message)
+
+    return verify
+
+
+def mysqldump_import(dump_file, mongodb, dump_type, import_args=None, verify=None):
+    """Import a mysqldump xml output in a single pass
 
+    Args:
+        dump_file: path or file object of the mysqldump xml output
+        mongodb (object): :class:`.MyMongoDB` instance
+        dump_type (str): schema, data or complete
+        import_args (Optional[dict]): :class:`.DumpImporter` parameters. Default to None
+        verify (Optional[callable]): check of the dump run before saving the binlog position and marking the
+            databases as parsed. Default to None
 
-def process_schema_buffer(buf, table, db, mongodb):
-    parser = etree.XMLParser(recover=True)
-    tnode = etree.fromstring(buf, parser=parser)
-    doc = dict()
-    doc['_id'] = db + '.' + table
-    doc['primary_key'] = []
-    doc['table'] = table
-    doc['db'] = db
-    for child in tnode:
-        if child.tag == 'field':
-            if child.attrib['Key'] == 'PRI':
-                doc['primary_key'].append(child.attrib['Field'])
+    Raises:
+        :class:`.SysException`
 
+    """
+    if import_args is None:
+        import_args = dict()
+
+    schema = dump_type in ['schema', 'complete']
+    data = dump_type in ['data', 'complete']
+    importer = DumpImporter(mongodb, schema=schema, data=data, **import_args)
     try:
-        mongodb.insert_primary_key(doc)
+        dbs = importer.run(dump_file, verify)
     except Exception as e:
         raise SysException(e)
 
-    del tnode
-
-
-def mysqldump_parser_data(dump_file, mongodb):
-    inputbuffer = ''
-    db_start = re.compile(r'.*<database name.*', re.IGNORECASE)
-    tb_start = re.compile(r'.*<table_data.*', re.IGNORECASE)
-    row_start = re.compile(r'.*<row>.*', re.IGNORECASE)
-    row_end = re.compile(r'.*</row>.*', re.IGNORECASE)
-    master_log = re.compile(r'.*CHANGE MASTER.*', re.IGNORECASE)
-    db = ''
-    table = ''
-    log_file = None
-    log_pos = None
-
-    with open(dump_file, 'r') as inputfile:
-        append = False
-        for line in inputfile:
-            if row_start.match(line):
-                # print('start')
-                inputbuffer = line
-                append = True
-            elif row_end.match(line):
-                # print('end')
-                inputbuffer += line
-                append = False
-                process_data_buffer(inputbuffer, table, db, mongodb)
-                inputbuffer = None
-                del inputbuffer
-            elif append:
-                # print('elif')
-                inputbuffer += line
-            elif db_start.match(line):
-                db = re.findall('name="(.*?)"', line, re.DOTALL)[0]
-                try:
-                    mongodb.drop_db(db)
-                except Exception as e:
-                    raise SysException(e)
-            elif tb_start.match(line):
-                table = re.findall('name="(.*?)"', line, re.DOTALL)[0]
-            elif master_log.match(line):
-                log_file = re.findall("MASTER_LOG_FILE='(.*?)'", line, re.DOTALL)[0]
-                log_pos = re.findall("MASTER_LOG_POS=(.*?);", line, re.DOTALL)[0]
-
-    if log_file is not None and log_pos is not None:
-        try:
-            mongodb.write_log_pos(log_file, log_pos)
-        except Exception as e:
-            raise SysException(e)
+    for db in dbs:
+        for parse_type, parsed in [('schema', schema), ('data', data)]:
+            if not parsed:
+                continue
+            try:
+                mongodb.make_db_as_parsed(db, parse_type)
+            except Exception as e:
+                logger.error('Cannot insert db ' + db + ' as parsed')
 
-    try:
-        mongodb.make_db_as_parsed(db, 'data')
-    except Exception as e:
-        logger.error('Cannot insert db ' + db + ' as parsed')
 
+def mysqldump_import_stream(conf, db, dump_type, mongodb, import_args=None, spool_dir=''):
+    """Import a database reading the mysqldump output while it is produced
 
-def mysqldump_parser_schema(dump_file, mongodb):
-    inputbuffer = ''
-    db_start = re.compile(r'.*<database name.*', re.IGNORECASE)
-    tb_start = re.compile(r'.*<table_structure.*', re.IGNORECASE)
-    tb_end = re.compile(r'.*</table_structure.*', re.IGNORECASE)
-    db = ''
-    table = ''
-
-    with open(dump_file, 'r') as inputfile:
-        append = False
-        for line in inputfile:
-            if tb_start.match(line):
-                # print('start')
-                inputbuffer = line
-                append = True
-                table = re.findall('name="(.*?)"', line, re.DOTALL)[0]
-            elif tb_end.match(line):
-                # print('end')
-                inputbuffer += line
-                append = False
-                process_schema_buffer(inputbuffer, table, db, mongodb)
-                inputbuffer = None
-                del inputbuffer
-            elif append:
-                # print('elif')
-                inputbuffer += line
-            elif db_start.match(line):
-                db = re.findall('name="(.*?)"', line, re.DOTALL)[0]
+    When ``spool_dir`` is set the output is also copied to a spool file in that directory, so a failed import
+    can be retried without running mysqldump again. The spool file is removed at the end.
+
+    Args:
+        conf (dict): mysql connection parameters
+        db (str): database name
+        dump_type (str): schema, data or complete
+        mongodb (object): :class:`.MyMongoDB` instance
+        import_args (Optional[dict]): :class:`.DumpImporter` parameters. Default to None
+        spool_dir (Optional[str]): directory of the spool file. Default to '', no spool
+
+    Raises:
+        :class:`.SysException`
 
+    """
+    dumpcommand = mysqldump_command(conf, db, dump_type)
+    logger.debug('executing: {0}'.format(' '.join(dumpcommand)))
+    errors = TemporaryFile()
     try:
-        mongodb.make_db_as_parsed(db, 'schema')
+        p1 = subprocess.Popen(dumpcommand, stdout=subprocess.PIPE, stderr=errors)
     except Exception as e:
-        logger.error('Cannot insert db ' + db + ' as parsed')
-    # TODO add index from mysql schema
+        errors.close()
+        raise SysException(e)
+    verify = mysqldump_verifier(p1, errors, 'db ' + db)
 
+    source = p1.stdout
+    spool = None
+    if spool_dir != '':
+        spool = NamedTemporaryFile(dir=spool_dir, delete=False)
+        source = SpoolReader(p1.stdout, spool)
 
-def mysqldump_cmd(conf, db, dump_type):
-    dump_file = NamedTemporaryFile(delete=False)
+    try:
+        try:
+            mysqldump_import(source, mongodb, dump_type, import_args, verify)
+        except Exception as e:
+            if spool is None:
+                raise
+            logger.error('Import of db ' + db + ' failed, retrying from spool file ' + spool.name +
+                         '. Error: ' + str(e))
+            source.drain()
+            mysqldump_import(spool.name, mongodb, dump_type, import_args, verify)
+    finally:
+        p1.stdout.close()
+        p1.wait()
+        errors.close()
+        if spool is not None:
+            spool.close()
+            os.remove(spool.name)
+
+
+def mysqldump_parser_data(dump_file, mongodb, batch_size=1000, writers=2, queue_size=8):
+    import_args = {'batch_size': batch_size, 'writers': writers, 'queue_size': queue_size}
+    mysqldump_import(dump_file, mongodb, 'data', import_args)
+
+
+def mysqldump_parser_schema(dump_file, mongodb):
+    mysqldump_import(dump_file, mongodb, 'schema')
+
+
+def mysqldump_command(conf, db, dump_type, table=None):
     dumpcommand = ['mysqldump',
                     '--user=' + conf['user'],
                     '--host=' + conf['host'],
                     '--port=' + conf['port'],
                     '--force',
+                    '--hex-blob',
                     '--xml',
-                    '--master-data=2']
+                    '--single-transaction']
+    if table is None:
+        # the binlog position is read with the snapshot of the dump
+        dumpcommand.append('--master-data=2')
     if conf['password'] != '':
         dumpcommand.append('--password=' + conf['password'])
     if dump_type == 'schema':
@@ -220,6 +382,15 @@ def mysqldump_cmd(conf, db, dump_type):
         dumpcommand.append('--no-create-db')
         dumpcommand.append('--no-create-info')
     dumpcommand.append(db)
+    if table is not None:
+        dumpcommand.append(table)
+
+    return dumpcommand
+
+
+def mysqldump_cmd(conf, db, dump_type):
+    dump_file = NamedTemporaryFile(delete=False)
+    dumpcommand = mysqldump_command(conf, db, dump_type)
 
     logger.debug('executing: {0}'.format(' '.join(dumpcommand)))
 
@@ -229,10 +400,39 @@ def mysqldump_cmd(conf, db, dump_type):
         except Exception as e:
             raise SysException(e)
     p1.wait()
+    if p1.returncode != 0:
+        os.remove(dump_file.name)
+        raise SysException('mysqldump of db ' + db + ' exited with code ' + str(p1.returncode))
 
     return dump_file.name
 
-    # TODO save log_pos to mongo to start from here with replicator
+
+class SpoolReader:
+    """File object reading a pipe and copying what is read to a spool file
+
+    Args:
+        pipe (object): file object to read
+        spool (object): file object where the data read is copied
+
+    """
+    def __init__(self, pipe, spool):
+        self.pipe = pipe
+        self.spool = spool
+
+    def read(self, size=-1):
+        data = self.pipe.read(size)
+        self.spool.write(data)
+        return data
+
+    def drain(self):
+        """Copy to the spool file what is left in the pipe
+
+        """
+        while True:
+            data = self.read(1024 * 1024)
+            if not data:
+                break
+        self.spool.flush()
 
 
 class LoggerWriter:
@@ -9,6 +9,8 @@ import logging.config
 
 
 from mymongolib import utils
+from mymongolib.asyncmunging import check_engine
+from mymongolib.exceptions import SysException
 from mymongolib.mongodb import MyMongoDB
 from mymongolib.mymongodaemon import MyMongoDaemon
 from mymongolib.utils import LoggerWriter
@@ -29,7 +31,8 @@ if __name__ == '__main__':
     mongo = MyMongoDB(config['mongodb'])
     if args.mysqldump_data:
         try:
-            utils.run_mysqldump(dump_type='data', conf=config['mysql'], mongodb=mongo)
+            utils.run_mysqldump(dump_type='data', conf=config['mysql'], mongodb=mongo,
+                                mongo_conf=config['mongodb'])
             logger.info('Data dump procedure ended')
             sys.exit(0)
         except Exception as e:
@@ -37,7 +40,8 @@ if __name__ == '__main__':
             sys.exit(1)
     elif args.mysqldump_schema:
         try:
-            utils.run_mysqldump(dump_type='schema', conf=config['mysql'], mongodb=mongo)
+            utils.run_mysqldump(dump_type='schema', conf=config['mysql'], mongodb=mongo,
+                                mongo_conf=config['mongodb'])
             logger.info('Schema dump procedure ended')
             sys.exit(0)
         except Exception as e:
@@ -45,13 +49,21 @@ if __name__ == '__main__':
             sys.exit(1)
     elif args.mysqldump_complete:
         try:
-            utils.run_mysqldump(dump_type='complete', conf=config['mysql'], mongodb=mongo)
+            utils.run_mysqldump(dump_type='complete', conf=config['mysql'], mongodb=mongo,
+                                mongo_conf=config['mongodb'])
             logger.info('Complete dump procedure ended')
             sys.exit(0)
         except Exception as e:
             logger.error('Complete dump procedure ended with errors: ' + str(e))
             sys.exit(1)
 
+    if args.start or args.restart:
+        try:
+            check_engine(config['datamunging'])
+        except SysException as e:
+            logger.error(str(e))
+            sys.exit(1)
+
     log_err = LoggerWriter(logger, logging.ERROR)
     mymongo_daemon = MyMongoDaemon(config['general']['pid_file'], log_err=log_err)
     if args.start:
@@ -0,0 +1,169 @@
+import configparser
+import time
+
+import mongomock
+import pytest
+from pymysqlreplication.row_event import DeleteRowsEvent, UpdateRowsEvent, WriteRowsEvent
+
+from mymongolib.mongodb import MyMongoDB
+from mymongolib.mysql import STMT_END_F
+
+# mysqldump --xml --master-data=2 output of database db
+DUMP = b"""<?xml version="1.0"?>
+<mysqldump xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<!--
+CHANGE MASTER TO MASTER_LOG_FILE='mysql-bin.000003', MASTER_LOG_POS=154;
+-->
+<database name="db">
+  <table_structure name="users">
+    <field Field="id" Type="int(11)" Null="NO" Key="PRI" />
+    <field Field="name" Type="varchar(20)" Null="YES" Key="" />
+    <field Field="password" Type="varchar(20)" Null="YES" Key="" />
+    <key Table="users" Non_unique="0" Key_name="PRIMARY" Seq_in_index="1" Column_name="id" />
+  </table_structure>
+  <table_data name="users">
+    <row><field name="id">1</field><field name="name">a</field><field name="password">x</field></row>
+    <row><field name="id">2</field><field name="name">b</field><field name="password">y</field></row>
+  </table_data>
+  <table_structure name="audit_log">
+    <field Field="id" Type="int(11)" Null="NO" Key="PRI" />
+    <key Table="audit_log" Non_unique="0" Key_name="PRIMARY" Seq_in_index="1" Column_name="id" />
+  </table_structure>
+  <table_data name="audit_log">
+    <row><field name="id">1</field></row>
+  </table_data>
+</database>
+</mysqldump>
+"""
+
+EVENT_CLASSES = {event_type: type('Test' + base.__name__, (base, ), {'rows': None, '__init__': lambda self: None})
+                 for event_type, base in (('insert', WriteRowsEvent), ('update', UpdateRowsEvent),
+                                          ('delete', DeleteRowsEvent))}
+
+
+class StopWorker(Exception):
+    """Raised to stop the infinite loop of a data munging worker in the tests
+
+    """
+
+
+class FakeCursor:
+    """Cursor of a mysql server with the tables of database db, some of them with a primary key, two rows each
+
+    """
+    def __init__(self, tables, keyed, executed):
+        self.tables = tables
+        self.keyed = keyed
+        self.executed = executed
+        self.result = []
+
+    def execute(self, sql):
+        self.executed.append(sql)
+        if sql.startswith('SHOW FULL TABLES'):
+            self.result = [(table, 'BASE TABLE') for table in self.tables]
+        elif sql.startswith('SHOW KEYS'):
+            table = sql.split('`')[3]
+            self.result = [(table, 0, 'PRIMARY')] if table in self.keyed else []
+        elif sql.startswith('SHOW MASTER STATUS'):
+            self.result = [('mysql-bin.000001', 4)]
+        elif sql.startswith('SELECT COUNT(*)'):
+            self.result = [(2, )]
+        else:
+            self.result = []
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0] if len(self.result) > 0 else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.fake_cursor = cursor
+
+    def cursor(self):
+        return self.fake_cursor
+
+    def close(self):
+        pass
+
+
+def make_conf(mongodb=None, datamunging=None, mysql=None, scheduler=None):
+    """Build the configuration sections used by the tests
+
+    """
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'mongodb': dict({'host': '', 'port': '', 'user': '', 'password': '', 'utildb': 'utils',
+                         'id_mode': 'objectid'}, **(mongodb or {})),
+        'datamunging': dict({'pipeline': 'queue', 'apply_mode': 'bulk', 'batch_size': '100',
+                             'update_mode': 'delta', 'coalesce': 'True', 'idle_timeout': '0',
+                             'state_interval': '0'}, **(datamunging or {})),
+        'mysql': dict({'databases': 'db'}, **(mysql or {})),
+        'scheduler': dict(scheduler or {}),
+    })
+
+    return config
+
+
+def add_table(mongo, schema, table, primary_key=('id', ), columns=None):
+    """Save the structure of a table like the schema import does
+
+    """
+    columns = columns or [[k, 'int(11)'] for k in primary_key]
+    indexes = [{'name': 'PRIMARY', 'keys': list(primary_key), 'unique': True}] if len(primary_key) > 0 else []
+    mongo.insert_primary_key({'_id': schema + '.' + table, 'primary_key': list(primary_key), 'columns': columns,
+                              'indexes': indexes, 'table': table, 'db': schema})
+    for index in indexes:
+        mongo.create_index(index['keys'], schema, table, name=index['name'], unique=index['unique'])
+
+
+def rows_event(event_type, rows, schema='db', table='t', primary_key='id'):
+    """Build a binlog rows event from python values instead of a binlog packet
+
+    """
+    event = EVENT_CLASSES[event_type]()
+    event.schema = schema
+    event.table = table
+    event.primary_key = primary_key
+    if event_type == 'update':
+        event.rows = [{'before_values': before, 'after_values': after} for before, after in rows]
+    else:
+        event.rows = [{'values': values} for values in rows]
+    event.flags = STMT_END_F
+    event.timestamp = time.time()
+
+    return event
+
+
+def run_once(munging):
+    """Apply what is in the replicator queue with a worker, stopping it when it waits for new records
+
+    """
+    def stop():
+        raise StopWorker()
+
+    munging.wait_for_entries = stop
+    try:
+        munging.run()
+    except StopWorker:
+        pass
+
+
+@pytest.fixture
+def client():
+    return mongomock.MongoClient()
+
+
+@pytest.fixture
+def config():
+    return make_conf()
+
+
+@pytest.fixture
+def mongo(client, config):
+    return MyMongoDB(config['mongodb'], client)
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from mymongolib import asyncmunging
+from mymongolib.asyncmunging import AsyncDataMunging, check_engine
+from mymongolib.exceptions import SysException
+
+from .conftest import add_table, make_conf, run_once
+
+
+class AsyncCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args):
+        self.cursor = self.cursor.sort(*args)
+        return self
+
+    async def to_list(self, length):
+        await asyncio.sleep(0)
+        return list(self.cursor[0:length])
+
+
+class AsyncCollection:
+    """Motor collection running the operations on a mongomock collection, yielding to the event loop first
+
+    """
+    def __init__(self, coll):
+        self.coll = coll
+
+    def find(self, query):
+        return AsyncCursor(self.coll.find(query))
+
+    async def bulk_write(self, requests, ordered=True):
+        await asyncio.sleep(0)
+        return self.coll.bulk_write(requests, ordered=ordered)
+
+    async def delete_many(self, query):
+        await asyncio.sleep(0)
+        return self.coll.delete_many(query)
+
+
+class AsyncClient:
+    def __init__(self, client):
+        self.client = client
+
+    def __getitem__(self, name):
+        db = self.client[name]
+
+        class AsyncDatabase:
+            def __getitem__(self, coll):
+                return AsyncCollection(db[coll])
+
+        return AsyncDatabase()
+
+
+def test_busy_async_worker_reports_its_progress(monkeypatch, client, mongo):
+    class Motor:
+        @staticmethod
+        def AsyncIOMotorClient(conn_string):
+            return AsyncClient(client)
+
+    monkeypatch.setattr(asyncmunging, 'motor_asyncio', Motor)
+    add_table(mongo, 'db', 't')
+    mongo.write_many_to_queue([{'event_type': 'insert', 'values': {'id': i}, 'schema': 'db', 'table': 't',
+                                'partition': 0} for i in range(10)])
+    saved = list()
+    write_apply_state = mongo.write_apply_state
+
+    def saving(partition, seqnum=None, progress=None):
+        saved.append(seqnum)
+        write_apply_state(partition, seqnum, progress)
+
+    mongo.write_apply_state = saving
+    conf = make_conf(datamunging={'engine': 'async', 'batch_size': '2', 'max_in_flight': '2'})['datamunging']
+
+    run_once(AsyncDataMunging(mongo, None, conf, 0))
+
+    # progress reported while batches were still read, before the queue drained
+    assert len(set(seqnum for seqnum in saved[:-1] if seqnum is not None)) > 1
+    assert saved[-1] == 10
+    assert mongo.count_queue() == 0
+
+
+def test_async_engine_without_motor_is_refused_at_config_load(monkeypatch):
+    monkeypatch.setattr(asyncmunging, 'motor_asyncio', None)
+
+    check_engine(make_conf(datamunging={'engine': 'sync'})['datamunging'])
+    with pytest.raises(SysException):
+        check_engine(make_conf(datamunging={'engine': 'async'})['datamunging'])
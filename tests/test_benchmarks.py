@@ -0,0 +1,47 @@
+import argparse
+import io
+
+import pytest
+
+from benchmarks import dump_import, gen_mysqldump, replication
+from mymongolib.dumpimport import DumpImporter
+
+
+@pytest.mark.parametrize('pipeline', ['queue', 'direct'])
+def test_replication_benchmark_applies_all_the_events(pipeline):
+    args = replication.parse_args(['--events', '300', '--rows-per-event', '2', '--workers', '2', '--hot-keys', '5',
+                                   '--pipeline', pipeline, '--flush-rows', '50', '--timeout', '30'])
+
+    results = replication.run(args)
+
+    assert results['applied']
+    assert results['events'] == 300 and results['rows'] >= 300
+    assert results['mongo_ops'] > 0
+
+
+def test_generated_dump_imports_the_rows_and_keys(mongo):
+    parser = argparse.ArgumentParser()
+    gen_mysqldump.add_arguments(parser)
+    args = parser.parse_args(['--tables', '2', '--rows', '30', '--columns', '6'])
+    out = io.StringIO()
+
+    assert gen_mysqldump.DumpGenerator(args).write(out) == 60
+
+    importer = DumpImporter(mongo, schema=True, drop_db=False, writers=1)
+    assert importer.run(io.BytesIO(out.getvalue().encode('utf-8'))) == ['mymongo_bench1']
+    for table in ['t1', 't2']:
+        coll = mongo.get_coll(table, 'mymongo_bench1')
+        assert coll.count_documents({}) == 30
+        assert sorted(coll.index_information()) == ['PRIMARY', '_id_', 'ix_c1']
+    assert mongo.get_log_pos()['log_file'] == 'mysql-bin.000001'
+
+
+def test_dump_import_benchmark_reports_both_modes():
+    args = dump_import.parse_args(['--tables', '1', '--rows', '200', '--batch-size', '50'])
+
+    results = dump_import.run(args)
+
+    assert results['rows'] == 200
+    for mode in ['parse', 'write']:
+        assert 'error' not in results[mode]
+        assert results[mode]['rows_per_second'] > 0
@@ -0,0 +1,291 @@
+import logging
+import queue
+import threading
+import time
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from mymongolib.datamunging import DataMunging
+from mymongolib.exceptions import SysException
+from mymongolib.maintenance import Maintenance
+from mymongolib.mongodb import MyMongoDB
+
+from .conftest import StopWorker, add_table, make_conf, run_once
+
+
+def failing_table(mongo, table):
+    """Make every bulk write to a collection fail like a write error on its first operation
+
+    """
+    bulk_write = mongo.bulk_write
+
+    def failing(requests, schema, collection, ordered=True):
+        if collection == table:
+            raise SysException(BulkWriteError({'writeErrors': [{'index': 0, 'errmsg': 'failed'}]}))
+        return bulk_write(requests, schema, collection, ordered)
+
+    mongo.bulk_write = failing
+
+
+def test_watermark_stops_at_failed_record_with_coalescing(mongo, config):
+    add_table(mongo, 'db', 't')
+    add_table(mongo, 'db', 'u')
+    mongo.write_many_to_queue([
+        {'event_type': 'insert', 'values': {'id': 1, 'v': 1}, 'schema': 'db', 'table': 't', 'partition': 0},
+        {'event_type': 'insert', 'values': {'id': 1}, 'schema': 'db', 'table': 'u', 'partition': 0},
+        {'event_type': 'update', 'values': {'before': {'id': 1, 'v': 1}, 'after': {'id': 1, 'v': 2}},
+         'schema': 'db', 'table': 't', 'partition': 0},
+    ])
+    failing_table(mongo, 'u')
+
+    run_once(DataMunging(mongo, None, config['datamunging'], 0))
+
+    assert mongo.get_apply_state()[0]['seqnum'] == 1
+    Maintenance(mongo, config['scheduler'], config['mysql'], 1).compact_queue()
+    assert [r['seqnum'] for r in mongo.get_from_queue(10, 0)] == [2]
+    assert mongo.get_coll('t', 'db').find_one({'id': 1})['v'] == 2
+
+
+def test_coalesce_does_not_modify_the_records(mongo, config):
+    add_table(mongo, 'db', 't')
+    munging = DataMunging(mongo, None, config['datamunging'], 0)
+    records = [
+        {'_id': 'a', 'seqnum': 1, 'event_type': 'insert', 'values': {'id': 1, 'v': 1}, 'schema': 'db', 'table': 't'},
+        {'_id': 'b', 'seqnum': 2, 'event_type': 'update', 'values': {'before': {'id': 1, 'v': 1},
+                                                                     'after': {'id': 1, 'v': 2}},
+         'schema': 'db', 'table': 't'},
+    ]
+
+    events, dropped = munging.coalesce_events(records)
+
+    assert records[0]['seqnum'] == 1 and 'coalesced' not in records[0]
+    assert records[0]['values'] == {'id': 1, 'v': 1}
+    assert len(events) == 1 and events[0]['seqnum'] == 2 and events[0]['coalesced'] == ['b']
+    assert events[0]['values'] == {'id': 1, 'v': 2} and dropped == []
+
+
+def counting_writes(mongo):
+    """Count the write operations sent to mongo
+
+    """
+    writes = list()
+    bulk_write = mongo.bulk_write
+
+    def counting(requests, schema, collection, ordered=True):
+        writes.extend(requests)
+        return bulk_write(requests, schema, collection, ordered)
+
+    mongo.bulk_write = counting
+
+    return writes
+
+
+def update(before, after, table='t'):
+    return {'event_type': 'update', 'values': {'before': before, 'after': after}, 'schema': 'db', 'table': table,
+            'partition': 0}
+
+
+def test_insert_and_updates_are_applied_as_one_insert(mongo, config):
+    add_table(mongo, 'db', 't')
+    mongo.write_many_to_queue([
+        {'event_type': 'insert', 'values': {'id': 1, 'v': 1}, 'schema': 'db', 'table': 't', 'partition': 0},
+        update({'id': 1, 'v': 1}, {'id': 1, 'v': 2}),
+        update({'id': 1, 'v': 2}, {'id': 1, 'v': 3}),
+    ])
+    writes = counting_writes(mongo)
+
+    run_once(DataMunging(mongo, None, config['datamunging'], 0))
+
+    assert len(writes) == 1
+    assert [doc['v'] for doc in mongo.get_coll('t', 'db').find({'id': 1})] == [3]
+    assert mongo.count_queue() == 0
+    assert mongo.get_apply_state()[0]['seqnum'] == 3
+
+
+def test_insert_and_delete_cancel_out(mongo, config):
+    add_table(mongo, 'db', 't')
+    mongo.write_many_to_queue([
+        {'event_type': 'insert', 'values': {'id': 1, 'v': 1}, 'schema': 'db', 'table': 't', 'partition': 0},
+        update({'id': 1, 'v': 1}, {'id': 1, 'v': 2}),
+        {'event_type': 'delete', 'values': {'id': 1, 'v': 2}, 'schema': 'db', 'table': 't', 'partition': 0},
+    ])
+    writes = counting_writes(mongo)
+
+    run_once(DataMunging(mongo, None, config['datamunging'], 0))
+
+    assert writes == []
+    assert mongo.get_coll('t', 'db').count_documents({}) == 0
+    assert mongo.count_queue() == 0
+    assert mongo.get_apply_state()[0]['seqnum'] == 3
+
+
+def test_primary_key_change_stays_after_the_events_on_the_new_key(mongo, config):
+    add_table(mongo, 'db', 't')
+    mongo.get_coll('t', 'db').insert_many([{'id': 1, 'v': 1}, {'id': 2, 'v': 1}])
+    mongo.write_many_to_queue([
+        update({'id': 1, 'v': 1}, {'id': 1, 'v': 2}),
+        {'event_type': 'delete', 'values': {'id': 2, 'v': 1}, 'schema': 'db', 'table': 't', 'partition': 0},
+        update({'id': 1, 'v': 2}, {'id': 2, 'v': 2}),
+    ])
+
+    run_once(DataMunging(mongo, None, config['datamunging'], 0))
+
+    assert [(doc['id'], doc['v']) for doc in mongo.get_coll('t', 'db').find()] == [(2, 2)]
+
+
+def test_replayed_insert_is_applied_again_with_mongo_ids(mongo, config):
+    add_table(mongo, 'db', 't')
+    insert = {'event_type': 'insert', 'values': {'id': 1, 'v': 1}, 'schema': 'db', 'table': 't', 'partition': 0}
+    mongo.get_coll('t', 'db').insert_one(dict(insert['values']))
+    # replayed after a restart, then updated
+    mongo.write_many_to_queue([
+        insert,
+        {'event_type': 'update', 'values': {'before': {'id': 1, 'v': 1}, 'after': {'id': 1, 'v': 2}},
+         'schema': 'db', 'table': 't', 'partition': 0},
+    ])
+
+    run_once(DataMunging(mongo, None, config['datamunging'], 0))
+
+    assert mongo.get_apply_state()[0]['seqnum'] == 2
+    assert [doc['v'] for doc in mongo.get_coll('t', 'db').find({'id': 1})] == [2]
+
+
+def test_worker_retrying_a_failed_record_is_stuck(mongo, config, caplog):
+    add_table(mongo, 'db', 'u')
+    mongo.write_many_to_queue([{'event_type': 'insert', 'values': {'id': 1}, 'schema': 'db', 'table': 'u',
+                                'partition': 0}])
+    failing_table(mongo, 'u')
+    munging = DataMunging(mongo, None, config['datamunging'], 0)
+    munging.progressed = time.time() - 600
+
+    run_once(munging)
+    maintenance = Maintenance(mongo, make_conf(scheduler={'stuck_timeout': '60'})['scheduler'], config['mysql'], 1)
+    with caplog.at_level(logging.ERROR):
+        maintenance.check_workers()
+
+    # the heartbeat is recent, the applied sequence number did not advance
+    assert time.time() - mongo.get_apply_state()[0]['heartbeat'] < 60
+    assert 'Apply worker 0 stuck' in caplog.text
+
+
+def test_batch_is_applied_with_one_bulk_write_per_collection(mongo):
+    add_table(mongo, 'db', 't')
+    add_table(mongo, 'db', 'u')
+    mongo.write_many_to_queue([
+        {'event_type': 'insert', 'values': {'id': 1, 'v': 1}, 'schema': 'db', 'table': 't', 'partition': 0},
+        {'event_type': 'insert', 'values': {'id': 1}, 'schema': 'db', 'table': 'u', 'partition': 0},
+        update({'id': 1, 'v': 1}, {'id': 1, 'v': 2}),
+        {'event_type': 'delete', 'values': {'id': 1}, 'schema': 'db', 'table': 'u', 'partition': 0},
+    ])
+    calls = list()
+    bulk_write = mongo.bulk_write
+
+    def counting(requests, schema, collection, ordered=True):
+        calls.append((collection, len(requests)))
+        return bulk_write(requests, schema, collection, ordered)
+
+    mongo.bulk_write = counting
+
+    run_once(DataMunging(mongo, None, make_conf(datamunging={'coalesce': 'False'})['datamunging'], 0))
+
+    assert calls == [('t', 2), ('u', 2)]
+    assert [doc['v'] for doc in mongo.get_coll('t', 'db').find({'id': 1})] == [2]
+    assert mongo.get_coll('u', 'db').count_documents({}) == 0
+    assert mongo.count_queue() == 0
+    assert mongo.get_apply_state()[0]['seqnum'] == 4
+
+
+def test_worker_wakes_up_on_the_replicator_notifications(mongo):
+    notifications = queue.Queue()
+    munging = DataMunging(mongo, notifications, make_conf(datamunging={'idle_timeout': '10'})['datamunging'], 0)
+    munging.last_seqnum = 5
+    results = list()
+    waiter = threading.Thread(target=lambda: results.append(munging.wait_for_entries()))
+    waiter.start()
+    time.sleep(0.05)
+    notifications.put({'seqnum': 7})
+    waiter.join(5)
+    assert results == [True]
+
+    # all the pending notifications are consumed, none is above the records applied
+    for seqnum in [4, 5]:
+        notifications.put({'seqnum': seqnum})
+    assert not munging.wait_for_entries()
+    assert notifications.empty()
+
+    munging.idle_timeout = 0.1
+    start = time.time()
+    assert not munging.wait_for_entries()
+    assert time.time() - start < 1
+
+
+def test_primary_key_is_the_mongo_id(client):
+    config = make_conf(mongodb={'id_mode': 'primary_key'}, datamunging={'coalesce': 'False'})
+    mongo = MyMongoDB(config['mongodb'], client)
+    add_table(mongo, 'db', 't')
+    add_table(mongo, 'db', 'c', primary_key=('a', 'b'))
+    insert = {'event_type': 'insert', 'values': {'id': 1, 'v': 1}, 'schema': 'db', 'table': 't', 'partition': 0}
+    mongo.write_many_to_queue([
+        insert,
+        dict(insert),
+        update({'id': 1, 'v': 1}, {'id': 2, 'v': 1}),
+        {'event_type': 'insert', 'values': {'a': 1, 'b': 2}, 'schema': 'db', 'table': 'c', 'partition': 0},
+    ])
+
+    run_once(DataMunging(mongo, None, config['datamunging'], 0))
+
+    # the replayed insert is an upsert, the primary key change moves the document
+    assert [(doc['_id'], doc['v']) for doc in mongo.get_coll('t', 'db').find()] == [(2, 1)]
+    assert [doc['_id'] for doc in mongo.get_coll('c', 'db').find()] == [{'a': 1, 'b': 2}]
+    assert mongo.get_apply_state()[0]['seqnum'] == 4
+
+
+def test_delta_update_sets_only_the_changed_fields(mongo):
+    add_table(mongo, 'db', 't')
+    mongo.get_coll('t', 'db').insert_one({'id': 1, 'v': 1, 'w': 1, 'extra': 'kept'})
+    mongo.write_many_to_queue([
+        update({'id': 1, 'v': 1, 'w': 1}, {'id': 1, 'v': 2, 'w': 1}),
+        # the document is missing, the whole after image is written
+        update({'id': 2, 'v': 1, 'w': 1}, {'id': 2, 'v': 2, 'w': 1}),
+    ])
+
+    run_once(DataMunging(mongo, None, make_conf(datamunging={'coalesce': 'False'})['datamunging'], 0))
+
+    docs = mongo.get_coll('t', 'db').find({}, {'_id': 0}).sort('id')
+    assert list(docs) == [{'id': 1, 'v': 2, 'w': 1, 'extra': 'kept'}, {'id': 2, 'v': 2, 'w': 1}]
+
+
+def test_replace_update_rewrites_the_document(mongo):
+    add_table(mongo, 'db', 't')
+    mongo.get_coll('t', 'db').insert_one({'id': 1, 'v': 1, 'extra': 'dropped'})
+    mongo.write_many_to_queue([update({'id': 1, 'v': 1}, {'id': 1, 'v': 2})])
+
+    run_once(DataMunging(mongo, None, make_conf(datamunging={'update_mode': 'replace'})['datamunging'], 0))
+
+    assert list(mongo.get_coll('t', 'db').find({}, {'_id': 0})) == [{'id': 1, 'v': 2}]
+
+
+def test_direct_worker_acknowledges_the_applied_batches(mongo):
+    add_table(mongo, 'db', 't')
+    batches = queue.Queue()
+    acks = queue.Queue()
+    batches.put({'seqnum': 2, 'generation': 1.0, 'events': [
+        {'_id': 1, 'seqnum': 1, 'event_type': 'insert', 'values': {'id': 1, 'v': 1}, 'schema': 'db', 'table': 't'},
+        {'_id': 2, 'seqnum': 2, 'event_type': 'insert', 'values': {'id': 2, 'v': 1}, 'schema': 'db', 'table': 't'},
+    ]})
+    munging = DataMunging(mongo, batches, make_conf(datamunging={'pipeline': 'direct'})['datamunging'], 0,
+                          ack_queue=acks)
+
+    def stop(seqnum=None):
+        if seqnum is None:
+            raise StopWorker()
+
+    munging.idle_timeout = 0.01
+    munging.save_state = stop
+    with pytest.raises(StopWorker):
+        munging.run()
+
+    assert acks.get_nowait() == {'partition': 0, 'seqnum': 2, 'generation': 1.0}
+    assert mongo.get_coll('t', 'db').count_documents({}) == 2
+    assert 'replicator_queue' not in mongo.mdb['utils'].list_collection_names()
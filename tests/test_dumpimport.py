@@ -0,0 +1,65 @@
+import io
+
+import pytest
+
+from mymongolib.dumpimport import DumpImporter
+from mymongolib.exceptions import SysException
+from mymongolib.mysql import CaptureFilter
+
+from .conftest import DUMP, make_conf
+
+
+def test_import_skips_the_tables_and_columns_not_captured(mongo):
+    conf = make_conf(mysql={'exclude_tables': '*.audit_log', 'exclude_columns': 'db.users.password'})['mysql']
+    importer = DumpImporter(mongo, schema=True, drop_db=False, writers=1, capture_filter=CaptureFilter(conf))
+
+    assert importer.run(io.BytesIO(DUMP)) == ['db']
+    assert sorted((doc['id'], doc['name']) for doc in mongo.get_coll('users', 'db').find()) == [(1, 'a'), (2, 'b')]
+    assert mongo.get_coll('users', 'db').count_documents({'password': {'$exists': True}}) == 0
+    assert mongo.get_coll('audit_log', 'db').count_documents({}) == 0
+    assert mongo.get_primary_key('audit_log', 'db') is None
+
+
+def test_truncated_dump_is_not_committed(mongo):
+    importer = DumpImporter(mongo, schema=True, drop_db=False, writers=1)
+
+    with pytest.raises(SysException):
+        importer.run(io.BytesIO(DUMP[:DUMP.index(b'<table_structure name="audit_log">')]))
+    assert mongo.get_log_pos()['log_pos'] == 'NA'
+
+
+def test_rows_are_inserted_in_batches(mongo):
+    dump = DUMP.replace(b'<field name="password">y</field>', b'<field name="password" xsi:nil="true" />')
+    batches = list()
+    insert_many = mongo.insert_many
+
+    def counting(docs, schema, collection, ordered=True):
+        batches.append((collection, len(docs), ordered))
+        return insert_many(docs, schema, collection, ordered)
+
+    mongo.insert_many = counting
+    importer = DumpImporter(mongo, schema=True, drop_db=False, batch_size=1, writers=2)
+
+    assert importer.run(io.BytesIO(dump)) == ['db']
+    assert sorted(batches) == [('audit_log', 1, False), ('users', 1, False), ('users', 1, False)]
+    users = mongo.get_coll('users', 'db').find()
+    assert sorted((doc['id'], doc['password']) for doc in users) == [(1, 'x'), (2, None)]
+    assert importer.stats[('db', 'users')][0] == 2
+    assert mongo.get_log_pos()['log_file'] == 'mysql-bin.000003'
+    assert mongo.get_log_pos()['log_pos'] == '154'
+
+
+@pytest.mark.parametrize('index_mode', ['before', 'after'])
+def test_mysql_keys_become_mongo_indexes(mongo, index_mode):
+    primary = b'<key Table="users" Non_unique="0" Key_name="PRIMARY" Seq_in_index="1" Column_name="id" />'
+    dump = DUMP.replace(primary, primary +
+                        b'<key Table="users" Non_unique="0" Key_name="login" Seq_in_index="2" Column_name="id" />'
+                        b'<key Table="users" Non_unique="0" Key_name="login" Seq_in_index="1" Column_name="name" />')
+    importer = DumpImporter(mongo, schema=True, drop_db=False, writers=1, index_mode=index_mode)
+
+    importer.run(io.BytesIO(dump))
+
+    indexes = mongo.get_coll('users', 'db').index_information()
+    assert indexes['PRIMARY']['key'] == [('id', 1)] and indexes['PRIMARY']['unique']
+    # mysql unique keys allow many NULLs, a mongo unique index does not
+    assert indexes['login']['key'] == [('name', 1), ('id', 1)] and not indexes['login'].get('unique', False)
@@ -0,0 +1,89 @@
+import logging
+import time
+
+import pymysql
+
+from mymongolib.datamunging import DataMunging
+from mymongolib.maintenance import Maintenance
+from mymongolib.metrics import Metrics, MetricsRegistry
+
+from .conftest import FakeConnection, FakeCursor, add_table, make_conf, run_once
+
+
+def test_row_counts_skip_the_tables_not_captured(monkeypatch, mongo, caplog):
+    executed = list()
+    monkeypatch.setattr(pymysql, 'connect',
+                        lambda **kwargs: FakeConnection(FakeCursor(['users', 'audit_log'], [], executed)))
+    mongo.get_coll('users', 'db').insert_many([{'id': 1}, {'id': 2}])
+    conf = make_conf(mysql={'host': 'localhost', 'port': '3306', 'user': 'root', 'password': '',
+                            'exclude_tables': '*.audit_log'})
+    maintenance = Maintenance(mongo, conf['scheduler'], conf['mysql'], 1)
+
+    with caplog.at_level(logging.WARNING):
+        maintenance.check_row_counts()
+
+    assert 'Row count mismatch' not in caplog.text
+    assert not any('audit_log' in sql for sql in executed if sql.startswith('SELECT COUNT'))
+    assert 'audit_log' not in mongo.mdb['db'].list_collection_names()
+
+
+def test_metrics_snapshot_has_the_primary_key_cache_counters(mongo, config):
+    add_table(mongo, 'db', 't')
+    mongo.write_many_to_queue([
+        {'event_type': 'insert', 'values': {'id': 1}, 'schema': 'db', 'table': 't', 'partition': 0},
+        {'event_type': 'insert', 'values': {'id': 2}, 'schema': 'db', 'table': 't', 'partition': 0},
+    ])
+    registry = MetricsRegistry(4096)
+    metrics = Metrics(registry.create('datamunging-0'))
+    run_once(DataMunging(mongo, None, config['datamunging'], 0, metrics=metrics))
+
+    Maintenance(mongo, config['scheduler'], config['mysql'], 1, metrics_registry=registry).checkpoint_metrics()
+
+    samples = mongo.mdb['utils']['metrics_history'].find_one()['samples']
+    values = dict((sample['name'], sample['value']) for sample in samples)
+    assert values['mymongo_pk_cache_hits_total'] == mongo.pk_cache_hits > 0
+    assert values['mymongo_pk_cache_misses_total'] == mongo.pk_cache_misses
+    assert 'mymongo_pk_cache_hits_total' in registry.render()
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.jobs = dict()
+
+    def add_job(self, func, trigger, args=(), minutes=None, name=None, max_instances=None):
+        self.jobs[name] = minutes
+
+
+def test_jobs_are_scheduled_at_their_intervals(mongo):
+    conf = make_conf(scheduler={'compact_queue_interval': '2', 'check_row_counts_interval': '0'})
+    sched = FakeScheduler()
+    Maintenance(mongo, conf['scheduler'], conf['mysql'], 1, metrics_registry=MetricsRegistry(4096)).add_jobs(sched)
+    assert sched.jobs == {'compact_queue': 2, 'refresh_primary_keys': 60, 'checkpoint_metrics': 5,
+                          'check_workers': 1}
+
+    # without the replicator queue and the metrics there is nothing to compact or checkpoint
+    sched = FakeScheduler()
+    Maintenance(mongo, conf['scheduler'], conf['mysql'], 1, direct=True).add_jobs(sched)
+    assert sorted(sched.jobs) == ['check_workers', 'refresh_primary_keys']
+
+
+def test_failed_job_is_logged(mongo, config, caplog):
+    def job():
+        raise RuntimeError('down')
+
+    with caplog.at_level(logging.ERROR):
+        Maintenance(mongo, config['scheduler'], config['mysql'], 1).timed('compact_queue', job)
+
+    assert 'Cannot run job compact_queue. Error: down' in caplog.text
+
+
+def test_compact_queue_keeps_the_records_not_applied(mongo, config):
+    mongo.write_many_to_queue([{'event_type': 'insert', 'values': {'id': i}, 'schema': 'db', 'table': 't',
+                                'partition': i % 2} for i in range(6)])
+    mongo.write_apply_state(0, 3, time.time())
+    mongo.write_apply_state(1, None, time.time())
+
+    Maintenance(mongo, config['scheduler'], config['mysql'], 2).compact_queue()
+
+    assert [r['seqnum'] for r in mongo.get_from_queue(10, 0)] == [5]
+    assert [r['seqnum'] for r in mongo.get_from_queue(10, 1)] == [2, 4, 6]
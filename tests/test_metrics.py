@@ -0,0 +1,61 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from mymongolib.metrics import Metrics, MetricsRegistry, binlog_number
+
+
+def test_disabled_metrics_do_nothing():
+    metrics = Metrics()
+    metrics.inc('mymongo_events_applied_total')
+    metrics.observe('mymongo_batch_size', 10)
+    metrics.publish(True)
+
+    assert metrics.values == {}
+
+
+def test_process_snapshots_are_merged():
+    registry = MetricsRegistry(4096)
+    for process, lag in [('datamunging_0', 2.0), ('datamunging_1', 5.0)]:
+        metrics = Metrics(registry.create(process))
+        metrics.inc('mymongo_events_applied_total', {'schema': 'db', 'table': 't'}, 3)
+        metrics.observe('mymongo_batch_size', 10, {'stage': 'apply'})
+        metrics.set('mymongo_replication_lag_seconds', lag, {'partition': process[-1]})
+        metrics.publish(True)
+
+    values = registry.collect()
+
+    assert values[('mymongo_events_applied_total', (('schema', 'db'), ('table', 't')))] == 6
+    assert values[('mymongo_replication_lag_seconds', (('partition', '1'), ))] == 5.0
+    # buckets 1, 10, ... and the sum of the observed values
+    assert values[('mymongo_batch_size', (('stage', 'apply'), ))][:3] == [0, 2, 0]
+    assert values[('mymongo_batch_size', (('stage', 'apply'), ))][-1] == 20
+
+
+def test_metrics_endpoint_serves_the_prometheus_text_format():
+    registry = MetricsRegistry(4096)
+    metrics = Metrics(registry.create('replicator'))
+    metrics.observe('mymongo_batch_size', 5, {'stage': 'capture'})
+    metrics.observe('mymongo_batch_size', 500, {'stage': 'capture'})
+    metrics.publish(True)
+    server = registry.serve(port=0)
+    url = 'http://127.0.0.1:' + str(server.server_address[1])
+    try:
+        page = urllib.request.urlopen(url + '/metrics', timeout=5).read().decode('utf-8')
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/other', timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert '# TYPE mymongo_batch_size histogram' in page
+    assert 'mymongo_batch_size_bucket{stage="capture",le="10"} 1' in page
+    assert 'mymongo_batch_size_bucket{stage="capture",le="+Inf"} 2' in page
+    assert 'mymongo_batch_size_count{stage="capture"} 2' in page
+    assert 'mymongo_last_publish_timestamp_seconds{process="replicator"}' in page
+
+
+def test_binlog_number():
+    assert binlog_number('mysql-bin.000042') == 42
+    assert binlog_number(None) == 0
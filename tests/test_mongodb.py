@@ -0,0 +1,84 @@
+from mymongolib.datamunging import DataMunging
+from mymongolib.mongodb import MyMongoDB
+
+from .conftest import add_table, make_conf, run_once
+
+
+def write_rows(mongo, count):
+    return mongo.write_many_to_queue([{'event_type': 'insert', 'values': {'id': i}, 'schema': 'db', 'table': 't',
+                                       'partition': 0} for i in range(count)])
+
+
+def test_seqnum_restarts_above_the_applied_records(client, mongo, config):
+    add_table(mongo, 'db', 't')
+    mongo.init_seqnum()
+    assert write_rows(mongo, 4) == 4
+    run_once(DataMunging(mongo, None, config['datamunging'], 0))
+    assert mongo.count_queue() == 0
+    assert mongo.get_apply_state()[0]['seqnum'] == 4
+
+    restarted = MyMongoDB(config['mongodb'], client)
+    restarted.init_seqnum()
+    assert restarted.next_seqnum() > 4
+
+
+def test_seqnum_restarts_above_the_reserved_numbers(client, mongo, config):
+    add_table(mongo, 'db', 't')
+    mongo.init_seqnum()
+    write_rows(mongo, 4)
+    # applied and removed from the queue before the worker saved its progress
+    mongo.get_coll('replicator_queue', 'utils').delete_many({})
+
+    restarted = MyMongoDB(config['mongodb'], client)
+    restarted.init_seqnum()
+    assert restarted.next_seqnum() > 4
+    assert restarted.get_log_pos()['log_file'] == 'NA'
+
+
+def test_seqnum_reserved_in_blocks(mongo):
+    mongo.seqnum_block = 3
+    mongo.init_seqnum()
+    assert [mongo.next_seqnum() for i in range(7)] == list(range(1, 8))
+    assert mongo.get_log_pos()['seqnum_reserved'] == 9
+
+
+def test_collections_are_cached_per_database(monkeypatch, client, mongo):
+    client['a'].create_collection('t')
+    created = list()
+    create_collection = type(client['b']).create_collection
+
+    def counting(db, name, *args, **kwargs):
+        created.append((db.name, name))
+        return create_collection(db, name, *args, **kwargs)
+
+    monkeypatch.setattr(type(client['b']), 'create_collection', counting)
+    coll = mongo.get_coll('t', 'a')
+    assert mongo.get_coll('t', 'a') is coll
+    mongo.get_coll('t', 'b')
+    mongo.get_coll('t', 'b')
+
+    # the collection already in database a is not created again, the one with the same name in b is
+    assert created == [('b', 't')]
+    assert 't' in client['b'].list_collection_names()
+
+
+def test_dropped_database_collections_are_created_again(mongo):
+    mongo.get_coll('mysqllog', 'db')
+    mongo.drop_db('db')
+
+    assert mongo.get_coll('mysqllog', 'db').find_one({'_id': 'last_log_pos'})['log_pos'] == 'NA'
+
+
+def test_primary_key_cache_is_reloaded_when_invalidated(client, mongo):
+    config = make_conf(mongodb={'pk_cache_ttl': '0'})
+    worker = MyMongoDB(config['mongodb'], client)
+    add_table(mongo, 'db', 't')
+    assert worker.get_primary_key('t', 'db')['primary_key'] == ['id']
+    assert worker.get_primary_key('t', 'db')['primary_key'] == ['id']
+    assert (worker.pk_cache_hits, worker.pk_cache_misses) == (2, 0)
+
+    # a new schema dump changes the key, the worker sees it once the cache is invalidated
+    mongo.insert_primary_key({'_id': 'db.t', 'primary_key': ['id', 'v'], 'table': 't', 'db': 'db'})
+    assert worker.get_primary_key('t', 'db')['primary_key'] == ['id']
+    mongo.invalidate_primary_keys()
+    assert worker.get_primary_key('t', 'db')['primary_key'] == ['id', 'v']
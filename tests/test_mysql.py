@@ -0,0 +1,166 @@
+import multiprocessing
+import queue
+import threading
+import time
+
+import pytest
+
+from mymongolib.exceptions import SysException
+from mymongolib.mysql import BinlogCapture, event_rows, get_partition
+
+from .conftest import add_table, rows_event
+
+
+def direct_capture(mongo, partitions=1, **kwargs):
+    mongo.init_seqnum()
+    return BinlogCapture(mongo, [queue.Queue() for i in range(partitions)], flush_rows=1, flush_interval=0,
+                         ack_queue=queue.Queue(), **kwargs)
+
+
+def test_stale_acks_do_not_checkpoint_new_flushes(mongo):
+    add_table(mongo, 'db', 't')
+    capture = direct_capture(mongo)
+    # acknowledgement of a previous run of the replicator left in the ipc queue
+    capture.ack_queue.put({'partition': 0, 'seqnum': 1000, 'generation': capture.generation - 1})
+
+    capture.add_event(rows_event('insert', [{'id': 1}]), 'mysql-bin.000001', 100)
+    assert len(capture.pending) == 1
+    assert mongo.get_log_pos()['log_pos'] != 100
+
+    msg = capture.queues_out[0].get_nowait()
+    capture.ack_queue.put({'partition': 0, 'seqnum': msg['seqnum'], 'generation': msg['generation']})
+    capture.check_acks()
+    assert len(capture.pending) == 0
+    assert mongo.get_log_pos()['log_pos'] == 100
+
+
+def test_rows_are_written_to_the_queue_in_batches(mongo):
+    add_table(mongo, 'db', 't')
+    mongo.init_seqnum()
+    capture = BinlogCapture(mongo, [queue.Queue()], flush_rows=3, flush_interval=0)
+    writes = list()
+    write_many_to_queue = mongo.write_many_to_queue
+
+    def counting(rows):
+        writes.append(len(rows))
+        return write_many_to_queue(rows)
+
+    mongo.write_many_to_queue = counting
+
+    capture.add_event(rows_event('insert', [{'id': 1}, {'id': 2}]), 'mysql-bin.000001', 100)
+    assert writes == [] and mongo.get_log_pos()['log_pos'] == 'NA'
+
+    event = rows_event('insert', [{'id': 3}])
+    event.flags = 0
+    # the statement is not complete, the flush does not checkpoint its position
+    capture.add_event(event, 'mysql-bin.000001', 200)
+    assert writes == [3] and mongo.get_log_pos()['log_pos'] == 100
+    assert capture.queues_out[0].get_nowait() == {'seqnum': 3}
+
+    capture.add_event(rows_event('insert', [{'id': 4}]), 'mysql-bin.000001', 300)
+    capture.flush()
+    assert writes == [3, 1] and mongo.get_log_pos()['log_pos'] == 300
+    assert [r['values']['id'] for r in mongo.get_from_queue(10, 0)] == [1, 2, 3, 4]
+
+
+def keys_in_partitions(partitions, same):
+    """Two primary keys of table db.t in the same or in different partitions
+
+    """
+    for i in range(2, 100):
+        if (get_partition('db', 't', (1, ), partitions) == get_partition('db', 't', (i, ), partitions)) == same:
+            return 1, i
+
+
+def test_primary_key_change_across_partitions_is_split():
+    old, new = keys_in_partitions(4, same=False)
+    rows = event_rows(rows_event('update', [({'id': old, 'v': 1}, {'id': new, 'v': 1})]), 4)
+
+    assert [(row['event_type'], row['values'], row['partition']) for row in rows] == [
+        ('delete', {'id': old, 'v': 1}, get_partition('db', 't', (old, ), 4)),
+        ('insert', {'id': new, 'v': 1}, get_partition('db', 't', (new, ), 4)),
+    ]
+
+
+def test_primary_key_change_in_the_same_partition_stays_an_update():
+    old, new = keys_in_partitions(4, same=True)
+    rows = event_rows(rows_event('update', [({'id': old, 'v': 1}, {'id': new, 'v': 1})]), 4)
+
+    assert [(row['event_type'], row['partition']) for row in rows] == [
+        ('update', get_partition('db', 't', (new, ), 4))]
+
+
+def test_repartition_keeps_the_rows_of_a_key_together(mongo):
+    mongo.init_seqnum()
+    mongo.write_many_to_queue(event_rows(rows_event('insert', [{'id': i} for i in range(20)]), 4))
+    mongo.write_apply_state(1, 5)
+
+    assert mongo.repartition_queue(3) > 0
+    for record in mongo.get_from_queue(100):
+        assert record['partition'] == get_partition('db', 't', (record['values']['id'], ), 3)
+    assert 'seqnum' not in {state['_id']: state for state in mongo.get_apply_state()}[1]
+
+
+def test_repartition_refuses_records_without_hash(mongo):
+    mongo.init_seqnum()
+    mongo.write_many_to_queue([{'event_type': 'insert', 'values': {'id': 1}, 'schema': 'db', 'table': 't',
+                                'partition': 3}])
+
+    with pytest.raises(SysException):
+        mongo.repartition_queue(2)
+
+
+def test_capture_pauses_before_the_ipc_queues_are_full(mongo):
+    add_table(mongo, 'db', 't')
+    capture = direct_capture(mongo, max_flushes=2)
+    capture.queues_out = [queue.Queue(maxsize=2)]
+    capture.add_event(rows_event('insert', [{'id': 1}]), 'mysql-bin.000001', 100)
+
+    reader = threading.Thread(target=capture.add_event,
+                              args=(rows_event('insert', [{'id': 2}]), 'mysql-bin.000001', 200))
+    reader.daemon = True
+    reader.start()
+    reader.join(0.5)
+    assert capture.paused
+    assert capture.queues_out[0].qsize() == 2
+    # the buffer lock is free while the capture waits for the acknowledgements
+    assert capture.lock.acquire(timeout=0.1)
+    capture.lock.release()
+
+    for i in range(2):
+        msg = capture.queues_out[0].get_nowait()
+        capture.ack_queue.put({'partition': 0, 'seqnum': msg['seqnum'], 'generation': msg['generation']})
+    reader.join(5)
+    assert not reader.is_alive()
+    assert not capture.paused
+    assert mongo.get_log_pos()['log_pos'] == 200
+
+
+def test_reader_hung_on_an_event_stops_the_heartbeats(mongo):
+    add_table(mongo, 'db', 't')
+    heartbeat = multiprocessing.Value('d', 0.0)
+    capture = direct_capture(mongo, heartbeat=heartbeat)
+    hung = threading.Event()
+    release = threading.Event()
+
+    def table_allowed(schema, table):
+        hung.set()
+        release.wait(5)
+        return True
+
+    capture.capture_filter.table_allowed = table_allowed
+    reader = threading.Thread(target=capture.add_event,
+                              args=(rows_event('insert', [{'id': 1}]), 'mysql-bin.000001', 100))
+    reader.daemon = True
+    reader.start()
+    assert hung.wait(5)
+    time.sleep(0.05)
+
+    capture.tick()
+    assert heartbeat.value == capture.progress < time.time() - 0.05
+
+    release.set()
+    reader.join(5)
+    capture.tick()
+    # waiting for the next binlog event
+    assert heartbeat.value > capture.progress
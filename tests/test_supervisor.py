@@ -0,0 +1,60 @@
+import multiprocessing
+import sys
+import time
+
+import pytest
+
+from mymongolib.supervisor import Supervisor
+
+from .conftest import make_conf
+
+
+@pytest.fixture
+def supervisor():
+    config = make_conf()
+    config.read_dict({'supervisor': {'heartbeat_timeout': '10', 'backoff_base': '1', 'backoff_max': '3'}})
+    supervisor = Supervisor(config['supervisor'])
+    yield supervisor
+    for name in supervisor.procs:
+        supervisor.stop(name)
+
+
+def wait_exit(supervisor, name):
+    supervisor.procs[name]['process'].join(5)
+
+
+def test_exited_process_is_restarted_with_backoff(supervisor):
+    supervisor.add('replicator', sys.exit, args=(3, ), restart_with=['datamunging_0'])
+    supervisor.add('datamunging_0', time.sleep, args=(30, ))
+    supervisor.check()
+    worker = supervisor.procs['datamunging_0']['process']
+
+    delays = list()
+    for i in range(3):
+        wait_exit(supervisor, 'replicator')
+        supervisor.check()
+        delays.append(supervisor.procs['replicator']['next_start'] - time.time())
+        supervisor.procs['replicator']['next_start'] = 0
+        supervisor.check()
+
+    assert [round(delay) for delay in delays] == [1, 2, 3]
+    assert supervisor.restarts == {'replicator': 3, 'datamunging_0': 3}
+    # the worker was restarted with the replicator
+    assert not worker.is_alive()
+    assert supervisor.procs['datamunging_0']['process'].is_alive()
+
+
+def test_process_without_heartbeat_is_restarted(supervisor):
+    heartbeat = multiprocessing.Value('d', 0.0)
+    supervisor.add('replicator', time.sleep, args=(30, ), heartbeat=heartbeat)
+    supervisor.check()
+    process = supervisor.procs['replicator']['process']
+    supervisor.check()
+    assert supervisor.restarts['replicator'] == 0
+
+    heartbeat.value = time.time() - 60
+    supervisor.check()
+
+    assert supervisor.restarts['replicator'] == 1
+    assert not process.is_alive()
+    assert supervisor.procs['replicator']['process'] is None
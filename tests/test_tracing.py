@@ -0,0 +1,55 @@
+import configparser
+import logging
+
+from mymongolib.tracing import Tracer
+
+from .conftest import rows_event
+
+
+def tracing_conf(**kwargs):
+    config = configparser.ConfigParser()
+    config.read_dict({'tracing': kwargs})
+
+    return config['tracing']
+
+
+def dumped_event(table):
+    event = rows_event('insert', [{'id': 1}], table=table)
+    event.dumps = 0
+
+    def dump():
+        event.dumps += 1
+        print('event dump')
+
+    event.dump = dump
+
+    return event
+
+
+def test_only_the_traced_tables_are_logged_and_sampled(caplog):
+    tracer = Tracer(tracing_conf(tables='db.t', sample_rate='2'))
+    traced = dumped_event('t')
+    other = dumped_event('u')
+
+    with caplog.at_level(logging.INFO):
+        for i in range(4):
+            tracer.trace_event(traced, 'mysql-bin.000001', i)
+            tracer.trace_event(other, 'mysql-bin.000001', i)
+
+    assert traced.dumps == 2 and other.dumps == 0
+    assert 'db.u' not in caplog.text
+    assert caplog.text.count('db.t event dump') == 2
+
+
+def test_runtime_settings_override_the_traced_tables(mongo, caplog):
+    tracer = Tracer(tracing_conf(tables='', refresh_interval='0'), mongo=mongo)
+    event = dumped_event('t')
+
+    with caplog.at_level(logging.INFO):
+        tracer.trace_event(event, 'mysql-bin.000001', 1)
+        assert caplog.text == ''
+        mongo.get_coll('settings', 'utils').insert_one({'_id': 'tracing', 'tables': ['db.*'], 'sample_rate': 1})
+        tracer.trace_event(event, 'mysql-bin.000001', 2)
+
+    assert 'db.t TestWriteRowsEvent with 1 rows at mysql-bin.000001:2' in caplog.text
+    assert event.dumps == 1
@@ -0,0 +1,41 @@
+import datetime
+import time
+from collections import namedtuple
+
+import pytest
+from pymysqlreplication.constants import FIELD_TYPE
+
+from mymongolib.mysql import event_rows
+from mymongolib.typeconv import TypeConverter
+
+from .conftest import rows_event
+
+Column = namedtuple('Column', ['name', 'type'])
+
+
+@pytest.fixture
+def local_time(monkeypatch):
+    monkeypatch.setenv('TZ', 'Europe/Rome')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_binlog_and_dump_rows_are_converted_alike(local_time):
+    structure = [['id', 'int(11)'], ['created', 'timestamp'], ['tags', "set('a','b')"], ['flags', 'bit(10)']]
+    dump_rows = [{'id': '1', 'created': '2016-07-01 10:00:00', 'tags': '', 'flags': '0x05'},
+                 {'id': '2', 'created': '2016-01-01 10:00:00', 'tags': 'b,a', 'flags': '0x0201'}]
+    # pymysqlreplication decodes TIMESTAMP in local time, an empty SET as NULL and BIT as a string of bits
+    event = rows_event('insert', [
+        {'id': 1, 'created': datetime.datetime(2016, 7, 1, 12, 0), 'tags': None, 'flags': '0000000101'},
+        {'id': 2, 'created': datetime.datetime(2016, 1, 1, 11, 0), 'tags': {'a', 'b'}, 'flags': '1000000001'},
+    ])
+    event.columns = [Column('id', FIELD_TYPE.LONG), Column('created', FIELD_TYPE.TIMESTAMP2),
+                     Column('tags', FIELD_TYPE.SET), Column('flags', FIELD_TYPE.BIT)]
+
+    dumped = TypeConverter(structure).convert_rows(dump_rows)
+
+    assert [record['values'] for record in event_rows(event)] == dumped
+    assert dumped[0] == {'id': 1, 'created': datetime.datetime(2016, 7, 1, 10, 0), 'tags': None,
+                         'flags': '0000000101'}
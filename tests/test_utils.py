@@ -0,0 +1,116 @@
+import io
+import subprocess
+
+import pymysql
+import pytest
+
+from mymongolib import utils
+from mymongolib.exceptions import SysException
+from mymongolib.utils import mysqldump_command
+
+from .conftest import DUMP, FakeConnection, FakeCursor, make_conf
+
+
+class FakeProcess:
+    """mysqldump process writing a dump and an exit code
+
+    """
+    def __init__(self, output, returncode, message=b''):
+        self.output = output
+        self.exit_code = returncode
+        self.message = message
+        self.returncode = None
+
+    def __call__(self, command, stdout=None, stderr=None):
+        self.stdout = io.BytesIO(self.output)
+        if stderr is not None:
+            stderr.write(self.message)
+        return self
+
+    def wait(self):
+        self.returncode = self.exit_code
+        return self.returncode
+
+
+class FakePool:
+    """Process pool running the tasks in the calling process
+
+    """
+    def __init__(self, processes, initializer=None, initargs=()):
+        pass
+
+    def imap_unordered(self, func, tasks):
+        return map(func, tasks)
+
+    def terminate(self):
+        pass
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def dump_conf(**kwargs):
+    return make_conf(mysql=dict({'host': 'localhost', 'port': '3306', 'user': 'root', 'password': '',
+                                 'dump_workers': '2'}, **kwargs))
+
+
+def test_full_dump_reads_a_consistent_snapshot():
+    conf = make_conf(mysql={'host': 'localhost', 'port': '3306', 'user': 'root', 'password': ''})['mysql']
+    command = mysqldump_command(conf, 'db', 'data')
+
+    assert '--master-data=2' in command
+    assert '--single-transaction' in command
+
+
+def test_parallel_dump_refuses_tables_without_primary_key(monkeypatch, mongo):
+    executed = list()
+    monkeypatch.setattr(pymysql, 'connect',
+                        lambda **kwargs: FakeConnection(FakeCursor(['a', 'b'], ['a'], executed)))
+
+    with pytest.raises(SysException) as error:
+        utils.run_mysqldump('data', dump_conf()['mysql'], mongo, {})
+    assert 'db.b' in str(error.value)
+    assert not any(sql.startswith('FLUSH TABLES') for sql in executed)
+
+
+def test_consistent_dump_uses_a_single_snapshot(monkeypatch, mongo):
+    dumped = list()
+    monkeypatch.setattr(utils, 'run_mysqldump_parallel', lambda *args: pytest.fail('dumped in parallel'))
+    monkeypatch.setattr(utils, 'mysqldump_import_stream', lambda conf, db, *args: dumped.append(db))
+
+    utils.run_mysqldump('data', dump_conf(dump_consistent='True')['mysql'], mongo, {})
+    assert dumped == ['db']
+
+
+def test_failed_streamed_dump_is_not_committed(monkeypatch, mongo):
+    monkeypatch.setattr(subprocess, 'Popen', FakeProcess(DUMP, 2, b'mysqldump: Got error: 2013: Lost connection'))
+
+    with pytest.raises(SysException) as error:
+        utils.run_mysqldump('data', dump_conf(dump_workers='1')['mysql'], mongo)
+    assert 'Lost connection' in str(error.value)
+    assert mongo.get_log_pos()['log_pos'] == 'NA'
+    assert mongo.get_db_as_parsed('db') is None
+
+
+def test_streamed_dump_is_committed(monkeypatch, mongo):
+    monkeypatch.setattr(subprocess, 'Popen', FakeProcess(DUMP, 0))
+
+    utils.run_mysqldump('data', dump_conf(dump_workers='1')['mysql'], mongo)
+    assert mongo.get_log_pos()['log_pos'] == '154'
+    assert mongo.get_db_as_parsed('db')['data'] == 'ok'
+
+
+def test_failed_table_dump_stops_the_parallel_import(monkeypatch, mongo):
+    monkeypatch.setattr(pymysql, 'connect',
+                        lambda **kwargs: FakeConnection(FakeCursor(['users'], ['users'], list())))
+    monkeypatch.setattr(utils, 'Pool', FakePool)
+    monkeypatch.setattr(utils, 'dump_worker_mongo', mongo)
+    monkeypatch.setattr(subprocess, 'Popen', FakeProcess(DUMP, 2, b'mysqldump: Got error: 2013: Lost connection'))
+
+    with pytest.raises(SysException) as error:
+        utils.run_mysqldump('data', dump_conf()['mysql'], mongo, {})
+    assert 'table db.users' in str(error.value)
+    assert mongo.get_log_pos()['log_pos'] == 'NA'